@@ -136,6 +136,12 @@ print("AWS_S3_REGION_NAME:", AWS_S3_REGION_NAME)
 print("DEFAULT_FILE_STORAGE:", DEFAULT_FILE_STORAGE)
 
 
+# On-demand request profiling: staff users send X-Profile: 1 (or ?profiling=1)
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "True").lower() == "true"
+PROFILING_DIR = BASE_DIR / "profiles"
+PROFILING_MAX_CAPTURES = int(os.getenv("PROFILING_MAX_CAPTURES", "20"))
+
+
 # CORS settings
 CORS_ALLOWED_ORIGINS = os.getenv("CORS_ALLOWED_ORIGINS", "http://localhost:5173,http://localhost:3000").split(",")
 # For development, allow all origins if explicitly set
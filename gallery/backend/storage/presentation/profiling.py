@@ -0,0 +1,103 @@
+"""
+On-demand request profiling - part of the presentation layer.
+
+Staff users add ``X-Profile: 1`` (or ``?profiling=1``) to a request to run it
+under cProfile. The capture is written to ``PROFILING_DIR/<id>/``
+(``python.prof`` for pstats or snakeviz, ``python.txt`` with the top functions
+by cumulative time, and ``meta.json``) and its id is returned in the
+``X-Profile-Id`` response header. Other requests only pay for the header lookup.
+
+cProfile allows one active profiler per process (from Python 3.12 it raises
+otherwise), so a request asking for a capture while another runs is served
+unprofiled, without the header.
+"""
+import cProfile
+import json
+import logging
+import pstats
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from functools import wraps
+from pathlib import Path
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# cProfile allows one active profiler per process.
+_PROFILER_LOCK = threading.Lock()
+
+
+def profiling_requested(request) -> bool:
+    """Whether a staff user asked to profile this request."""
+    flag = request.headers.get('X-Profile') or request.query_params.get('profiling')
+    if flag not in ('1', 'true'):
+        return False
+    if not request.user.is_staff:
+        logger.warning('Ignoring a profiling request from a non-staff user.')
+        return False
+    return settings.PROFILING_ENABLED
+
+
+def prune_profiles(directory: Path, keep: int) -> None:
+    """Delete all but the ``keep`` newest captures; their ids start with a timestamp."""
+    captures = sorted(path for path in directory.iterdir() if path.is_dir())
+    for path in captures[:-keep] if keep else captures:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+@contextmanager
+def capture_profile(label: str):
+    """
+    Profile the block into a new capture directory; yields the capture id.
+
+    Yields ``None`` instead when another capture is running and the block runs unprofiled.
+    """
+    if not _PROFILER_LOCK.acquire(blocking=False):
+        logger.warning('Another capture is running; %s is not profiled.', label)
+        yield None
+        return
+
+    try:
+        profiles_dir = Path(settings.PROFILING_DIR)
+        capture_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        directory = profiles_dir / capture_id
+
+        profiler = cProfile.Profile()
+        started = time.perf_counter()
+        profiler.enable()
+        try:
+            directory.mkdir(parents=True)
+            yield capture_id
+        finally:
+            profiler.disable()
+            elapsed_ms = (time.perf_counter() - started) * 1000
+
+            profiler.dump_stats(directory / 'python.prof')
+            with open(directory / 'python.txt', 'w', encoding='utf-8') as f:
+                pstats.Stats(profiler, stream=f).sort_stats('cumulative').print_stats(50)
+            with open(directory / 'meta.json', 'w', encoding='utf-8') as f:
+                json.dump({'id': capture_id, 'label': label, 'wall_ms': round(elapsed_ms, 1)}, f, indent=4)
+            prune_profiles(profiles_dir, settings.PROFILING_MAX_CAPTURES)
+            logger.info('Profiled %s in %.0f ms: %s', label, elapsed_ms, directory)
+    finally:
+        _PROFILER_LOCK.release()
+
+
+def profiled(handler):
+    """Profile a viewset action when ``profiling_requested``, returning the capture id in ``X-Profile-Id``."""
+    @wraps(handler)
+    def wrapper(self, request, *args, **kwargs):
+        if not profiling_requested(request):
+            return handler(self, request, *args, **kwargs)
+
+        with capture_profile(f'{type(self).__name__}.{handler.__name__}') as capture_id:
+            response = handler(self, request, *args, **kwargs)
+        if capture_id is not None:
+            response['X-Profile-Id'] = capture_id
+        return response
+
+    return wrapper
@@ -8,6 +8,7 @@ from ..domain.serializers import (
     GenerationLogCreateSerializer
 )
 from ..infrastructure.repository import GenerationLogRepository
+from .profiling import profiled
 
 
 class ImagePagination(PageNumberPagination):
@@ -31,6 +32,8 @@ class GenerationLogViewSet(viewsets.ReadOnlyModelViewSet):
     - List: GET /api/generation-logs/ (paginated, non-joined)
     - Create: POST /api/generation-logs/
     - Retrieve: GET /api/generation-logs/{id}/ (with control images joined)
+
+    Staff users can profile any action with ``X-Profile: 1`` (see ``profiling``).
     """
     
     pagination_class = ImagePagination
@@ -47,6 +50,7 @@ class GenerationLogViewSet(viewsets.ReadOnlyModelViewSet):
             return GenerationLogListSerializer
         return GenerationLogSerializer
     
+    @profiled
     def list(self, request, *args, **kwargs):
         """List generation logs with pagination - no joins."""
         queryset = self.get_queryset()
@@ -57,6 +61,7 @@ class GenerationLogViewSet(viewsets.ReadOnlyModelViewSet):
         
         return paginator.get_paginated_response(serializer.data)
     
+    @profiled
     def create(self, request, *args, **kwargs):
         """Create a new generation log."""
         serializer = GenerationLogCreateSerializer(data=request.data)
@@ -75,6 +80,7 @@ class GenerationLogViewSet(viewsets.ReadOnlyModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
     
+    @profiled
     def retrieve(self, request, pk=None, *args, **kwargs):
         """Retrieve a single generation log with all control images joined."""
         log = GenerationLogRepository.get_by_id(pk)
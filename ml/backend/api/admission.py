@@ -0,0 +1,362 @@
+"""
+Cost-aware admission and fair queuing of generation jobs within one process.
+
+A job's cost estimates its denoising work in UNet evaluations of a 512x512
+latent: the steps it runs (a ``strength`` share of them for img2img), doubled
+while classifier-free guidance is on, scaled by the pixels of the diffusion
+pass and by the ControlNets active at each step. Jobs run while the cost of
+the running ones stays within ``admission.budget``; a job costing more than
+the whole budget runs alone, and jobs of CPU-only engines (the ``fast`` tier)
+cost nothing and never wait.
+
+Waiting jobs belong to a priority class (``admission.classes``, e.g.
+``interactive`` previews and ``batch`` work) and are served by self-clocked
+weighted fair queuing: a job's finish tag is its start tag plus
+``cost / weight``, and the waiting job with the smallest tag runs next. While
+several classes have jobs waiting, each receives compute in proportion to its
+weight, so a burst of full-quality jobs cannot starve previews; a class that
+was idle gains no credit for it.
+
+Every ticket records the time spent queued apart from the time spent computing.
+
+Jobs are admitted where inference runs: on the model server, across every
+Django worker, or else within each worker process (``admit``).
+"""
+
+import itertools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Iterator
+
+from api.ml.config import base_size, load_model_config, resolve_generation_config
+from api.ml.controlnets import get_controlnet_window, get_default_controlnet_types
+from api.ml.engines import get_engine, get_engines_config, resolve_engine
+from api.ml.memory_plan import CONTROLNET_UNET_RATIO
+from api.ml.schedulers import scheduler_settings
+from api.ml.status import AdmissionRejected
+
+logger = logging.getLogger(__name__)
+
+# Pixels of the reference latent a cost unit is measured at.
+REFERENCE_PIXELS = 512 * 512
+
+_CONTROLLER: "AdmissionController | None" = None
+_CONTROLLER_LOCK = threading.Lock()
+
+
+@dataclass
+class Ticket:
+    priority: str
+    cost: float
+    finish_tag: float
+    sequence: int
+    queued_at: float = field(default_factory=time.perf_counter)
+    admitted_at: float | None = None
+    finished_at: float | None = None
+
+    @property
+    def queue_ms(self) -> float:
+        admitted_at = self.admitted_at if self.admitted_at is not None else time.perf_counter()
+        return (admitted_at - self.queued_at) * 1000
+
+    @property
+    def compute_ms(self) -> float:
+        if self.admitted_at is None:
+            return 0.0
+        finished_at = self.finished_at if self.finished_at is not None else time.perf_counter()
+        return (finished_at - self.admitted_at) * 1000
+
+    def timing(self) -> dict:
+        return {
+            "priority": self.priority,
+            "cost": round(self.cost, 1),
+            "queue_ms": round(self.queue_ms, 1),
+            "compute_ms": round(self.compute_ms, 1),
+        }
+
+    def server_timing(self) -> str:
+        return server_timing(self.timing())
+
+
+@dataclass
+class ClassStats:
+    admitted: int = 0
+    rejected: int = 0
+    queue_ms: float = 0.0
+    compute_ms: float = 0.0
+
+
+class AdmissionController:
+    """
+    Admit jobs within a concurrent cost budget, in weighted fair order across classes.
+
+    ``weights`` maps each priority class to its share of compute;
+    ``max_queued`` caps the jobs a class may have waiting (``None``: no cap).
+
+    ``admit`` waits for the budget. A queue drained by a single consumer, like
+    the model server's, instead takes ``enqueue``d tickets in ``fair_order``,
+    marks each one ``start``ed when it runs and ``release``s it when done.
+    """
+
+    def __init__(self, budget: float, weights: dict[str, float], max_queued: dict[str, int | None]):
+        self.budget = budget
+        self.weights = weights
+        self.max_queued = max_queued
+        self._cond = threading.Condition()
+        self._waiting: list[Ticket] = []
+        self._running: list[Ticket] = []
+        self._virtual_time = 0.0
+        self._last_finish: dict[str, float] = {}
+        self._sequence = itertools.count()
+        self._stats = {priority: ClassStats() for priority in weights}
+
+    @contextmanager
+    def admit(self, priority: str, cost: float, timeout: float | None = None) -> Iterator[Ticket]:
+        """
+        Wait until the job may run, then hold its share of the budget for the block.
+
+        Raises ``AdmissionRejected`` when the class queue is full or the job
+        waited more than ``timeout`` seconds.
+        """
+        ticket = self.enqueue(priority, cost)
+        self._wait(ticket, timeout)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    @staticmethod
+    def fair_order(ticket: Ticket) -> tuple[float, int]:
+        """Sort key of waiting tickets: the next one to run sorts first."""
+        return ticket.finish_tag, ticket.sequence
+
+    def enqueue(self, priority: str, cost: float) -> Ticket:
+        """Queue a job; raises ``AdmissionRejected`` when its class queue is full."""
+        if priority not in self.weights:
+            raise ValueError(f"Unknown priority class: {priority}")
+
+        with self._cond:
+            max_queued = self.max_queued.get(priority)
+            if cost and max_queued is not None and sum(t.priority == priority for t in self._waiting) >= max_queued:
+                self._stats[priority].rejected += 1
+                raise AdmissionRejected(f"Too many {priority} jobs waiting; try again later.")
+
+            start_tag = max(self._virtual_time, self._last_finish.get(priority, 0.0))
+            finish_tag = start_tag + cost / self.weights[priority]
+            self._last_finish[priority] = finish_tag
+            ticket = Ticket(priority, cost, finish_tag, next(self._sequence))
+            self._waiting.append(ticket)
+            return ticket
+
+    def _runnable(self, ticket: Ticket) -> bool:
+        """Whether ``ticket`` is next in fair order and fits the budget. Holds ``_cond``."""
+        if not ticket.cost:
+            return True
+        head = min(self._waiting, key=self.fair_order)
+        running_cost = sum(t.cost for t in self._running)
+        return head is ticket and (not self._running or running_cost + ticket.cost <= self.budget)
+
+    def _wait(self, ticket: Ticket, timeout: float | None) -> None:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while not self._runnable(ticket):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    self.withdraw(ticket)
+                self._cond.wait(remaining)
+            self.start(ticket)
+
+    def start(self, ticket: Ticket) -> None:
+        """Move a waiting ticket to the running jobs as it starts."""
+        with self._cond:
+            self._waiting.remove(ticket)
+            self._running.append(ticket)
+            if ticket.cost:
+                # Free jobs skip the fair order, so only paid ones advance the clock.
+                self._virtual_time = max(self._virtual_time, ticket.finish_tag)
+            ticket.admitted_at = time.perf_counter()
+            self._cond.notify_all()
+
+    def withdraw(self, ticket: Ticket) -> None:
+        """Give up on a waiting ticket that waited too long; raises ``AdmissionRejected``."""
+        with self._cond:
+            self._waiting.remove(ticket)
+            self._stats[ticket.priority].rejected += 1
+            # The next job in line may fit now.
+            self._cond.notify_all()
+        raise AdmissionRejected(f"Waited {ticket.queue_ms / 1000:.1f}s for {ticket.priority} compute; try again later.")
+
+    def release(self, ticket: Ticket) -> None:
+        """Return a running ticket's share of the budget and record its times."""
+        ticket.finished_at = time.perf_counter()
+        with self._cond:
+            self._running.remove(ticket)
+            stats = self._stats[ticket.priority]
+            stats.admitted += 1
+            stats.queue_ms += ticket.queue_ms
+            stats.compute_ms += ticket.compute_ms
+            self._cond.notify_all()
+        logger.debug(
+            "%s job (cost %.0f): queued %.0f ms, computed %.0f ms",
+            ticket.priority, ticket.cost, ticket.queue_ms, ticket.compute_ms,
+        )
+
+    def status(self) -> dict:
+        """Budget use and, per class, queue length and mean queue and compute times."""
+        with self._cond:
+            classes = {}
+            for priority, stats in self._stats.items():
+                done = stats.admitted or 1
+                classes[priority] = {
+                    "waiting": sum(t.priority == priority for t in self._waiting),
+                    "running": sum(t.priority == priority for t in self._running),
+                    "admitted": stats.admitted,
+                    "rejected": stats.rejected,
+                    "mean_queue_ms": round(stats.queue_ms / done, 1),
+                    "mean_compute_ms": round(stats.compute_ms / done, 1),
+                }
+            return {
+                "budget": self.budget,
+                "running_cost": round(sum(t.cost for t in self._running), 1),
+                "classes": classes,
+            }
+
+
+def server_timing(timing: dict) -> str:
+    """Value of a ``Server-Timing`` header for a ticket's ``timing()``."""
+    return f"queue;dur={timing['queue_ms']:.1f}, compute;dur={timing['compute_ms']:.1f}"
+
+
+def get_admission_config() -> dict:
+    return load_model_config().get("admission", {})
+
+
+def get_priority_classes() -> list[str]:
+    return list(get_admission_config().get("classes", {"interactive": {}, "batch": {}}))
+
+
+def get_default_priority() -> str:
+    return get_admission_config().get("default_class", "interactive")
+
+
+def get_admission_controller() -> AdmissionController | None:
+    """The process-wide controller, built from ``admission`` on first use; ``None`` when disabled."""
+    global _CONTROLLER
+
+    admission_config = get_admission_config()
+    if not admission_config.get("enabled", False):
+        return None
+
+    with _CONTROLLER_LOCK:
+        if _CONTROLLER is None:
+            classes = admission_config.get("classes", {"interactive": {}, "batch": {}})
+            _CONTROLLER = AdmissionController(
+                budget=admission_config.get("budget", 400.0),
+                weights={name: cfg.get("weight", 1.0) for name, cfg in classes.items()},
+                max_queued={name: cfg.get("max_queued") for name, cfg in classes.items()},
+            )
+        return _CONTROLLER
+
+
+@contextmanager
+def admit(options: dict, priority: str | None = None, images: int = 1) -> Iterator[Ticket | None]:
+    """
+    Hold the admission of a job generating ``images`` images with ``options`` for the block.
+
+    Yields the job's ticket, or ``None`` when admission control is disabled.
+    ``priority`` defaults to ``admission.default_class``.
+    """
+    controller = get_admission_controller()
+    if controller is None:
+        yield None
+        return
+
+    timeout = get_admission_config().get("queue_timeout_s", 120)
+    with controller.admit(priority or get_default_priority(), estimate_cost(options, images), timeout=timeout) as ticket:
+        yield ticket
+
+
+@dataclass
+class QueueAdmission:
+    """
+    Admission of the jobs of a queue drained one run at a time in fair order.
+
+    The model server's inference thread takes its queued jobs in
+    ``AdmissionController.fair_order`` and starts their tickets as they run,
+    so the budget does not apply there; ``timeout`` bounds the wait.
+    """
+
+    controller: AdmissionController
+    default_priority: str
+    timeout: float | None
+
+    def enqueue(self, options: dict, priority: str | None = None) -> Ticket:
+        return self.controller.enqueue(priority or self.default_priority, estimate_cost(options))
+
+
+def get_queue_admission() -> QueueAdmission | None:
+    """``QueueAdmission`` on the process-wide controller; ``None`` when admission control is disabled."""
+    controller = get_admission_controller()
+    if controller is None:
+        return None
+    return QueueAdmission(controller, get_default_priority(), get_admission_config().get("queue_timeout_s", 120))
+
+
+def admission_status() -> dict | None:
+    """``AdmissionController.status`` of this process; ``None`` when admission control is disabled."""
+    controller = get_admission_controller()
+    return None if controller is None else controller.status()
+
+
+def estimate_cost(options: dict, images: int = 1) -> float:
+    """
+    Estimated denoising work of generating ``images`` images with ``options``.
+
+    ``options`` are the keyword arguments of ``try_generate_image``; omitted
+    ones take their configured defaults. Engines other than ``sd15`` run their
+    configured steps without ControlNets, scaled by their ``cost_scale``;
+    CPU-only engines cost nothing.
+    """
+    engine = resolve_engine(options.get("engine"), options.get("profile"))
+    if get_engine(engine).cpu_only:
+        return 0.0
+
+    engine_config = get_engines_config().get("available", {}).get(engine, {})
+    gen_config = resolve_generation_config(options.get("profile") if engine == "sd15" else None)
+
+    mode = options.get("mode") or gen_config.get("mode", "txt2img")
+    strength = options.get("strength")
+    if strength is None:
+        strength = gen_config.get("img2img", {}).get("strength", 0.6)
+
+    controlnet_work = 0.0
+    if engine == "sd15":
+        width, height = base_size(gen_config.get("width", 768), gen_config.get("height", 768))
+        steps = gen_config.get("num_inference_steps", 50)
+        guidance_scale = gen_config.get("guidance_scale", 7.5)
+        scheduler = options.get("scheduler") or gen_config.get("scheduler")
+        if scheduler is not None:
+            steps, scheduler_guidance = scheduler_settings(scheduler, gen_config)
+            if scheduler_guidance is not None:
+                guidance_scale = scheduler_guidance
+        cfg_share = gen_config.get("cfg_cutoff", 1.0) if guidance_scale > 1 else 0.0
+
+        controlnet_types = options.get("controlnet_types")
+        if controlnet_types is None:
+            controlnet_types = get_default_controlnet_types()
+        for controlnet_type in set(controlnet_types):
+            start, end = get_controlnet_window(controlnet_type)
+            controlnet_work += CONTROLNET_UNET_RATIO * max(end - start, 0.0)
+    else:
+        width, height = gen_config.get("width", 768), gen_config.get("height", 768)
+        steps = engine_config.get("num_inference_steps", 30)
+        cfg_share = 1.0 if engine_config.get("guidance_scale", 4.5) > 1 else 0.0
+
+    if mode == "img2img":
+        steps = int(steps * strength)
+
+    unet_passes = steps * (1 + cfg_share) * (1 + controlnet_work)
+    return images * unet_passes * width * height / REFERENCE_PIXELS * engine_config.get("cost_scale", 1.0)
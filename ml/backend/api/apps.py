@@ -3,3 +3,8 @@ from django.apps import AppConfig
 
 class ApiConfig(AppConfig):
     name = "api"
+
+    def ready(self):
+        from api.ml.artifacts import configure_offline_mode
+
+        configure_offline_mode()
@@ -0,0 +1,94 @@
+"""Encoding of generated images for API responses."""
+
+import base64
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from PIL import Image
+
+from api.ml.config import load_model_config
+
+MIME_TYPES = {
+    "JPEG": "image/jpeg",
+    "WEBP": "image/webp",
+    "AVIF": "image/avif",
+    "PNG": "image/png",
+}
+# Formats that store grayscale natively, so mode L control maps are not converted to RGB.
+GRAYSCALE_FORMATS = ("JPEG", "PNG")
+
+DEFAULT_ENCODING: dict[str, dict] = {
+    "result": {"format": "JPEG", "quality": 85, "optimize": True},
+    "control": {"format": "JPEG", "quality": 75, "optimize": False},
+}
+
+# Pillow releases the GIL while encoding, so threads encode in parallel.
+_EXECUTOR: ThreadPoolExecutor | None = None
+_EXECUTOR_LOCK = threading.Lock()
+
+
+def get_encodings() -> dict[str, dict]:
+    """Return the encoding settings per output type (``result``, ``control``)."""
+    encoding_config = load_model_config().get("output_encoding", {})
+    return {
+        output_type: {**defaults, **encoding_config.get(output_type, {})}
+        for output_type, defaults in DEFAULT_ENCODING.items()
+    }
+
+
+def save_options(encoding: dict) -> dict:
+    image_format = encoding["format"].upper()
+    options = {"format": image_format}
+
+    if image_format in ("JPEG", "WEBP", "AVIF"):
+        options["quality"] = encoding.get("quality", 85)
+    if image_format in ("JPEG", "PNG"):
+        options["optimize"] = encoding.get("optimize", False)
+    if image_format == "WEBP":
+        # 0 is fastest, 6 gives the smallest files.
+        options["method"] = encoding.get("method", 4)
+    if image_format == "AVIF":
+        # 0 gives the smallest files, 10 is fastest.
+        options["speed"] = encoding.get("speed", 8)
+
+    return options
+
+
+def encode_image(image: Image.Image, encoding: dict) -> tuple[str, str]:
+    """Encode an image to base64, returning it with its MIME type."""
+    options = save_options(encoding)
+    if image.mode != "RGB" and not (image.mode == "L" and options["format"] in GRAYSCALE_FORMATS):
+        image = image.convert("RGB")
+
+    buffer = BytesIO()
+    image.save(buffer, **options)
+    return base64.b64encode(buffer.getvalue()).decode("utf-8"), MIME_TYPES[options["format"]]
+
+
+def encode_images(images: list[tuple[Image.Image, str]]) -> list[tuple[str, str]]:
+    """
+    Encode ``(image, output_type)`` pairs concurrently, preserving their order.
+
+    Each image uses the settings configured for its output type under
+    ``output_encoding`` in ``model_config.json``.
+    """
+    global _EXECUTOR
+
+    encodings = get_encodings()
+    if len(images) <= 1:
+        return [encode_image(image, encodings[output_type]) for image, output_type in images]
+
+    with _EXECUTOR_LOCK:
+        if _EXECUTOR is None:
+            encoding_config = load_model_config().get("output_encoding", {})
+            _EXECUTOR = ThreadPoolExecutor(
+                max_workers=encoding_config.get("max_workers", 4),
+                thread_name_prefix="image-encode",
+            )
+
+    futures = [
+        _EXECUTOR.submit(encode_image, image, encodings[output_type])
+        for image, output_type in images
+    ]
+    return [future.result() for future in futures]
@@ -0,0 +1,418 @@
+"""
+Management command running micro-benchmarks of the request path.
+
+Usage:
+    uv run python manage.py benchmark decode
+    uv run python manage.py benchmark decode --repeat 10
+    uv run python manage.py benchmark encode
+    SHREKIFY_MODEL_CONFIG=model_config.tiny.json uv run python manage.py benchmark step_cache
+    uv run python manage.py benchmark guidance
+    uv run python manage.py benchmark control_maps
+    SHREKIFY_MODEL_CONFIG=model_config.tiny.json uv run python manage.py benchmark schedulers
+    uv run python manage.py benchmark admission
+    uv run python manage.py benchmark cartoon
+"""
+import math
+import statistics
+import threading
+import time
+import tracemalloc
+from io import BytesIO
+from typing import Callable
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from PIL import Image
+
+from api.ml.config import load_generation_config
+
+# Denoising steps of the pipeline suites: enough for step schedules to matter,
+# still quick on the tiny model.
+PIPELINE_STEPS = 20
+# CFG cutoff timed by the guidance suite when generation.cfg_cutoff is off.
+DEFAULT_CFG_CUTOFF = 0.7
+
+
+def measure(fn: Callable[[], object], repeat: int) -> tuple[float, object]:
+    """Return the median wall time in milliseconds and the last result."""
+    timings = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings), result
+
+
+def make_photo(width: int, height: int, image_format: str, orientation: int = 1) -> bytes:
+    """Encode a synthetic photo-sized image with the given EXIF orientation."""
+    gradient = Image.linear_gradient("L").resize((width, height))
+    mirrored = gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT)
+    radial = Image.radial_gradient("L").resize((width, height))
+    image = Image.merge("RGB", (gradient, mirrored, radial))
+    exif = Image.Exif()
+    exif[0x0112] = orientation
+
+    buffer = BytesIO()
+    image.save(buffer, format=image_format, quality=90, exif=exif)
+    return buffer.getvalue()
+
+
+def bench_decode(command: BaseCommand, repeat: int) -> None:
+    from api.ml.image_utils import decode_image
+
+    gen_config = load_generation_config()
+    target = (gen_config.get("width", 768), gen_config.get("height", 768))
+    cases = [
+        ("12MP JPEG", 4000, 3000, "JPEG", 1),
+        ("48MP JPEG rotated", 8000, 6000, "JPEG", 6),
+        ("12MP PNG", 4000, 3000, "PNG", 1),
+    ]
+
+    command.stdout.write(f"Target size {target[0]}x{target[1]}")
+    command.stdout.write(f"{'input':<20} {'legacy ms':>10} {'fast ms':>10} {'speedup':>8} {'decoded':>12}")
+
+    for label, width, height, image_format, orientation in cases:
+        data = make_photo(width, height, image_format, orientation)
+
+        def legacy():
+            image = Image.open(BytesIO(data)).convert("RGB")
+            return image.resize(target, Image.LANCZOS)
+
+        def fast():
+            image = decode_image(BytesIO(data), target)
+            return image, image.resize(target, Image.LANCZOS, reducing_gap=3.0)
+
+        legacy_ms, _ = measure(legacy, repeat)
+        fast_ms, (decoded, _) = measure(fast, repeat)
+        command.stdout.write(
+            f"{label:<20} {legacy_ms:>10.1f} {fast_ms:>10.1f} {legacy_ms / fast_ms:>7.1f}x "
+            f"{decoded.width:>5}x{decoded.height:<6}"
+        )
+
+
+def bench_encode(command: BaseCommand, repeat: int) -> None:
+    from api.encoding import encode_image, encode_images, get_encodings
+
+    gen_config = load_generation_config()
+    size = (gen_config.get("width", 768), gen_config.get("height", 768))
+    photo = Image.open(BytesIO(make_photo(*size, "PNG"))).convert("RGB")
+    control_maps = [photo.convert("L").convert("RGB") for _ in range(3)]
+    outputs = [(photo, "result")] + [(control_map, "control") for control_map in control_maps]
+
+    def sequential():
+        legacy = {"format": "JPEG", "quality": 85, "optimize": True}
+        return [encode_image(image, legacy) for image, _ in outputs]
+
+    legacy_ms, legacy_out = measure(sequential, repeat)
+    parallel_ms, parallel_out = measure(lambda: encode_images(outputs), repeat)
+    command.stdout.write(f"{len(outputs)} images at {size[0]}x{size[1]}")
+    command.stdout.write(
+        f"sequential JPEG optimize: {legacy_ms:.1f} ms, {sum(len(b) for b, _ in legacy_out) / 1024:.0f} KB base64"
+    )
+    command.stdout.write(
+        f"parallel configured:      {parallel_ms:.1f} ms, {sum(len(b) for b, _ in parallel_out) / 1024:.0f} KB base64"
+    )
+
+    result_encoding = get_encodings()["result"]
+    for image_format in ("JPEG", "WEBP", "AVIF"):
+        encoding = {**result_encoding, "format": image_format}
+        try:
+            format_ms, (data, _) = measure(lambda: encode_image(photo, encoding), repeat)
+        except (KeyError, OSError) as exc:
+            command.stdout.write(f"{image_format:<6} unavailable: {exc}")
+            continue
+        command.stdout.write(f"{image_format:<6} result: {format_ms:.1f} ms, {len(data) / 1024:.0f} KB base64")
+
+
+def traced_peak(fn: Callable[[], object]) -> tuple[int, object]:
+    """Return the peak bytes allocated through Python and NumPy while ``fn`` runs, and its result."""
+    tracemalloc.start()
+    try:
+        result = fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak, result
+
+
+def bench_control_maps(command: BaseCommand, repeat: int) -> None:
+    import cv2
+
+    from api.encoding import encode_image, get_encodings
+    from api.ml.controlnets import ControlMap
+    from api.ml.controlnets.canny import get_canny_thresholds
+
+    gen_config = load_generation_config()
+    size = (gen_config.get("width", 768), gen_config.get("height", 768))
+    gray = np.asarray(Image.open(BytesIO(make_photo(*size, "PNG"))).convert("L"))
+    low_threshold, high_threshold = get_canny_thresholds()
+
+    def legacy():
+        # Preprocessor output as a 3-channel PIL image, then the pipeline's
+        # PIL-to-float conversion (VaeImageProcessor.pil_to_numpy).
+        edges = Image.fromarray(cv2.cvtColor(cv2.Canny(gray, low_threshold, high_threshold), cv2.COLOR_GRAY2RGB))
+        return np.array(edges).astype(np.float32) / 255.0
+
+    def array_native():
+        return ControlMap(cv2.Canny(gray, low_threshold, high_threshold)).to_tensor()
+
+    command.stdout.write(f"Canny control map at {size[0]}x{size[1]}, up to the tensor the pipeline takes")
+    command.stdout.write(f"{'path':<14} {'ms':>8} {'peak KB':>10}")
+    for label, fn in (("legacy PIL", legacy), ("ControlMap", array_native)):
+        path_ms, _ = measure(fn, repeat)
+        peak, _ = traced_peak(fn)
+        command.stdout.write(f"{label:<14} {path_ms:>8.2f} {peak / 1024:>10.0f}")
+
+    control_map = ControlMap(cv2.Canny(gray, low_threshold, high_threshold))
+    encoding = get_encodings()["control"]
+    for label, image in (("RGB", control_map.to_pil().convert("RGB")), ("L", control_map.to_pil())):
+        encode_ms, (data, _) = measure(lambda: encode_image(image, encoding), repeat)
+        command.stdout.write(f"returned as {label:<3} {encode_ms:>8.2f} ms, {len(data) / 1024:.0f} KB base64")
+
+
+def psnr(reference: np.ndarray, image: np.ndarray) -> float:
+    """Peak signal-to-noise ratio in dB of two float images in [0, 1]."""
+    mse = float(np.mean((reference - image) ** 2))
+    return math.inf if mse == 0 else 10 * math.log10(1 / mse)
+
+
+def bench_step_cache(command: BaseCommand, repeat: int) -> None:
+    import torch
+
+    from api.ml.pipeline import get_pipeline_variant, load_pipeline
+    from api.ml.step_cache import step_cache
+
+    if load_pipeline() is None:
+        raise CommandError("Pipeline failed to load; see the log for details.")
+    pipeline, _ = get_pipeline_variant([], "txt2img")
+
+    gen_config = load_generation_config()
+    steps = PIPELINE_STEPS
+    size = (gen_config.get("width", 768), gen_config.get("height", 768))
+
+    def run(interval: int) -> np.ndarray:
+        with step_cache(pipeline, interval):
+            return pipeline(
+                prompt="an ogre in a swamp",
+                num_inference_steps=steps,
+                guidance_scale=gen_config.get("guidance_scale", 7.5),
+                width=size[0],
+                height=size[1],
+                generator=torch.Generator().manual_seed(0),
+                output_type="np",
+            ).images[0]
+
+    run(1)  # warm-up
+    baseline_ms, reference = measure(lambda: run(1), repeat)
+    command.stdout.write(f"{steps} steps at {size[0]}x{size[1]}")
+    command.stdout.write(f"{'interval':>8} {'ms':>10} {'speedup':>8} {'PSNR dB':>8}")
+    for interval in (1, 2, 3, 5):
+        cached_ms, image = measure(lambda: run(interval), repeat) if interval > 1 else (baseline_ms, reference)
+        command.stdout.write(
+            f"{interval:>8} {cached_ms:>10.1f} {baseline_ms / cached_ms:>7.2f}x {psnr(reference, image):>8.1f}"
+        )
+
+
+def bench_guidance(command: BaseCommand, repeat: int) -> None:
+    import torch
+
+    from api.ml.controlnets import get_controlnet_scale, get_controlnet_window, get_default_controlnet_types
+    from api.ml.guidance import cfg_truncation, skip_inactive_controlnets
+    from api.ml.pipeline import get_pipeline_variant, load_pipeline
+
+    if load_pipeline() is None:
+        raise CommandError("Pipeline failed to load; see the log for details.")
+    pipeline, controlnet_types = get_pipeline_variant(get_default_controlnet_types(), "txt2img")
+
+    gen_config = load_generation_config()
+    size = (gen_config.get("width", 768), gen_config.get("height", 768))
+    guidance_scale = gen_config.get("guidance_scale", 7.5)
+    if guidance_scale <= 1 or pipeline.unet.config.time_cond_proj_dim is not None:
+        raise CommandError("The pipeline does not use classifier-free guidance; nothing to truncate.")
+    cfg_cutoff = gen_config.get("cfg_cutoff", 1.0)
+    if cfg_cutoff >= 1:
+        cfg_cutoff = DEFAULT_CFG_CUTOFF
+    cutoff_step = math.ceil(cfg_cutoff * PIPELINE_STEPS)
+
+    control_image = Image.open(BytesIO(make_photo(*size, "PNG"))).convert("RGB")
+    windows = [get_controlnet_window(cn_type) for cn_type in controlnet_types]
+
+    def run(use_windows: bool, truncate: bool) -> list[float]:
+        """Return the wall time of every denoising step in milliseconds."""
+        marks = [time.perf_counter()]
+
+        def on_step_end(pipe, step, timestep, callback_kwargs):
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            marks.append(time.perf_counter())
+            return callback_kwargs
+
+        gen_kwargs = {
+            "prompt": "an ogre in a swamp",
+            "num_inference_steps": PIPELINE_STEPS,
+            "guidance_scale": guidance_scale,
+            "width": size[0],
+            "height": size[1],
+            "generator": torch.Generator().manual_seed(0),
+            "output_type": "latent",
+            "callback_on_step_end": on_step_end,
+        }
+        if controlnet_types:
+            gen_kwargs["image"] = [control_image] * len(controlnet_types)
+            gen_kwargs["controlnet_conditioning_scale"] = [get_controlnet_scale(t) for t in controlnet_types]
+            if use_windows:
+                gen_kwargs["control_guidance_start"] = [start for start, _ in windows]
+                gen_kwargs["control_guidance_end"] = [end for _, end in windows]
+
+        with skip_inactive_controlnets(pipeline), cfg_truncation(pipeline, cutoff_step if truncate else None):
+            pipeline(**gen_kwargs)
+        # The first interval also covers prompt encoding and latent setup.
+        return [(end - start) * 1000 for start, end in zip(marks[1:], marks[2:])]
+
+    cases = {
+        "baseline": (False, False),
+        "windows": (True, False),
+        "cfg cutoff": (False, True),
+        "both": (True, True),
+    }
+    run(False, False)  # warm-up
+    timings = {
+        label: [statistics.median(step) for step in zip(*(run(*flags) for _ in range(repeat)))]
+        for label, flags in cases.items()
+    }
+
+    command.stdout.write(
+        f"{PIPELINE_STEPS} steps at {size[0]}x{size[1]}, ControlNets: {', '.join(controlnet_types) or 'none'}, "
+        f"CFG cutoff at step {cutoff_step}"
+    )
+    command.stdout.write(f"{'step':>4} " + " ".join(f"{label:>11}" for label in cases))
+    for step, row in enumerate(zip(*timings.values()), start=1):
+        command.stdout.write(f"{step:>4} " + " ".join(f"{ms:>11.1f}" for ms in row))
+    command.stdout.write(f"{'sum':>4} " + " ".join(f"{sum(steps):>11.1f}" for steps in timings.values()))
+
+
+def bench_schedulers(command: BaseCommand, repeat: int) -> None:
+    import torch
+
+    from api.ml.pipeline import get_pipeline_variant, load_pipeline
+    from api.ml.schedulers import get_scheduler_names, get_scheduler_preset, with_scheduler
+
+    if load_pipeline() is None:
+        raise CommandError("Pipeline failed to load; see the log for details.")
+    pipeline, _ = get_pipeline_variant([], "txt2img")
+
+    gen_config = load_generation_config()
+    size = (gen_config.get("width", 768), gen_config.get("height", 768))
+
+    def run(name: str | None, steps: int, guidance_scale: float) -> None:
+        with_scheduler(pipeline, name)(
+            prompt="an ogre in a swamp",
+            num_inference_steps=steps,
+            guidance_scale=guidance_scale,
+            width=size[0],
+            height=size[1],
+            generator=torch.Generator().manual_seed(0),
+            output_type="np",
+        )
+
+    default_guidance = gen_config.get("guidance_scale", 7.5)
+    cases = [(f"default ({type(pipeline.scheduler).__name__})", None, gen_config.get("num_inference_steps", 50), default_guidance)]
+    for name in get_scheduler_names():
+        preset = get_scheduler_preset(name)
+        guidance_scale = preset.guidance_scale if preset.guidance_scale is not None else default_guidance
+        cases += [(name, name, steps, guidance_scale) for steps in preset.recommended_steps]
+
+    run(None, 1, default_guidance)  # warm-up
+    command.stdout.write(f"{size[0]}x{size[1]}, one image")
+    command.stdout.write(f"{'scheduler':<36} {'steps':>5} {'ms':>10} {'ms/step':>8}")
+    for label, name, steps, guidance_scale in cases:
+        run_ms, _ = measure(lambda: run(name, steps, guidance_scale), repeat)
+        command.stdout.write(f"{label:<36} {steps:>5} {run_ms:>10.1f} {run_ms / steps:>8.1f}")
+
+
+def bench_cartoon(command: BaseCommand, repeat: int) -> None:
+    from api.ml.cartoon import cartoonify_batch
+
+    gen_config = load_generation_config()
+    size = (gen_config.get("width", 768), gen_config.get("height", 768))
+    photo = Image.open(BytesIO(make_photo(*size, "JPEG"))).convert("RGB")
+
+    command.stdout.write(f"{size[0]}x{size[1]}")
+    command.stdout.write(f"{'batch':>5} {'ms':>10} {'ms/image':>9}")
+    for batch_size in (1, 4, 8):
+        batch = [photo] * batch_size
+        run_ms, _ = measure(lambda: cartoonify_batch(batch), repeat)
+        command.stdout.write(f"{batch_size:>5} {run_ms:>10.1f} {run_ms / batch_size:>9.1f}")
+
+
+# Simulated compute time per unit of admission cost in the admission suite.
+ADMISSION_MS_PER_COST = 0.5
+
+
+def bench_admission(command: BaseCommand, repeat: int) -> None:
+    from api.admission import AdmissionController, estimate_cost, get_admission_config
+
+    admission_config = get_admission_config()
+    budget = admission_config.get("budget", 400.0)
+    classes = admission_config.get("classes", {"interactive": {}, "batch": {}})
+    weights = {name: cfg.get("weight", 1.0) for name, cfg in classes.items()}
+
+    # A burst of full-quality batch jobs, then previews: few steps, no ControlNets.
+    batch_cost = estimate_cost({})
+    preview_cost = estimate_cost({"profile": "balanced", "scheduler": "unipc", "controlnet_types": []})
+    jobs = [("batch", batch_cost)] * 8 + [("interactive", preview_cost)] * 4
+
+    def run(controller: AdmissionController, fifo: bool) -> dict[str, list[tuple[float, float]]]:
+        timings = {"batch": [], "interactive": []}
+
+        def job(priority: str, cost: float) -> None:
+            with controller.admit("batch" if fifo else priority, cost) as ticket:
+                time.sleep(cost * ADMISSION_MS_PER_COST / 1000)
+            timings[priority].append((ticket.queue_ms, ticket.compute_ms))
+
+        threads = [threading.Thread(target=job, args=spec) for spec in jobs]
+        for thread in threads:
+            thread.start()
+            # Keep the arrival order.
+            time.sleep(0.002)
+        for thread in threads:
+            thread.join()
+        return timings
+
+    command.stdout.write(
+        f"budget {budget}, batch job cost {batch_cost:.0f}, preview cost {preview_cost:.0f}; "
+        f"8 batch jobs then 4 previews, {ADMISSION_MS_PER_COST} ms per cost unit"
+    )
+    command.stdout.write(f"{'queueing':<14} {'class':<12} {'queue ms':>9} {'compute ms':>11}")
+    for label, fifo in (("fifo", True), ("weighted fair", False)):
+        runs = [run(AdmissionController(budget, weights, {}), fifo) for _ in range(max(1, repeat // 5))]
+        for priority in ("interactive", "batch"):
+            waits = [queue_ms for timings in runs for queue_ms, _ in timings[priority]]
+            computes = [compute_ms for timings in runs for _, compute_ms in timings[priority]]
+            command.stdout.write(
+                f"{label:<14} {priority:<12} {statistics.mean(waits):>9.0f} {statistics.mean(computes):>11.0f}"
+            )
+
+
+SUITES: dict[str, Callable[[BaseCommand, int], None]] = {
+    "admission": bench_admission,
+    "cartoon": bench_cartoon,
+    "control_maps": bench_control_maps,
+    "decode": bench_decode,
+    "encode": bench_encode,
+    "guidance": bench_guidance,
+    "schedulers": bench_schedulers,
+    "step_cache": bench_step_cache,
+}
+
+
+class Command(BaseCommand):
+    help = "Run micro-benchmarks of the Shrekify request path"
+
+    def add_arguments(self, parser):
+        parser.add_argument("suite", choices=sorted(SUITES), help="Benchmark suite to run")
+        parser.add_argument("--repeat", type=int, default=5, help="Runs per measurement (median is reported)")
+
+    def handle(self, *args, **options):
+        SUITES[options["suite"]](self, options["repeat"])
@@ -0,0 +1,74 @@
+"""
+Management command checking the import-time budget of the web process.
+
+Starts a fresh interpreter with ``python -X importtime``, sets up Django and
+imports the URLconf (and with it every view), then fails if the imports exceed
+the budget or if any inference library was imported. Run it in CI to keep
+``manage.py`` commands and worker boots from paying for torch and diffusers.
+
+Usage:
+    uv run python manage.py check_import_time
+    uv run python manage.py check_import_time --budget-ms 1500 --top 15
+"""
+import os
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Libraries that only inference needs; none may load during startup.
+HEAVY_MODULES = ("torch", "diffusers", "transformers", "controlnet_aux", "cv2", "accelerate", "xformers")
+
+
+def parse_importtime(stderr: str) -> list[tuple[str, int, int, int]]:
+    """Return ``(module, depth, self_us, cumulative_us)`` per ``-X importtime`` line."""
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        stripped = name.lstrip(" ")
+        depth = (len(name) - len(stripped) - 1) // 2
+        entries.append((stripped, depth, int(self_us), int(cumulative_us)))
+    return entries
+
+
+class Command(BaseCommand):
+    help = "Fail if importing the web app exceeds the time budget or pulls in inference libraries"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--budget-ms", type=float, default=2000.0, help="Maximum total import time")
+        parser.add_argument("--top", type=int, default=10, help="Number of slowest top-level imports to list")
+
+    def handle(self, *args, **options):
+        code = f"import django; django.setup(); import {settings.ROOT_URLCONF}"
+        env = {**os.environ, "DJANGO_SETTINGS_MODULE": os.environ.get("DJANGO_SETTINGS_MODULE", "backend.settings")}
+        completed = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", code],
+            capture_output=True,
+            text=True,
+            env=env,
+        )
+        if completed.returncode != 0:
+            raise CommandError(f"Import failed:\n{completed.stderr[-2000:]}")
+
+        entries = parse_importtime(completed.stderr)
+        top_level = sorted((e for e in entries if e[1] == 0), key=lambda e: e[3], reverse=True)
+        total_ms = sum(e[3] for e in top_level) / 1000
+
+        self.stdout.write(f"{'module':<40} {'cumulative ms':>14}")
+        for name, _, _, cumulative_us in top_level[:options["top"]]:
+            self.stdout.write(f"{name:<40} {cumulative_us / 1000:>14.1f}")
+        self.stdout.write(f"{'total':<40} {total_ms:>14.1f}")
+
+        heavy = sorted({name for name, *_ in entries if name in HEAVY_MODULES})
+        problems = []
+        if heavy:
+            problems.append(f"inference libraries imported at startup: {', '.join(heavy)}")
+        if total_ms > options["budget_ms"]:
+            problems.append(f"imports took {total_ms:.0f} ms, budget is {options['budget_ms']:.0f} ms")
+
+        if problems:
+            raise CommandError("; ".join(problems))
+        self.stdout.write(self.style.SUCCESS(f"✅ Startup imports within budget ({total_ms:.0f} ms)."))
@@ -0,0 +1,53 @@
+"""
+Management command reporting unique vs shared resident memory per worker.
+
+Usage:
+    uv run python manage.py memory_report
+    uv run python manage.py memory_report --match "gunicorn: worker"
+    uv run python manage.py memory_report --pid 1234 --pid 1235
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from api.ml.memory import find_processes, process_memory
+
+
+class Command(BaseCommand):
+    help = "Report per-process unique vs shared RSS of the ML workers"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--pid", type=int, action="append", default=[], help="Process id to inspect")
+        parser.add_argument(
+            "--match",
+            default="gunicorn",
+            help="Inspect every process whose command line contains this string",
+        )
+
+    def handle(self, *args, **options):
+        pids = options["pid"] or find_processes(options["match"])
+        if not pids:
+            raise CommandError(f"No processes found matching '{options['match']}'.")
+
+        self.stdout.write(f"{'pid':>8} {'rss MB':>10} {'pss MB':>10} {'unique MB':>10} {'shared MB':>10}")
+
+        total_unique_kb = 0
+        max_shared_kb = 0
+        for pid in pids:
+            try:
+                usage = process_memory(pid)
+            except OSError as exc:
+                self.stdout.write(self.style.WARNING(f"{pid:>8} unavailable: {exc}"))
+                continue
+
+            total_unique_kb += usage["unique_kb"]
+            max_shared_kb = max(max_shared_kb, usage["shared_kb"])
+            self.stdout.write(
+                f"{pid:>8} {usage['rss_kb'] / 1024:>10.1f} {usage['pss_kb'] / 1024:>10.1f} "
+                f"{usage['unique_kb'] / 1024:>10.1f} {usage['shared_kb'] / 1024:>10.1f}"
+            )
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Unique total: {total_unique_kb / 1024:.1f} MB, "
+                f"shared (largest mapping): {max_shared_kb / 1024:.1f} MB"
+            )
+        )
@@ -0,0 +1,107 @@
+"""
+Management command showing the memory plan chosen for one or more budgets.
+
+Loads the configured pipeline on the CPU, counts its weights and prints the
+plan and estimated peak for each budget. With ``--generate`` every plan is
+applied and timed with a short generation (on CUDA, with its measured peak).
+
+Usage:
+    uv run python manage.py plan_memory --budget-mb 8000 6000 4000 3000
+    SHREKIFY_MODEL_CONFIG=model_config.tiny.json uv run python manage.py plan_memory --budget-mb 4 2 1 --generate
+"""
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.ml.config import load_model_config
+from api.ml.memory_plan import (
+    apply_memory_plan,
+    choose_plan,
+    count_component_elements,
+    get_budget_mb,
+    get_plan_dtypes,
+    plan_batch_size,
+    plan_overhead_mb,
+    plan_resolution,
+    with_default_controlnets,
+)
+
+
+class Command(BaseCommand):
+    help = "Show the memory plan (dtype, slicing, tiling, offload) chosen for given budgets"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--budget-mb", type=float, nargs="+", help="Budgets to plan for (default: the configured one)")
+        parser.add_argument("--width", type=int, help="Generation width (default: from generation config)")
+        parser.add_argument("--height", type=int, help="Generation height (default: from generation config)")
+        parser.add_argument("--batch-size", type=int, help="Images per pipeline call")
+        parser.add_argument("--device", choices=["cpu", "cuda"], help="Device to plan for (default: this machine's)")
+        parser.add_argument("--generate", action="store_true", help="Apply each plan and time a short generation")
+        parser.add_argument("--steps", type=int, default=2, help="Denoising steps of --generate")
+
+    def handle(self, *args, **options):
+        import torch
+
+        from api.ml.ml_sd15 import encode_ip_adapter_images
+        from api.ml.pipeline import assemble_pipeline, login, select_device
+
+        local_device, dtype = select_device()
+        device = options["device"] or local_device
+        if options["generate"] and device != local_device:
+            raise CommandError(f"--generate needs the {device} device; this machine has {local_device}.")
+
+        default_width, default_height = plan_resolution()
+        width = options["width"] or default_width
+        height = options["height"] or default_height
+        batch_size = options["batch_size"] or plan_batch_size()
+        budgets = options["budget_mb"] or [get_budget_mb(device)]
+        efficient_attention = device == "cuda" and hasattr(torch.nn.functional, "scaled_dot_product_attention")
+
+        login()
+        pipeline = assemble_pipeline(load_model_config(), dtype)
+        elements = with_default_controlnets(count_component_elements(pipeline))
+        self.stdout.write(
+            f"{width}x{height}, batch {batch_size} on {device}; weights: "
+            + ", ".join(f"{name} {count / 1e6:.1f}M" for name, count in elements.items())
+        )
+        self.stdout.write(f"{'budget MB':>10} {'estimate MB':>12} {'fits':>5}  plan")
+
+        for budget_mb in budgets:
+            plan = choose_plan(
+                elements,
+                width,
+                height,
+                batch_size,
+                budget_mb,
+                get_plan_dtypes(device),
+                efficient_attention,
+                allow_offload=device == "cuda",
+                overhead_mb=plan_overhead_mb(device),
+            )
+            budget = "unlimited" if budget_mb is None else f"{budget_mb:.0f}"
+            line = f"{budget:>10} {plan.estimated_peak_mb:>12.0f} {'yes' if plan.fits else 'no':>5}  {plan.describe()}"
+
+            if options["generate"]:
+                apply_memory_plan(pipeline, plan, device)
+                gen_kwargs = {
+                    "prompt": [""] * batch_size,
+                    "num_inference_steps": options["steps"],
+                    "width": width,
+                    "height": height,
+                }
+                if getattr(pipeline, "ip_adapter_enabled", False):
+                    from PIL import Image
+
+                    blank = Image.new("RGB", (width, height))
+                    gen_kwargs["ip_adapter_image_embeds"] = encode_ip_adapter_images(
+                        pipeline, [blank] * batch_size, blank, do_classifier_free_guidance=True
+                    )
+                if device == "cuda":
+                    torch.cuda.reset_peak_memory_stats()
+                started = time.perf_counter()
+                pipeline(**gen_kwargs)
+                line += f" | {(time.perf_counter() - started) * 1000:.0f} ms"
+                if device == "cuda":
+                    line += f", measured peak {torch.cuda.max_memory_allocated() / 2**20:.0f} MB"
+
+            self.stdout.write(line)
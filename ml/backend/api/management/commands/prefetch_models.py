@@ -0,0 +1,81 @@
+"""
+Management command downloading every model artifact ahead of time.
+
+Resolves the repositories referenced by ``model_config.json`` to pinned commits,
+downloads the files the service loads and verifies them against the Hub's
+checksums. Pins and sha256 sums are written to the lock file
+(``artifacts.lock_file``, ``models.lock.json`` by default) next to the config.
+
+Usage:
+    uv run python manage.py prefetch_models            # pin new artifacts, keep existing pins
+    uv run python manage.py prefetch_models --update   # re-resolve every pin
+    uv run python manage.py prefetch_models --verify   # offline: re-hash the local files
+
+With ``SHREKIFY_MODEL_CONFIG=model_config.tiny.json`` this fetches the tiny
+fixture models used to exercise the offline path.
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from api.ml.artifacts import (
+    collect_artifacts,
+    fetch_artifact,
+    get_lock_path,
+    read_lock,
+    verify_artifact,
+    write_lock,
+)
+from api.ml.config import load_model_config
+
+
+class Command(BaseCommand):
+    help = "Download and pin the model artifacts in model_config.json for offline use"
+
+    def add_arguments(self, parser):
+        mode = parser.add_mutually_exclusive_group()
+        mode.add_argument("--update", action="store_true", help="Re-resolve pinned revisions to the latest commit")
+        mode.add_argument("--verify", action="store_true", help="Only re-hash local files against the lock file")
+
+    def handle(self, *args, **options):
+        artifacts = collect_artifacts(load_model_config())
+        lock = read_lock()
+
+        if options["verify"]:
+            self._verify(artifacts, lock)
+            return
+
+        failed = []
+        for artifact in artifacts:
+            pinned = None if options["update"] else lock.get(artifact.repo_id, {}).get("revision")
+            self.stdout.write(f"⬇️  {artifact.repo_id}@{pinned or artifact.revision}")
+            try:
+                entry = fetch_artifact(artifact, pinned_revision=pinned)
+            except Exception as exc:
+                self.stderr.write(f"✗ {artifact.repo_id}: {exc}")
+                failed.append(artifact.repo_id)
+                continue
+
+            lock[artifact.repo_id] = entry
+            size_mb = sum(f["size"] for f in entry["files"].values()) / 2**20
+            self.stdout.write(f"   {entry['revision'][:12]}: {len(entry['files'])} file(s), {size_mb:.1f} MB verified")
+
+        write_lock(lock)
+        self.stdout.write(f"📝 Wrote {get_lock_path()}")
+
+        if failed:
+            raise CommandError(f"Failed to prefetch: {', '.join(failed)}")
+        self.stdout.write(self.style.SUCCESS(f"✅ {len(artifacts)} artifact(s) ready for offline use."))
+
+    def _verify(self, artifacts, lock: dict) -> None:
+        problems = []
+        for artifact in artifacts:
+            entry = lock.get(artifact.repo_id)
+            if entry is None:
+                problems.append(f"{artifact.repo_id}: not in the lock file")
+                continue
+            problems.extend(f"{artifact.repo_id}/{problem}" for problem in verify_artifact(artifact.repo_id, entry))
+
+        for problem in problems:
+            self.stderr.write(f"✗ {problem}")
+        if problems:
+            raise CommandError(f"{len(problems)} artifact problem(s); run prefetch_models to repair them.")
+        self.stdout.write(self.style.SUCCESS(f"✅ {len(artifacts)} artifact(s) verified."))
@@ -0,0 +1,92 @@
+"""
+Management command running the dedicated model-server process.
+
+Django workers submit jobs to it over a Unix socket when ``model_server.enabled``
+is set in ``model_config.json`` (or ``SHREKIFY_MODEL_SERVER_SOCKET`` is exported).
+
+Usage:
+    uv run python manage.py run_model_server
+    uv run python manage.py run_model_server --stub   # no models, for local testing
+
+Send SIGHUP to reread the configuration and reload the models without dropping
+queued jobs, SIGTERM to drain the queue and exit.
+"""
+from django.core.management.base import BaseCommand
+from PIL import ImageFilter
+
+from api.admission import admission_status, get_queue_admission
+from api.ml.config import load_model_config
+from api.ml.ipc import DEFAULT_SOCKET_PATH, get_model_server_config
+from api.ml.model_server import ModelServer
+from api.singleflight import SingleFlight
+
+
+def stub_generate(image, **options):
+    """Stand-in for the diffusion pipeline that exercises the full IPC path."""
+    from api.ml.results import fallback_result
+
+    result = fallback_result(image)
+    result.control_images.append((image.filter(ImageFilter.FIND_EDGES), "Stub Edges"))
+    return result
+
+
+def with_admission(status=None):
+    """Wrap a status callable to also report the admission queues, which live in this process."""
+    def server_status():
+        report = status() if status is not None else {}
+        admission = admission_status()
+        return report if admission is None else {**report, "admission": admission}
+
+    return server_status
+
+
+class Command(BaseCommand):
+    help = "Run the long-lived model server that owns the inference pipeline"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--socket", help="Unix socket path (defaults to model_server.socket_path)")
+        parser.add_argument(
+            "--stub",
+            action="store_true",
+            help="Serve a lightweight stand-in instead of loading the models",
+        )
+
+    def handle(self, *args, **options):
+        server_config = get_model_server_config()
+        socket_path = options["socket"] or server_config.get("socket_path", DEFAULT_SOCKET_PATH)
+        # Duplicate requests from different Django workers meet here.
+        coalescing = load_model_config().get("coalescing", {}).get("enabled", True)
+        flights = SingleFlight() if coalescing else None
+        # Their jobs are also taken in weighted fair order here, across every worker.
+        admission = get_queue_admission()
+
+        if options["stub"]:
+            self.stdout.write("🧪 Starting stub model server (no models loaded)...")
+            server = ModelServer(
+                socket_path,
+                generate=stub_generate,
+                status=with_admission(),
+                flights=flights,
+                admission=admission,
+            )
+        else:
+            from api.ml.engines import load_engine, try_generate_image, try_generate_images, unload_engines
+            from api.ml.status import get_pipeline_status
+
+            self.stdout.write("🚀 Starting model server...")
+            server = ModelServer(
+                socket_path,
+                generate=try_generate_image,
+                load=load_engine,
+                unload=unload_engines,
+                status=with_admission(get_pipeline_status),
+                generate_batch=try_generate_images,
+                max_batch_size=server_config.get("max_batch_size", 1),
+                batch_window_s=server_config.get("batch_window_ms", 0) / 1000,
+                flights=flights,
+                admission=admission,
+            )
+
+        server.install_signal_handlers()
+        server.serve_forever()
+        self.stdout.write(self.style.SUCCESS("✅ Model server stopped."))
@@ -0,0 +1,223 @@
+"""
+Management command Shrekifying a directory or manifest of photos offline.
+
+Progress is checkpointed to ``<output-dir>/progress.jsonl`` after every batch, so
+rerunning the same command after a crash or kill resumes where it left off.
+
+Usage:
+    uv run python manage.py shrekify_batch --input-dir photos/ --output-dir out/
+    uv run python manage.py shrekify_batch --manifest campaign.jsonl --output-dir out/ --batch-size 8
+
+Manifest lines are JSON objects with a ``path`` and an optional unique ``id``.
+"""
+import json
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from pathlib import Path
+from typing import Iterator
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.encoding import get_encodings, save_options
+from api.ml.config import GENERATION_MODES, get_generation_profiles, load_generation_config, load_model_config
+from api.ml.image_utils import decode_image
+from api.ml.schedulers import get_scheduler_names
+
+logger = logging.getLogger(__name__)
+
+IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tif", ".tiff"}
+PROGRESS_FILE = "progress.jsonl"
+
+
+def iter_directory(input_dir: Path) -> Iterator[tuple[str, Path]]:
+    for path in sorted(input_dir.rglob("*")):
+        if path.is_file() and path.suffix.lower() in IMAGE_SUFFIXES:
+            yield path.relative_to(input_dir).with_suffix("").as_posix(), path
+
+
+def iter_manifest(manifest: Path) -> Iterator[tuple[str, Path]]:
+    with open(manifest, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if "path" not in entry:
+                raise CommandError(f"{manifest}:{line_number}: manifest entry has no 'path'.")
+            path = (manifest.parent / entry["path"]).resolve()
+            yield str(entry.get("id", path.stem)), path
+
+
+def read_progress(progress_path: Path) -> set[str]:
+    """Return the ids finished by previous runs."""
+    if not progress_path.exists():
+        return set()
+
+    done = set()
+    with open(progress_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                done.add(json.loads(line)["id"])
+            except (ValueError, KeyError):
+                # A run killed mid-write leaves a truncated last line.
+                continue
+
+    # Terminate a truncated line so the next record starts on a fresh one.
+    with open(progress_path, "rb+") as f:
+        if f.seek(0, os.SEEK_END) > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                f.write(b"\n")
+
+    return done
+
+
+def batched(items: Iterator, size: int) -> Iterator[list]:
+    while batch := list(islice(items, size)):
+        yield batch
+
+
+class Command(BaseCommand):
+    help = "Shrekify a directory or JSONL manifest of photos in batches, with resume"
+
+    def add_arguments(self, parser):
+        source = parser.add_mutually_exclusive_group(required=True)
+        source.add_argument("--input-dir", type=Path, help="Directory of input photos (searched recursively)")
+        source.add_argument("--manifest", type=Path, help="JSONL manifest with one {'path', 'id'} per line")
+        parser.add_argument("--output-dir", type=Path, required=True, help="Where results and progress are written")
+        parser.add_argument("--batch-size", type=int, default=4, help="Images per pipeline call")
+        parser.add_argument("--prefetch", type=int, default=2, help="Batches decoded ahead of the pipeline")
+        parser.add_argument(
+            "--controlnets",
+            help="Comma-separated ControlNet types (defaults to the configured ones, '' for none)",
+        )
+        parser.add_argument("--mode", choices=GENERATION_MODES, help="Generation mode (defaults to generation.mode)")
+        parser.add_argument("--strength", type=float, help="img2img strength (defaults to generation.img2img.strength)")
+        parser.add_argument("--engine", help="Generation engine (defaults to engines.default)")
+        parser.add_argument("--profile", help="Generation profile (defaults to generation.profile)")
+        parser.add_argument("--scheduler", help="Scheduler preset (defaults to generation.scheduler)")
+        parser.add_argument("--save-control-maps", action="store_true", help="Also write the control maps")
+
+    def handle(self, *args, **options):
+        from api.ml.engines import generate_images, get_engine_names, load_engine, resolve_engine
+
+        output_dir: Path = options["output_dir"]
+        output_dir.mkdir(parents=True, exist_ok=True)
+        progress_path = output_dir / PROGRESS_FILE
+
+        done = read_progress(progress_path)
+        if done:
+            self.stdout.write(f"⏩ Resuming: {len(done)} image(s) already done.")
+
+        if options["input_dir"]:
+            inputs = iter_directory(options["input_dir"])
+        else:
+            inputs = iter_manifest(options["manifest"])
+        pending = ((item_id, path) for item_id, path in inputs if item_id not in done)
+
+        engines = get_engine_names()
+        if options["engine"] and options["engine"] not in engines:
+            raise CommandError(f"Unknown engine {options['engine']}; available: {', '.join(engines)}")
+
+        profiles = get_generation_profiles()
+        if options["profile"] and options["profile"] not in profiles:
+            raise CommandError(f"Unknown profile {options['profile']}; available: {', '.join(profiles)}")
+
+        schedulers = get_scheduler_names()
+        if options["scheduler"] and options["scheduler"] not in schedulers:
+            raise CommandError(f"Unknown scheduler {options['scheduler']}; available: {', '.join(schedulers)}")
+
+        controlnet_types = None
+        if options["controlnets"] is not None:
+            controlnet_types = [t.strip() for t in options["controlnets"].split(",") if t.strip()]
+
+        self.stdout.write("🚀 Loading pipeline...")
+        if load_engine(resolve_engine(options["engine"], options["profile"])) is None:
+            raise CommandError("Pipeline failed to load; see the log for details.")
+
+        gen_config = load_generation_config()
+        target_size = (gen_config.get("width", 768), gen_config.get("height", 768))
+        max_pixels = load_model_config().get("upload", {}).get("max_pixels")
+        encodings = get_encodings()
+
+        def decode_batch(batch: list[tuple[str, Path]]) -> list[tuple[str, object]]:
+            decoded = []
+            for item_id, path in batch:
+                try:
+                    decoded.append((item_id, decode_image(path, target_size, max_pixels)))
+                except Exception as exc:
+                    self.stderr.write(f"✗ {item_id}: could not read {path}: {exc}")
+            return decoded
+
+        processed = 0
+        failed = 0
+        started = time.perf_counter()
+
+        with ThreadPoolExecutor(max_workers=max(options["prefetch"], 1)) as executor, \
+                open(progress_path, "a", encoding="utf-8") as progress:
+            batches = batched(pending, options["batch_size"])
+            queued = deque(
+                executor.submit(decode_batch, batch)
+                for batch in islice(batches, options["prefetch"] + 1)
+            )
+
+            while queued:
+                decoded = queued.popleft().result()
+                # Keep the decoder busy on later batches while this one diffuses.
+                for batch in islice(batches, 1):
+                    queued.append(executor.submit(decode_batch, batch))
+
+                if not decoded:
+                    continue
+
+                ids = [item_id for item_id, _ in decoded]
+                try:
+                    results = generate_images(
+                        [image for _, image in decoded],
+                        options["engine"],
+                        controlnet_types=controlnet_types,
+                        mode=options["mode"],
+                        strength=options["strength"],
+                        profile=options["profile"],
+                        scheduler=options["scheduler"],
+                    )
+                except Exception as exc:
+                    logger.exception("Batch %s failed", ids)
+                    self.stderr.write(f"✗ Batch {ids[0]}..{ids[-1]} failed: {exc}")
+                    failed += len(ids)
+                    continue
+
+                for item_id, result in zip(ids, results):
+                    outputs = [self._write(output_dir, item_id, result.image, encodings["result"])]
+                    if options["save_control_maps"]:
+                        for index, (control_image, _) in enumerate(result.control_images):
+                            name = f"{item_id}_control{index}"
+                            outputs.append(self._write(output_dir, name, control_image, encodings["control"]))
+                    progress.write(json.dumps({"id": item_id, "outputs": outputs}) + "\n")
+
+                progress.flush()
+                os.fsync(progress.fileno())
+
+                processed += len(results)
+                elapsed = time.perf_counter() - started
+                self.stdout.write(f"  {processed} done ({processed / elapsed:.2f} images/s)")
+
+        elapsed = time.perf_counter() - started
+        rate = processed / elapsed if elapsed else 0.0
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"✅ {processed} image(s) in {elapsed:.1f}s ({rate:.2f} images/s), {failed} failed."
+            )
+        )
+
+    @staticmethod
+    def _write(output_dir: Path, name: str, image, encoding: dict) -> str:
+        save = save_options(encoding)
+        relative = f"{name}.{save['format'].lower().replace('jpeg', 'jpg')}"
+        path = output_dir / relative
+        path.parent.mkdir(parents=True, exist_ok=True)
+        image.convert("RGB").save(path, **save)
+        return relative
@@ -1,39 +1,63 @@
-"""ML module for Shrekify image generation."""
-
-from .ml_sd15 import GenerationResult, generate_shrek_image, try_generate_shrek_image
-from .pipeline import load_pipeline, get_pipeline, PipelineType
-from .config import load_model_config, load_prompts_config, load_generation_config
-from .image_utils import load_style_image, fallback_effect
-from .controlnets import (
-    extract_canny_edges,
-    extract_softedge,
-    extract_lineart,
-    extract_depth,
-    extract_openpose,
-    try_load_controlnets,
-    get_controlnets,
-    process_control_images,
-)
-
-__all__ = [
-    "GenerationResult",
-    "generate_shrek_image",
-    "try_generate_shrek_image",
-    "load_pipeline",
-    "get_pipeline",
-    "PipelineType",
-    "load_model_config",
-    "load_prompts_config",
-    "load_generation_config",
-    "load_style_image",
-    "fallback_effect",
+"""
+ML module for Shrekify image generation.
+
+Names are imported from their submodules on first access (PEP 562), so importing
+``api.ml`` (or a light submodule such as ``api.ml.config``) does not pull in
+torch, diffusers or transformers. Only running inference does.
+"""
+
+from importlib import import_module
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .pipeline import PipelineType
+
+_EXPORTS = {
+    "GenerationResult": ".results",
+    "fallback_result": ".results",
+    "generate_shrek_image": ".ml_sd15",
+    "generate_shrek_images": ".ml_sd15",
+    "try_generate_shrek_image": ".ml_sd15",
+    "shrekify_video": ".video",
+    "generate_images": ".engines",
+    "try_generate_image": ".engines",
+    "try_generate_images": ".engines",
+    "get_engine": ".engines",
+    "load_engine": ".engines",
+    "load_pipeline": ".pipeline",
+    "get_pipeline": ".pipeline",
+    "get_pipeline_variant": ".pipeline",
+    "PipelineType": ".pipeline",
+    "get_pipeline_status": ".status",
+    "load_model_config": ".config",
+    "load_prompts_config": ".config",
+    "load_generation_config": ".config",
+    "load_style_image": ".image_utils",
+    "fallback_effect": ".image_utils",
     # ControlNet
-    "extract_canny_edges",
-    "extract_softedge",
-    "extract_lineart",
-    "extract_depth",
-    "extract_openpose",
-    "try_load_controlnets",
-    "get_controlnets",
-    "process_control_images",
-]
+    "ControlMap": ".controlnets",
+    "extract_canny_edges": ".controlnets",
+    "extract_softedge": ".controlnets",
+    "extract_lineart": ".controlnets",
+    "extract_depth": ".controlnets",
+    "extract_openpose": ".controlnets",
+    "try_load_controlnets": ".controlnets",
+    "load_controlnets": ".controlnets",
+    "get_controlnets": ".controlnets",
+    "process_control_images": ".controlnets",
+    "process_control_images_batch": ".controlnets",
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name: str):
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(import_module(_EXPORTS[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> list[str]:
+    return sorted(list(globals()) + __all__)
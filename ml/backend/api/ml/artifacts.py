@@ -0,0 +1,273 @@
+"""
+Pinned, checksummed model artifacts and strict offline loading.
+
+``manage.py prefetch_models`` resolves every Hub repository referenced by
+``model_config.json`` to a commit, downloads the files the service loads and
+records their sha256 in a lock file next to the config. At runtime
+``resolve_pretrained`` maps a repository id to its pinned local snapshot, so
+``from_pretrained`` never contacts the Hub for locked artifacts. With
+``artifacts.offline`` (or ``SHREKIFY_OFFLINE=1``) anything not in the lock
+file is an error instead of a download.
+"""
+
+import fnmatch
+import hashlib
+import json
+import logging
+import os
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from .config import CONFIG_DIR, load_model_config
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LOCK_FILE = "models.lock.json"
+DEFAULT_DEPTH_MODEL = "Intel/dpt-large"
+DEFAULT_ANNOTATORS_REPO = "lllyasviel/Annotators"
+DEFAULT_SD35_MODEL = "stabilityai/stable-diffusion-3.5-medium"
+
+# Files loaded from each kind of repository, as Hub path patterns.
+PIPELINE_PATTERNS = [
+    "model_index.json",
+    "*/*.json",
+    "*/*.txt",
+    "*/diffusion_pytorch_model.safetensors",
+    "*/model.safetensors",
+]
+# SD3.5 adds a sharded T5 encoder and a SentencePiece tokenizer.
+SD35_PIPELINE_PATTERNS = PIPELINE_PATTERNS + ["*/model-*.safetensors", "*/*.model"]
+CONTROLNET_PATTERNS = ["config.json", "diffusion_pytorch_model.safetensors"]
+LORA_PATTERNS = ["pytorch_lora_weights.safetensors"]
+TRANSFORMERS_PATTERNS = ["*.json", "*.txt", "model.safetensors"]
+
+# controlnet_aux checkpoints behind each preprocessor, in the annotators repo.
+ANNOTATOR_FILES: dict[str, list[str]] = {
+    "softedge": ["ControlNetHED.pth"],
+    "lineart": ["sk_model.pth", "sk_model2.pth"],
+    "openpose": ["body_pose_model.pth", "hand_pose_model.pth", "facenet.pth"],
+}
+
+
+class ArtifactError(RuntimeError):
+    """A model artifact is missing from the local cache or fails verification."""
+
+
+@dataclass
+class Artifact:
+    repo_id: str
+    allow_patterns: list[str] = field(default_factory=list)
+    revision: str = "main"
+
+
+def get_artifacts_config() -> dict:
+    return load_model_config().get("artifacts", {})
+
+
+def offline_mode() -> bool:
+    env = os.getenv("SHREKIFY_OFFLINE")
+    if env is not None:
+        return env.lower() in ("1", "true", "yes")
+    return get_artifacts_config().get("offline", False)
+
+
+def configure_offline_mode() -> None:
+    """Switch the Hugging Face libraries to offline mode when it is enabled."""
+    cache_dir = get_artifacts_config().get("cache_dir")
+    if cache_dir:
+        os.environ.setdefault("HF_HUB_CACHE", cache_dir)
+
+    if offline_mode():
+        os.environ.setdefault("HF_HUB_OFFLINE", "1")
+        os.environ.setdefault("TRANSFORMERS_OFFLINE", "1")
+        logger.info("Model artifacts are loaded in offline mode.")
+
+
+def get_annotators_repo() -> str:
+    """Repository holding the controlnet_aux preprocessor checkpoints."""
+    return load_model_config().get("controlnet", {}).get("annotators_repo", DEFAULT_ANNOTATORS_REPO)
+
+
+def get_cache_dir() -> Path:
+    cache_dir = get_artifacts_config().get("cache_dir")
+    if cache_dir:
+        return Path(cache_dir)
+
+    from huggingface_hub import constants
+    return Path(constants.HF_HUB_CACHE)
+
+
+def get_lock_path() -> Path:
+    return CONFIG_DIR / get_artifacts_config().get("lock_file", DEFAULT_LOCK_FILE)
+
+
+def read_lock() -> dict[str, dict]:
+    lock_path = get_lock_path()
+    if not lock_path.exists():
+        return {}
+    with open(lock_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_lock(lock: dict[str, dict]) -> None:
+    with open(get_lock_path(), "w", encoding="utf-8") as f:
+        json.dump(dict(sorted(lock.items())), f, indent=4)
+        f.write("\n")
+
+
+def snapshot_path(repo_id: str, revision: str) -> Path:
+    """Local directory of a pinned snapshot in the Hugging Face cache layout."""
+    return get_cache_dir() / f"models--{repo_id.replace('/', '--')}" / "snapshots" / revision
+
+
+def collect_artifacts(model_config: dict) -> list[Artifact]:
+    """List the Hub repositories (and files in them) that ``model_config`` loads."""
+    artifacts_config = model_config.get("artifacts", {})
+    patterns: dict[str, list[str]] = {}
+
+    def add(repo_id: str, repo_patterns: list[str]) -> None:
+        merged = patterns.setdefault(repo_id, [])
+        merged.extend(p for p in repo_patterns if p not in merged)
+
+    add(model_config.get("model_id", "runwayml/stable-diffusion-v1-5"), PIPELINE_PATTERNS)
+
+    ip_config = model_config.get("ip_adapter", {})
+    if ip_config:
+        subfolder = ip_config.get("subfolder", "models")
+        add(
+            ip_config.get("repo", "h94/IP-Adapter"),
+            [f"{subfolder}/{name}" for name in ip_config.get("weight_names", [])]
+            + [f"{subfolder}/image_encoder/*.json", f"{subfolder}/image_encoder/model.safetensors"],
+        )
+
+    lcm_config = model_config.get("lcm_lora", {})
+    if lcm_config.get("enabled", False):
+        add(lcm_config.get("lora_id", "latent-consistency/lcm-lora-sdv1-5"), LORA_PATTERNS)
+
+    controlnet_config = model_config.get("controlnet", {})
+    if controlnet_config.get("enabled", False):
+        annotators_repo = controlnet_config.get("annotators_repo", DEFAULT_ANNOTATORS_REPO)
+        for cn_type, model_id in controlnet_config.get("models", {}).items():
+            add(model_id, CONTROLNET_PATTERNS)
+            if cn_type in ANNOTATOR_FILES:
+                add(annotators_repo, ANNOTATOR_FILES[cn_type])
+            if cn_type == "depth":
+                add(controlnet_config.get("depth_model", DEFAULT_DEPTH_MODEL), TRANSFORMERS_PATTERNS)
+
+    sd35_config = model_config.get("engines", {}).get("available", {}).get("sd35_nf4", {})
+    if sd35_config.get("enabled", False):
+        add(sd35_config.get("model_id", DEFAULT_SD35_MODEL), SD35_PIPELINE_PATTERNS)
+
+    # Repositories whose layout differs from the defaults above.
+    for repo_id, repo_patterns in artifacts_config.get("allow_patterns", {}).items():
+        if repo_id in patterns:
+            patterns[repo_id] = list(repo_patterns)
+
+    revisions = artifacts_config.get("revisions", {})
+    return [
+        Artifact(repo_id=repo_id, allow_patterns=repo_patterns, revision=revisions.get(repo_id, "main"))
+        for repo_id, repo_patterns in patterns.items()
+    ]
+
+
+def file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def git_blob_sha1(path: Path) -> str:
+    """The git object id the Hub reports for files not stored in LFS."""
+    digest = hashlib.sha1()
+    digest.update(f"blob {path.stat().st_size}\0".encode())
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def fetch_artifact(artifact: Artifact, pinned_revision: str | None = None) -> dict:
+    """
+    Download an artifact at a fixed commit and verify it against the Hub's hashes.
+
+    Returns the lock entry: the commit and the sha256 of every downloaded file.
+    """
+    from huggingface_hub import HfApi, hf_hub_download
+
+    api = HfApi()
+    revision = pinned_revision or api.model_info(artifact.repo_id, revision=artifact.revision).sha
+    info = api.model_info(artifact.repo_id, revision=revision, files_metadata=True)
+
+    siblings = [
+        sibling for sibling in info.siblings
+        if any(fnmatch.fnmatch(sibling.rfilename, pattern) for pattern in artifact.allow_patterns)
+    ]
+    if not siblings:
+        raise ArtifactError(f"{artifact.repo_id}@{revision} has no files matching {artifact.allow_patterns}.")
+
+    files = {}
+    for sibling in siblings:
+        local_path = Path(hf_hub_download(
+            artifact.repo_id,
+            sibling.rfilename,
+            revision=revision,
+            cache_dir=get_cache_dir(),
+        ))
+
+        sha256 = file_sha256(local_path)
+        if sibling.lfs is not None:
+            verified = sha256 == sibling.lfs.sha256
+        else:
+            verified = git_blob_sha1(local_path) == sibling.blob_id
+        if not verified:
+            raise ArtifactError(f"Checksum mismatch for {artifact.repo_id}/{sibling.rfilename}@{revision}.")
+
+        files[sibling.rfilename] = {"sha256": sha256, "size": local_path.stat().st_size}
+
+    return {"revision": revision, "files": files}
+
+
+def verify_artifact(repo_id: str, entry: dict) -> list[str]:
+    """Re-hash a locked artifact's local files; return the ones that are missing or differ."""
+    root = snapshot_path(repo_id, entry["revision"])
+    problems = []
+    for filename, expected in entry["files"].items():
+        path = root / filename
+        if not path.exists():
+            problems.append(f"{filename}: missing")
+        elif file_sha256(path) != expected["sha256"]:
+            problems.append(f"{filename}: sha256 mismatch")
+    return problems
+
+
+def resolve_pretrained(repo_id: str) -> str:
+    """
+    Return the local pinned snapshot for ``repo_id`` if it was prefetched.
+
+    Falls back to the repository id (a regular Hub download) unless offline mode
+    is on, in which case an artifact that is not fully prefetched raises
+    ``ArtifactError``. Local paths are returned unchanged.
+    """
+    if os.path.isdir(repo_id):
+        return repo_id
+
+    offline = offline_mode()
+    entry = read_lock().get(repo_id)
+
+    if entry is None:
+        if offline:
+            raise ArtifactError(f"{repo_id} is not in {get_lock_path().name}; run `manage.py prefetch_models`.")
+        return repo_id
+
+    root = snapshot_path(repo_id, entry["revision"])
+    missing = [filename for filename in entry["files"] if not (root / filename).exists()]
+    if missing:
+        if offline:
+            raise ArtifactError(f"{repo_id}@{entry['revision']} is missing {missing}; run `manage.py prefetch_models`.")
+        logger.warning("Pinned snapshot of %s is incomplete; loading from the Hub.", repo_id)
+        return repo_id
+
+    logger.debug("Loading %s from pinned snapshot %s", repo_id, root)
+    return str(root)
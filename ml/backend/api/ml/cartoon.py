@@ -0,0 +1,152 @@
+"""
+CPU cartoon stylisation: the ``fast`` tier and the fallback when diffusion is unavailable.
+
+No model is involved. Each image is smoothed with bilateral filters at half
+resolution (flattening textures while keeping edges), its colours are
+quantised to ``cartoon.levels`` levels, and skin, found by its chroma, is
+repainted along an ogre-green ramp (``cartoon.palette``, dark to light) by
+luminance. Canny edges of the smoothed image, with the ControlNet thresholds,
+are drawn on top as ink outlines.
+
+The per-pixel steps are lookup tables and array arithmetic over the whole
+batch; only the filters run image by image.
+"""
+
+import logging
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from .config import load_model_config
+from .controlnets.canny import canny_edges_batch
+from .results import GenerationResult
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PALETTE = ["#1f2a0c", "#3d5516", "#5e7d21", "#84a436", "#b2ca5d", "#dbe99c"]
+# Range of skin in YCrCb: any luminance, then the Cr and Cb chroma.
+SKIN_LOWER = (0, 133, 77)
+SKIN_UPPER = (255, 173, 127)
+# Neighbourhood of each bilateral pass; OpenCV has a fast path up to 5.
+BILATERAL_DIAMETER = 5
+
+
+def get_cartoon_config() -> dict:
+    return load_model_config().get("cartoon", {})
+
+
+def hex_to_rgb(color: str) -> tuple[int, int, int]:
+    color = color.lstrip("#")
+    return int(color[0:2], 16), int(color[2:4], 16), int(color[4:6], 16)
+
+
+def palette_lut(palette: list[str], levels: int) -> np.ndarray:
+    """``(256, 3)`` uint8 table mapping a luminance to its quantised colour on the palette ramp."""
+    colors = np.array([hex_to_rgb(color) for color in palette], dtype=np.float32)
+    step = 256 / levels
+    quantised = (np.floor(np.arange(256) / step) + 0.5) * step
+    positions = np.linspace(0, 255, len(colors))
+    return np.stack(
+        [np.interp(quantised, positions, colors[:, channel]) for channel in range(3)], axis=1
+    ).round().astype(np.uint8)
+
+
+def level_lut(levels: int) -> np.ndarray:
+    """``(256,)`` uint8 table quantising a channel to ``levels`` levels."""
+    step = 256 / levels
+    return ((np.floor(np.arange(256) / step) + 0.5) * step).clip(0, 255).astype(np.uint8)
+
+
+def smooth(image: np.ndarray, passes: int) -> np.ndarray:
+    """Edge-preserving smoothing of an RGB array: bilateral filters at half resolution."""
+    height, width = image.shape[:2]
+    small = cv2.pyrDown(image)
+    for _ in range(passes):
+        small = cv2.bilateralFilter(small, d=BILATERAL_DIAMETER, sigmaColor=40, sigmaSpace=BILATERAL_DIAMETER)
+    return cv2.resize(small, (width, height), interpolation=cv2.INTER_LINEAR)
+
+
+def skin_weight(ycrcb: np.ndarray) -> np.ndarray:
+    """Soft ``[0, 1]`` skin mask of an ``(H, W, 3)`` YCrCb array."""
+    mask = cv2.inRange(ycrcb, SKIN_LOWER, SKIN_UPPER)
+    return cv2.GaussianBlur(mask, (0, 0), sigmaX=3).astype(np.float32) / 255
+
+
+def cartoonify_arrays(stacked: np.ndarray) -> np.ndarray:
+    """Cartoon versions of ``(N, H, W, 3)`` uint8 RGB images."""
+    cartoon_config = get_cartoon_config()
+    levels = cartoon_config.get("levels", 6)
+    passes = cartoon_config.get("smoothing_passes", 3)
+    thickness = cartoon_config.get("edge_thickness", 2)
+    ink = np.array(hex_to_rgb(cartoon_config.get("ink", "#141a08")), dtype=np.uint8)
+    ogre = palette_lut(cartoon_config.get("palette", DEFAULT_PALETTE), levels)
+
+    smoothed = np.stack([smooth(image, passes) for image in stacked])
+    count, height, width, _ = smoothed.shape
+    # The per-pixel steps run on the batch stacked as a single tall image.
+    tall = smoothed.reshape(count * height, width, 3)
+    ycrcb = cv2.cvtColor(tall, cv2.COLOR_RGB2YCrCb)
+    skin = np.concatenate([skin_weight(sample) for sample in ycrcb.reshape(smoothed.shape)])
+
+    # Posterised colours, with skin blended towards the ogre ramp by luminance.
+    posterised = cv2.LUT(tall, level_lut(levels))
+    luminance = cv2.cvtColor(np.ascontiguousarray(ycrcb[..., 0]), cv2.COLOR_GRAY2RGB)
+    repainted = cv2.LUT(luminance, ogre.reshape(256, 1, 3))
+    cartoon = cv2.blendLinear(posterised, repainted, 1 - skin, skin).reshape(smoothed.shape)
+
+    kernel = np.ones((thickness, thickness), np.uint8)
+    for sample, edges in zip(cartoon, canny_edges_batch(smoothed)):
+        sample[cv2.dilate(edges, kernel) > 0] = ink
+    return cartoon
+
+
+def cartoonify_batch(images: list[Image.Image]) -> list[Image.Image]:
+    """Cartoon versions of ``images``; same-size images are processed as one batch."""
+    if not images:
+        return []
+    if len({image.size for image in images}) > 1:
+        return [cartoonify_batch([image])[0] for image in images]
+
+    stacked = np.stack([np.asarray(image.convert("RGB")) for image in images])
+    return [Image.fromarray(sample) for sample in cartoonify_arrays(stacked)]
+
+
+def cartoonify(image: Image.Image) -> Image.Image:
+    return cartoonify_batch([image])[0]
+
+
+def load() -> bool:
+    """Nothing to load; the tier is always available."""
+    return True
+
+
+def warm_up() -> None:
+    cartoonify(Image.new("RGB", (64, 64)))
+
+
+def footprint_mb() -> float:
+    return 0.0
+
+
+def unload() -> None:
+    pass
+
+
+def generate_shrek_images(
+    input_images: list[Image.Image],
+    controlnet_types: list[str] | None = None,
+    mode: str | None = None,
+    strength: float | None = None,
+    profile: str | None = None,
+    scheduler: str | None = None,
+) -> list[GenerationResult]:
+    """
+    Cartoon versions of ``input_images`` for the ``fast`` tier.
+
+    Takes the options of ``ml_sd15.generate_shrek_images``; none of them
+    apply to this engine.
+    """
+    results = cartoonify_batch(input_images)
+    logger.info("Cartoon stylisation complete (%d image(s)).", len(results))
+    return [GenerationResult(image=result, used_fallback=False, control_images=[]) for result in results]
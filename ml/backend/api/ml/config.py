@@ -2,14 +2,26 @@
 
 import json
 import logging
+import os
+from functools import lru_cache
 from pathlib import Path
 
 logger = logging.getLogger(__name__)
 
 CONFIG_DIR = Path(__file__).parent / "configs"
 
+# txt2img denoises from pure noise; img2img starts from the encoded input photo.
+GENERATION_MODES = ("txt2img", "img2img")
 
+
+@lru_cache(maxsize=None)
 def load_config(filename: str) -> dict:
+    """
+    Parse ``configs/<filename>`` on first use; later calls return the same dict.
+
+    Callers must not modify it. ``reload_configs`` makes the next call read
+    the file again.
+    """
     config_path = CONFIG_DIR / filename
     with open(config_path, "r", encoding="utf-8") as f:
         cfg = json.load(f)
@@ -17,8 +29,15 @@ def load_config(filename: str) -> dict:
     return cfg
 
 
+def reload_configs() -> None:
+    """Drop the parsed configuration files, so edits on disk take effect."""
+    load_config.cache_clear()
+    logger.info("Configuration will be reloaded on next use.")
+
+
 def load_model_config() -> dict:
-    return load_config("model_config.json")
+    # SHREKIFY_MODEL_CONFIG selects another file, e.g. model_config.tiny.json.
+    return load_config(os.getenv("SHREKIFY_MODEL_CONFIG", "model_config.json"))
 
 
 def load_prompts_config() -> dict:
@@ -28,3 +47,49 @@ def load_prompts_config() -> dict:
 def load_generation_config() -> dict:
     model_config = load_model_config()
     return model_config.get("generation", {})
+
+
+def get_generation_profiles() -> dict:
+    return load_generation_config().get("profiles", {})
+
+
+def resolve_generation_config(profile: str | None = None) -> dict:
+    """
+    Return the generation config with the overrides of ``profile`` applied.
+
+    ``None`` selects ``generation.profile``. Profiles trade quality for latency;
+    a nested section in a profile updates that section key by key.
+    """
+    gen_config = load_generation_config()
+    profile = profile or gen_config.get("profile", "quality")
+    profiles = gen_config.get("profiles", {})
+    if profile not in profiles:
+        raise ValueError(f"Unknown generation profile: {profile}")
+
+    resolved = dict(gen_config)
+    for key, value in profiles[profile].items():
+        if isinstance(value, dict):
+            resolved[key] = {**resolved.get(key, {}), **value}
+        else:
+            resolved[key] = value
+    return resolved
+
+
+def get_upscale_config() -> dict:
+    return load_generation_config().get("upscale", {})
+
+
+def upscale_enabled() -> bool:
+    return get_upscale_config().get("enabled", False)
+
+
+def base_size(width: int, height: int) -> tuple[int, int]:
+    """Resolution of the diffusion pass when the upscale stage is enabled."""
+    upscale_config = get_upscale_config()
+    if not upscale_config.get("enabled", False):
+        return width, height
+    return upscale_config.get("base_width", 512), upscale_config.get("base_height", 384)
+
+
+def get_video_config() -> dict:
+    return load_model_config().get("video", {})
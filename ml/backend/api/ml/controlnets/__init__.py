@@ -1,25 +1,44 @@
-from .canny import extract_canny_edges
-from .depth import extract_depth
-from .lineart import extract_lineart
-from .loader import (
-    get_controlnet_models,
-    get_controlnets,
-    get_preprocessor,
-    process_control_images,
-    try_load_controlnets,
-)
-from .openpose import extract_openpose
-from .softedge import extract_softedge
-
-__all__ = [
-    "extract_canny_edges",
-    "extract_depth",
-    "extract_lineart",
-    "extract_openpose",
-    "extract_softedge",
-    "get_controlnet_models",
-    "get_controlnets",
-    "get_preprocessor",
-    "process_control_images",
-    "try_load_controlnets",
-]
+"""
+ControlNet preprocessors and models.
+
+Names are imported from their submodules on first access (PEP 562), so reading
+the ControlNet configuration does not import torch, diffusers or the annotators.
+"""
+
+from importlib import import_module
+
+_EXPORTS = {
+    "ControlMap": ".control_map",
+    "extract_canny_edges": ".canny",
+    "extract_depth": ".depth",
+    "extract_lineart": ".lineart",
+    "extract_openpose": ".openpose",
+    "extract_softedge": ".softedge",
+    "get_controlnet_models": ".registry",
+    "get_controlnet_scale": ".registry",
+    "get_controlnet_window": ".registry",
+    "get_preprocessor_config": ".registry",
+    "get_default_controlnet_types": ".registry",
+    "get_controlnets": ".loader",
+    "get_preprocessor": ".loader",
+    "load_controlnets": ".loader",
+    "load_preprocessors": ".loader",
+    "process_control_images": ".loader",
+    "process_control_images_batch": ".loader",
+    "try_load_controlnets": ".loader",
+    "unload_controlnets": ".loader",
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name: str):
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(import_module(_EXPORTS[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> list[str]:
+    return sorted(list(globals()) + __all__)
@@ -0,0 +1,71 @@
+"""
+Control maps kept as NumPy arrays between the preprocessors and the pipeline.
+
+Most maps (edges, line art, depth) are single-channel. They are stored as
+``(H, W)`` uint8 arrays and broadcast to three channels only as views, so no
+3-channel copy is made before the pipeline, which takes the map as a ``[0, 1]``
+tensor. A PIL image is built only when the map is returned to a client.
+"""
+
+from dataclasses import dataclass
+
+import cv2
+import numpy as np
+from PIL import Image
+
+
+@dataclass(frozen=True)
+class ControlMap:
+    # (H, W) uint8, or (H, W, 3) uint8 for colour maps such as OpenPose skeletons.
+    array: np.ndarray
+
+    @classmethod
+    def from_pil(cls, image: Image.Image) -> "ControlMap":
+        return cls(np.array(image if image.mode in ("L", "RGB") else image.convert("RGB")))
+
+    @classmethod
+    def from_detector(cls, detected: np.ndarray) -> "ControlMap":
+        """Wrap a controlnet_aux ``output_type="np"`` result, dropping the channels of grey maps."""
+        if detected.ndim == 3 and np.array_equal(detected[..., 0], detected[..., 1]) \
+                and np.array_equal(detected[..., 0], detected[..., 2]):
+            return cls(np.ascontiguousarray(detected[..., 0]))
+        return cls(detected)
+
+    @property
+    def size(self) -> tuple[int, int]:
+        """``(width, height)``, like ``PIL.Image.size``."""
+        return self.array.shape[1], self.array.shape[0]
+
+    @property
+    def channels(self) -> int:
+        return 1 if self.array.ndim == 2 else self.array.shape[2]
+
+    def resized(self, size: tuple[int, int]) -> "ControlMap":
+        if size == self.size:
+            return self
+        return ControlMap(cv2.resize(self.array, size, interpolation=cv2.INTER_LINEAR))
+
+    def rgb(self) -> np.ndarray:
+        """``(H, W, 3)`` view of the map; single-channel maps are broadcast, not copied."""
+        if self.array.ndim == 3:
+            return self.array
+        return np.broadcast_to(self.array[:, :, None], (*self.array.shape, 3))
+
+    def to_tensor(self):
+        """
+        ``(3, H, W)`` float32 tensor in ``[0, 1]``, as the ControlNet pipelines take it.
+
+        The pipeline's control image processor does not normalise tensors, so it
+        uses this one as is. A single-channel map is converted once and expanded
+        to three channels as a view.
+        """
+        import torch
+
+        scaled = torch.from_numpy(np.divide(self.array, 255, dtype=np.float32))
+        if scaled.ndim == 2:
+            return scaled.unsqueeze(0).expand(3, -1, -1)
+        return scaled.permute(2, 0, 1)
+
+    def to_pil(self) -> Image.Image:
+        """PIL image of the map (mode ``L`` or ``RGB``) for returning it to a client."""
+        return Image.fromarray(self.array)
@@ -4,20 +4,49 @@ import numpy as np
 from PIL import Image
 from transformers import pipeline
 
+from ..artifacts import DEFAULT_DEPTH_MODEL, resolve_pretrained
+from ..config import load_model_config
+from .control_map import ControlMap
+from .registry import get_preprocessor_config
+
 logger = logging.getLogger(__name__)
 _DEPTH_ESTIMATOR = None
 
 
-def extract_depth(image: Image.Image) -> Image.Image:
+def get_depth_estimator():
     global _DEPTH_ESTIMATOR
 
     if _DEPTH_ESTIMATOR is None:
-        logger.info("Loading depth estimator...")
-        _DEPTH_ESTIMATOR = pipeline("depth-estimation", use_fast=True)
+        model_id = load_model_config().get("controlnet", {}).get("depth_model", DEFAULT_DEPTH_MODEL)
+        logger.info("Loading depth estimator %s...", model_id)
+        _DEPTH_ESTIMATOR = pipeline("depth-estimation", model=resolve_pretrained(model_id), use_fast=True)
         logger.info("Depth estimator loaded.")
 
-    depth = _DEPTH_ESTIMATOR(image)["depth"]
-    depth_np = np.array(depth)
-    depth_np = depth_np[:, :, None]
-    depth_np = np.concatenate([depth_np, depth_np, depth_np], axis=2)
-    return Image.fromarray(depth_np)
+    return _DEPTH_ESTIMATOR
+
+
+def _detect_input(image: Image.Image) -> Image.Image:
+    """Scale ``image`` down to ``detect_resolution`` on its short side."""
+    resolution = get_preprocessor_config("depth").get("detect_resolution", 384)
+    scale = resolution / min(image.size)
+    if scale >= 1:
+        return image
+    return image.resize((round(image.width * scale), round(image.height * scale)), Image.LANCZOS)
+
+
+def _depth_map(depth: Image.Image, size: tuple[int, int]) -> ControlMap:
+    # The estimator returns a mode L image; the map stays single-channel.
+    return ControlMap(np.asarray(depth)).resized(size)
+
+
+def extract_depth(image: Image.Image) -> ControlMap:
+    # Estimate on a copy scaled to detect_resolution, then scale the depth map
+    # back up to the generation size.
+    depth = get_depth_estimator()(_detect_input(image))["depth"]
+    return _depth_map(depth, image.size)
+
+
+def extract_depth_batch(images: list[Image.Image]) -> list[ControlMap]:
+    """``extract_depth`` for several images, run through the estimator as one batch."""
+    outputs = get_depth_estimator()([_detect_input(image) for image in images], batch_size=len(images))
+    return [_depth_map(output["depth"], image.size) for output, image in zip(outputs, images)]
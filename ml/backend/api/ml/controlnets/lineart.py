@@ -1,18 +1,49 @@
 import logging
 
+import numpy as np
+import torch
 from controlnet_aux import LineartDetector
+from controlnet_aux.util import HWC3, resize_image
 from PIL import Image
 
+from ..artifacts import get_annotators_repo, resolve_pretrained
+from .control_map import ControlMap
+from .registry import get_preprocessor_config
+
 logger = logging.getLogger(__name__)
 _LINEART_DETECTOR = None
 
 
-def extract_lineart(image: Image.Image) -> Image.Image:
+def get_lineart_detector() -> LineartDetector:
     global _LINEART_DETECTOR
 
     if _LINEART_DETECTOR is None:
         logger.info("Loading Lineart detector...")
-        _LINEART_DETECTOR = LineartDetector.from_pretrained("lllyasviel/Annotators")
+        _LINEART_DETECTOR = LineartDetector.from_pretrained(resolve_pretrained(get_annotators_repo()))
         logger.info("Lineart detector loaded.")
 
-    return _LINEART_DETECTOR(image)
+    return _LINEART_DETECTOR
+
+
+def extract_lineart(image: Image.Image) -> ControlMap:
+    resolution = get_preprocessor_config("lineart").get("detect_resolution", 512)
+    lines = get_lineart_detector()(image, detect_resolution=resolution, image_resolution=resolution, output_type="np")
+    return ControlMap.from_detector(lines).resized(image.size)
+
+
+@torch.no_grad()
+def extract_lineart_batch(images: list[Image.Image]) -> list[ControlMap]:
+    """
+    ``extract_lineart`` for same-size images in one forward pass of the line-art network.
+
+    Mirrors ``LineartDetector.__call__``, which only takes one image.
+    """
+    detector = get_lineart_detector()
+    resolution = get_preprocessor_config("lineart").get("detect_resolution", 512)
+    device = next(iter(detector.model.parameters())).device
+
+    batch = np.stack([resize_image(HWC3(np.asarray(image.convert("RGB"))), resolution) for image in images])
+    lines = detector.model(torch.from_numpy(batch).float().to(device).permute(0, 3, 1, 2) / 255.0)
+    lines = (lines[:, 0].cpu().numpy() * 255.0).clip(0, 255).astype(np.uint8)
+
+    return [ControlMap(255 - line).resized(image.size) for line, image in zip(lines, images)]
@@ -1,21 +1,25 @@
 import logging
+from collections import OrderedDict
 from typing import Callable
 
 import torch
 from diffusers import ControlNetModel
 from PIL import Image
 
+from ..artifacts import resolve_pretrained
 from ..config import load_model_config
-from .canny import extract_canny_edges
-from .depth import extract_depth
-from .lineart import extract_lineart
-from .openpose import extract_openpose
-from .softedge import extract_softedge
+from .canny import extract_canny_edges, extract_canny_edges_batch
+from .control_map import ControlMap
+from .depth import extract_depth, extract_depth_batch, get_depth_estimator
+from .lineart import extract_lineart, extract_lineart_batch, get_lineart_detector
+from .openpose import extract_openpose, get_openpose_detector
+from .registry import CONTROLNET_DESCRIPTIONS, get_controlnet_models, get_default_controlnet_types
+from .softedge import extract_softedge, extract_softedge_batch, get_hed_detector
 
 logger = logging.getLogger(__name__)
-_CONTROLNETS: list[ControlNetModel] = []
+_CONTROLNETS: OrderedDict[str, ControlNetModel] = OrderedDict()
 
-CONTROLNET_PREPROCESSORS: dict[str, Callable[[Image.Image], Image.Image]] = {
+CONTROLNET_PREPROCESSORS: dict[str, Callable[[Image.Image], ControlMap]] = {
     "canny": extract_canny_edges,
     "softedge": extract_softedge,
     "lineart": extract_lineart,
@@ -23,55 +27,87 @@ CONTROLNET_PREPROCESSORS: dict[str, Callable[[Image.Image], Image.Image]] = {
     "openpose": extract_openpose,
 }
 
-DEFAULT_CONTROLNET_MODELS: dict[str, str] = {
-    "canny": "lllyasviel/control_v11p_sd15_canny",
-    "softedge": "lllyasviel/control_v11p_sd15_softedge",
-    "lineart": "lllyasviel/control_v11p_sd15_lineart",
-    "depth": "lllyasviel/control_v11f1p_sd15_depth",
-    "openpose": "lllyasviel/control_v11p_sd15_openpose",
+# Preprocessors taking a list of same-size images; other types run image by image.
+BATCH_PREPROCESSORS: dict[str, Callable[[list[Image.Image]], list[ControlMap]]] = {
+    "canny": extract_canny_edges_batch,
+    "softedge": extract_softedge_batch,
+    "lineart": extract_lineart_batch,
+    "depth": extract_depth_batch,
 }
 
-CONTROLNET_DESCRIPTIONS: dict[str, str] = {
-    "canny": "Canny Edge Detection",
-    "softedge": "Soft Edge Detection (HED)",
-    "lineart": "Line Art Extraction",
-    "depth": "Depth Map Estimation",
-    "openpose": "Pose Detection (OpenPose)",
+PREPROCESSOR_LOADERS: dict[str, Callable[[], object]] = {
+    "softedge": get_hed_detector,
+    "lineart": get_lineart_detector,
+    "depth": get_depth_estimator,
+    "openpose": get_openpose_detector,
 }
 
-def get_controlnet_models() -> dict[str, str]:
-    model_config = load_model_config()
-    controlnet_config = model_config.get("controlnet", {})
-    config_models = controlnet_config.get("models", {})
-    return {**DEFAULT_CONTROLNET_MODELS, **config_models}
-
 
-def get_preprocessor(controlnet_type: str) -> Callable[[Image.Image], Image.Image] | None:
+def get_preprocessor(controlnet_type: str) -> Callable[[Image.Image], ControlMap] | None:
     return CONTROLNET_PREPROCESSORS.get(controlnet_type)
 
 
-def try_load_controlnets(dtype: torch.dtype) -> list[ControlNetModel]:
-    global _CONTROLNETS
+def load_preprocessors(controlnet_types: list[str]) -> list[object]:
+    """Eagerly load the annotator models behind the given preprocessors."""
+    detectors = []
+
+    for cn_type in controlnet_types:
+        loader = PREPROCESSOR_LOADERS.get(cn_type)
+        if loader is None:
+            continue
+
+        try:
+            detectors.append(loader())
+        except Exception as exc:
+            logger.warning("Preprocessor '%s' load failed: %s", cn_type, exc)
+
+    return detectors
+
+
+def _model_size_mb(model: torch.nn.Module) -> float:
+    return sum(p.numel() * p.element_size() for p in model.parameters()) / 2**20
 
-    if _CONTROLNETS:
-        return _CONTROLNETS
 
+def _evict_over_budget(keep: set[str]) -> None:
     model_config = load_model_config()
-    controlnet_config = model_config.get("controlnet", {})
+    budget_mb = model_config.get("controlnet", {}).get("memory_budget_mb")
+    if budget_mb is None:
+        return
+
+    resident_mb = sum(_model_size_mb(model) for model in _CONTROLNETS.values())
+    for cn_type in list(_CONTROLNETS):
+        if resident_mb <= budget_mb:
+            break
+        if cn_type in keep:
+            continue
 
-    if not controlnet_config.get("enabled", False):
-        logger.debug("ControlNet is not enabled in configuration.")
-        return []
+        evicted = _CONTROLNETS.pop(cn_type)
+        resident_mb -= _model_size_mb(evicted)
+        logger.info("Evicted ControlNet '%s' (%.0f MB resident, budget %s MB).", cn_type, resident_mb, budget_mb)
+
+    if resident_mb > budget_mb:
+        logger.warning(
+            "ControlNets in use need %.0f MB, above the %s MB budget.", resident_mb, budget_mb
+        )
 
-    controlnet_types = controlnet_config.get("types", [])
-    if not controlnet_types:
-        logger.debug("No ControlNet types specified.")
-        return []
 
+def load_controlnets(controlnet_types: list[str], dtype: torch.dtype) -> dict[str, ControlNetModel]:
+    """
+    Return the requested ControlNets, loading missing ones on first use.
+
+    Loaded models are kept in an LRU; the least recently used ones not needed by
+    this call are evicted once ``controlnet.memory_budget_mb`` is exceeded.
+    Types that fail to load are left out of the result.
+    """
     controlnet_models = get_controlnet_models()
-    loaded_controlnets = []
+    selected: dict[str, ControlNetModel] = {}
 
     for cn_type in controlnet_types:
+        if cn_type in _CONTROLNETS:
+            _CONTROLNETS.move_to_end(cn_type)
+            selected[cn_type] = _CONTROLNETS[cn_type]
+            continue
+
         model_id = controlnet_models.get(cn_type)
         if not model_id:
             logger.warning("Unknown ControlNet type: %s", cn_type)
@@ -79,25 +115,41 @@ def try_load_controlnets(dtype: torch.dtype) -> list[ControlNetModel]:
 
         try:
             logger.info("Loading ControlNet '%s' from %s...", cn_type, model_id)
-            controlnet = ControlNetModel.from_pretrained(model_id, torch_dtype=dtype)
-            loaded_controlnets.append(controlnet)
+            controlnet = ControlNetModel.from_pretrained(resolve_pretrained(model_id), torch_dtype=dtype)
+            _CONTROLNETS[cn_type] = controlnet
+            selected[cn_type] = controlnet
             logger.info("ControlNet '%s' loaded successfully.", cn_type)
             logger.debug("ControlNet '%s' details: %s", cn_type, controlnet)
         except Exception as cn_exc:
             logger.warning("ControlNet '%s' load failed: %s", cn_type, cn_exc)
 
-    _CONTROLNETS = loaded_controlnets
-    return _CONTROLNETS
+    _evict_over_budget(keep=set(selected))
+    return selected
+
+
+def try_load_controlnets(dtype: torch.dtype) -> list[ControlNetModel]:
+    """Load the default ControlNets ahead of the first request."""
+    controlnet_types = get_default_controlnet_types()
+    if not controlnet_types:
+        logger.debug("ControlNet is not enabled or no types are specified.")
+        return []
+
+    return list(load_controlnets(controlnet_types, dtype).values())
+
+
+def get_controlnets() -> dict[str, ControlNetModel]:
+    """Return the currently resident ControlNets, least recently used first."""
+    return dict(_CONTROLNETS)
 
 
-def get_controlnets() -> list[ControlNetModel]:
-    return _CONTROLNETS
+def unload_controlnets() -> None:
+    _CONTROLNETS.clear()
 
 
 def process_control_images(
     image: Image.Image,
     controlnet_types: list[str],
-) -> list[tuple[Image.Image, str]]:
+) -> list[tuple[ControlMap, str]]:
     control_images = []
 
     for cn_type in controlnet_types:
@@ -115,3 +167,43 @@ def process_control_images(
             logger.warning("Failed to process control image for '%s': %s", cn_type, e)
 
     return control_images
+
+
+def process_control_images_batch(
+    images: list[Image.Image],
+    controlnet_types: list[str],
+) -> tuple[list[list[tuple[ControlMap, str]]], list[str]]:
+    """
+    Compute the control maps of several images, one preprocessor call per type.
+
+    Returns the maps per image, in the order of the types that succeeded, and
+    those types. A type whose preprocessor fails for the batch is dropped for
+    every image, so all images keep the same ControlNets.
+    """
+    control_images: list[list[tuple[ControlMap, str]]] = [[] for _ in images]
+    processed_types: list[str] = []
+    same_size = len({image.size for image in images}) == 1
+
+    for cn_type in controlnet_types:
+        preprocessor = get_preprocessor(cn_type)
+        if preprocessor is None:
+            logger.warning("No preprocessor found for ControlNet type: %s", cn_type)
+            continue
+
+        batch_preprocessor = BATCH_PREPROCESSORS.get(cn_type)
+        try:
+            if batch_preprocessor is not None and same_size and len(images) > 1:
+                maps = batch_preprocessor(images)
+            else:
+                maps = [preprocessor(image) for image in images]
+        except Exception as e:
+            logger.warning("Failed to process control images for '%s': %s", cn_type, e)
+            continue
+
+        description = CONTROLNET_DESCRIPTIONS.get(cn_type, cn_type)
+        for sample_controls, control_image in zip(control_images, maps):
+            sample_controls.append((control_image, description))
+        processed_types.append(cn_type)
+        logger.debug("Processed %d control image(s) for '%s'", len(images), cn_type)
+
+    return control_images, processed_types
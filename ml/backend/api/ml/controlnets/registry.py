@@ -0,0 +1,56 @@
+"""ControlNet types and their configuration, without loading any models."""
+
+from ..config import load_model_config
+
+DEFAULT_CONTROLNET_MODELS: dict[str, str] = {
+    "canny": "lllyasviel/control_v11p_sd15_canny",
+    "softedge": "lllyasviel/control_v11p_sd15_softedge",
+    "lineart": "lllyasviel/control_v11p_sd15_lineart",
+    "depth": "lllyasviel/control_v11f1p_sd15_depth",
+    "openpose": "lllyasviel/control_v11p_sd15_openpose",
+}
+
+CONTROLNET_DESCRIPTIONS: dict[str, str] = {
+    "canny": "Canny Edge Detection",
+    "softedge": "Soft Edge Detection (HED)",
+    "lineart": "Line Art Extraction",
+    "depth": "Depth Map Estimation",
+    "openpose": "Pose Detection (OpenPose)",
+}
+
+
+def get_controlnet_models() -> dict[str, str]:
+    model_config = load_model_config()
+    controlnet_config = model_config.get("controlnet", {})
+    config_models = controlnet_config.get("models", {})
+    return {**DEFAULT_CONTROLNET_MODELS, **config_models}
+
+
+def get_default_controlnet_types() -> list[str]:
+    """ControlNet types used when a request does not select its own."""
+    model_config = load_model_config()
+    controlnet_config = model_config.get("controlnet", {})
+
+    if not controlnet_config.get("enabled", False):
+        return []
+
+    return list(controlnet_config.get("types", {}).keys())
+
+
+def get_controlnet_scale(controlnet_type: str) -> float:
+    model_config = load_model_config()
+    types_config = model_config.get("controlnet", {}).get("types", {})
+    return types_config.get(controlnet_type, {}).get("scale", 0.5)
+
+
+def get_controlnet_window(controlnet_type: str) -> tuple[float, float]:
+    """Fraction of the denoising steps, ``(start, end)``, during which a ControlNet applies."""
+    model_config = load_model_config()
+    type_config = model_config.get("controlnet", {}).get("types", {}).get(controlnet_type, {})
+    return type_config.get("guidance_start", 0.0), type_config.get("guidance_end", 1.0)
+
+
+def get_preprocessor_config(controlnet_type: str) -> dict:
+    """Settings of a ControlNet preprocessor, e.g. its ``detect_resolution``."""
+    model_config = load_model_config()
+    return model_config.get("controlnet", {}).get("preprocessors", {}).get(controlnet_type, {})
@@ -0,0 +1,243 @@
+"""
+Registry of generation engines and the memory-budgeted set of resident ones.
+
+Each engine declares how to load, warm up, measure, unload and run it. The
+engine functions live in their own modules and are imported on first use, so
+this registry (and the request validation that reads it) stays free of torch.
+
+Deployments pick an engine with ``engines.default`` (or ``SHREKIFY_ENGINE``);
+requests may pick another enabled one, and a generation profile naming an
+``engine`` (the ``fast`` tier's ``cartoon``) overrides both. Resident engines are kept in LRU order:
+before an engine loads, idle ones are unloaded until its estimated footprint
+fits ``engines.memory_budget_mb``, rather than running out of memory.
+"""
+
+import logging
+import os
+import threading
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from importlib import import_module
+from typing import Callable, Iterator
+
+from PIL import Image
+
+from .config import get_generation_profiles, load_generation_config, load_model_config
+from .results import GenerationResult, fallback_results
+from .status import PipelineUnavailableError
+
+logger = logging.getLogger(__name__)
+
+
+class EngineBudgetError(PipelineUnavailableError):
+    """An engine does not fit the memory budget while other engines are busy."""
+
+
+def _lazy(module: str, name: str) -> Callable:
+    """Return a function importing ``module`` (relative to ``api.ml``) only when called."""
+    def call(*args, **kwargs):
+        return getattr(import_module(module, __package__), name)(*args, **kwargs)
+
+    call.__name__ = name
+    return call
+
+
+@dataclass(frozen=True)
+class Engine:
+    name: str
+    description: str
+    # Load the models; returns ``None`` when loading fails.
+    load: Callable[[], object | None]
+    # One short generation so the first request does not pay for kernel setup.
+    warm_up: Callable[[], None]
+    # Memory held while resident, in MB; 0 when not loaded.
+    footprint_mb: Callable[[], float]
+    unload: Callable[[], None]
+    # ``generate(images, controlnet_types=, mode=, strength=, profile=, scheduler=)`` -> one result per image.
+    generate: Callable[..., list[GenerationResult]]
+    # Runs on the CPU without models, so web workers run it even with a model server.
+    cpu_only: bool = False
+
+
+ENGINES: dict[str, Engine] = {}
+
+
+def register_engine(engine: Engine) -> None:
+    ENGINES[engine.name] = engine
+
+
+register_engine(Engine(
+    name="sd15",
+    description="Stable Diffusion 1.5 with ControlNets and IP-Adapter",
+    load=_lazy(".pipeline", "load_pipeline"),
+    warm_up=_lazy(".ml_sd15", "warm_up"),
+    footprint_mb=_lazy(".pipeline", "pipeline_footprint_mb"),
+    unload=_lazy(".pipeline", "unload_pipeline"),
+    generate=_lazy(".ml_sd15", "generate_shrek_images"),
+))
+register_engine(Engine(
+    name="sd35_nf4",
+    description="Stable Diffusion 3.5 medium with an NF4 transformer",
+    load=_lazy(".ml", "load_pipeline"),
+    warm_up=_lazy(".ml", "warm_up"),
+    footprint_mb=_lazy(".ml", "footprint_mb"),
+    unload=_lazy(".ml", "unload_pipeline"),
+    generate=_lazy(".ml", "generate_shrek_images"),
+))
+register_engine(Engine(
+    name="cartoon",
+    description="CPU cartoon stylisation with an ogre-green palette (the fast tier)",
+    load=_lazy(".cartoon", "load"),
+    warm_up=_lazy(".cartoon", "warm_up"),
+    footprint_mb=_lazy(".cartoon", "footprint_mb"),
+    unload=_lazy(".cartoon", "unload"),
+    generate=_lazy(".cartoon", "generate_shrek_images"),
+    cpu_only=True,
+))
+
+# Resident engines and their footprint in MB, least recently used first.
+_RESIDENT: OrderedDict[str, float] = OrderedDict()
+_IN_USE: Counter[str] = Counter()
+_ENGINES_LOCK = threading.Lock()
+
+
+def get_engines_config() -> dict:
+    return load_model_config().get("engines", {})
+
+
+def get_engine_names() -> list[str]:
+    """Engines that are registered and enabled in ``model_config.json``."""
+    available = get_engines_config().get("available", {"sd15": {}})
+    return [name for name, cfg in available.items() if name in ENGINES and cfg.get("enabled", True)]
+
+
+def get_default_engine() -> str:
+    return os.getenv("SHREKIFY_ENGINE") or get_engines_config().get("default", "sd15")
+
+
+def resolve_engine(engine: str | None = None, profile: str | None = None) -> str:
+    """The engine a request runs on: its profile's ``engine`` if any, else ``engine``, else the default."""
+    profile = profile or load_generation_config().get("profile", "quality")
+    return get_generation_profiles().get(profile, {}).get("engine") or engine or get_default_engine()
+
+
+def get_engine(name: str | None = None) -> Engine:
+    name = name or get_default_engine()
+    if name not in get_engine_names():
+        raise ValueError(f"Unknown or disabled engine: {name}")
+    return ENGINES[name]
+
+
+def _estimate_mb(engine: Engine) -> float:
+    engine_config = get_engines_config().get("available", {}).get(engine.name, {})
+    return engine_config.get("footprint_mb", 0.0)
+
+
+def _make_room(engine: Engine) -> None:
+    """Unload idle engines, least recently used first, until ``engine`` fits. Holds ``_ENGINES_LOCK``."""
+    budget_mb = get_engines_config().get("memory_budget_mb")
+    if budget_mb is None:
+        return
+
+    needed_mb = _estimate_mb(engine)
+    for name in list(_RESIDENT):
+        if sum(_RESIDENT.values()) + needed_mb <= budget_mb:
+            return
+        if _IN_USE[name]:
+            continue
+        logger.info("Unloading idle engine %s (%.0f MB) to make room for %s", name, _RESIDENT[name], engine.name)
+        ENGINES[name].unload()
+        del _RESIDENT[name]
+
+    if sum(_RESIDENT.values()) + needed_mb > budget_mb:
+        raise EngineBudgetError(
+            f"Engine {engine.name} needs ~{needed_mb:.0f} MB; busy engines hold "
+            f"{sum(_RESIDENT.values()):.0f} MB of the {budget_mb:.0f} MB budget."
+        )
+
+
+@contextmanager
+def use_engine(name: str | None = None) -> Iterator[Engine]:
+    """
+    Reserve an engine for the duration of the block.
+
+    Makes room for it within the memory budget if it is not resident; on exit
+    its measured footprint replaces the configured estimate.
+    """
+    engine = get_engine(name)
+    with _ENGINES_LOCK:
+        if engine.name not in _RESIDENT:
+            _make_room(engine)
+            _RESIDENT[engine.name] = _estimate_mb(engine)
+        _RESIDENT.move_to_end(engine.name)
+        _IN_USE[engine.name] += 1
+
+    try:
+        yield engine
+    finally:
+        footprint_mb = engine.footprint_mb()
+        with _ENGINES_LOCK:
+            _IN_USE[engine.name] -= 1
+            if footprint_mb:
+                _RESIDENT[engine.name] = footprint_mb
+            elif not _IN_USE[engine.name]:
+                # Never loaded (or the load failed): free its reservation.
+                _RESIDENT.pop(engine.name, None)
+
+
+def mark_resident(name: str) -> None:
+    """Count an engine loaded outside ``use_engine`` (the pre-fork preload) against the budget."""
+    engine = ENGINES[name]
+    with _ENGINES_LOCK:
+        _RESIDENT[name] = engine.footprint_mb() or _estimate_mb(engine)
+        _RESIDENT.move_to_end(name)
+
+
+def load_engine(name: str | None = None) -> object | None:
+    """Load an engine (and warm it up if ``engines.warm_up``); ``None`` if loading fails."""
+    with use_engine(name) as engine:
+        loaded = engine.load()
+        if loaded is not None and get_engines_config().get("warm_up", False):
+            logger.info("Warming up engine %s...", engine.name)
+            engine.warm_up()
+    return loaded
+
+
+def unload_engines() -> None:
+    """Unload every resident engine that is not in use."""
+    with _ENGINES_LOCK:
+        for name in [name for name in _RESIDENT if not _IN_USE[name]]:
+            ENGINES[name].unload()
+            del _RESIDENT[name]
+
+
+def get_resident_engines() -> dict[str, float]:
+    """Resident engines and their footprint in MB, least recently used first."""
+    with _ENGINES_LOCK:
+        return dict(_RESIDENT)
+
+
+def generate_images(input_images: list[Image.Image], engine: str | None = None, **options) -> list[GenerationResult]:
+    """Generate with ``engine`` (see ``resolve_engine``); ``options`` are the engine's generate kwargs."""
+    with use_engine(resolve_engine(engine, options.get("profile"))) as selected:
+        return selected.generate(input_images, **options)
+
+
+def try_generate_images(
+    input_images: list[Image.Image],
+    engine: str | None = None,
+    **options,
+) -> list[GenerationResult]:
+    """Like ``generate_images``, with the fallback effect for every image on any failure."""
+    try:
+        return generate_images(input_images, engine, **options)
+    except PipelineUnavailableError as unavailable_exc:
+        logger.warning("%s Using fallback effect.", unavailable_exc)
+    except Exception as gen_exc:
+        logger.exception("Image generation failed; using fallback effect. Reason: %s", gen_exc)
+    return fallback_results(input_images)
+
+
+def try_generate_image(input_image: Image.Image, engine: str | None = None, **options) -> GenerationResult:
+    return try_generate_images([input_image], engine, **options)[0]
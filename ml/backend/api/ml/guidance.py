@@ -0,0 +1,133 @@
+"""
+Guidance schedules that drop work from late denoising steps.
+
+ControlNet windows (``control_guidance_start``/``end``) zero a ControlNet's
+scale outside its window, but diffusers still runs it. ``skip_inactive_controlnets``
+skips the ControlNets whose scale is zero at a step. ``cfg_truncation`` stops
+classifier-free guidance after a cutoff step: the UNet and ControlNets then run
+only the conditional half of the batch, and their outputs are duplicated so the
+pipeline's guidance formula reduces to the conditional prediction.
+
+Both wrap the shared modules for the calls in their block only (see
+``step_cache.layer_forward``), so concurrent requests keep their own schedules.
+"""
+
+import logging
+from contextlib import contextmanager
+from typing import Iterator
+
+import torch
+from diffusers import MultiControlNetModel
+
+from .pipeline import PipelineType
+from .step_cache import layer_forward
+
+logger = logging.getLogger(__name__)
+
+
+def _residual_count(unet) -> int:
+    """Number of down-block residuals the UNet takes from a ControlNet."""
+    return 1 + sum(len(block.resnets) + len(block.downsamplers or []) for block in unet.down_blocks)
+
+
+@contextmanager
+def skip_inactive_controlnets(pipeline: PipelineType) -> Iterator[None]:
+    """Skip ControlNets outside their guidance window instead of running them at scale 0."""
+    controlnet = getattr(pipeline, "controlnet", None)
+    # get_pipeline_variant always wraps the ControlNets in a MultiControlNetModel.
+    if not isinstance(controlnet, MultiControlNetModel):
+        yield
+        return
+
+    unet = pipeline.unet
+    # Zero residuals broadcast when the UNet adds them to its own.
+    zero = torch.zeros((), device=unet.device, dtype=unet.dtype)
+    residual_count = _residual_count(unet)
+
+    def controlnet_forward(forward):
+        def wrapped(sample, timestep, *args, controlnet_cond, conditioning_scale, **kwargs):
+            down_samples, mid_sample = [zero] * residual_count, zero
+            for net, cond, scale in zip(controlnet.nets, controlnet_cond, conditioning_scale):
+                if scale == 0:
+                    continue
+                # Summed like MultiControlNetModel.forward does.
+                net_down, net_mid = net(sample, timestep, *args, controlnet_cond=cond, conditioning_scale=scale, **kwargs)
+                down_samples = [total + down for total, down in zip(down_samples, net_down)]
+                mid_sample = mid_sample + net_mid
+            return down_samples, mid_sample
+        return wrapped
+
+    restore = []
+    layer_forward(controlnet, controlnet_forward, restore)
+    try:
+        yield
+    finally:
+        for undo in reversed(restore):
+            undo()
+
+
+def _conditional_half(value, batch: int):
+    """Keep the second (conditional) half of every tensor batched at ``batch``."""
+    if isinstance(value, torch.Tensor):
+        return value[batch // 2:] if value.ndim and value.shape[0] == batch else value
+    if isinstance(value, (list, tuple)):
+        return type(value)(_conditional_half(item, batch) for item in value)
+    if isinstance(value, dict):
+        return {key: _conditional_half(item, batch) for key, item in value.items()}
+    return value
+
+
+def _duplicate(value):
+    """Stand the conditional output in for the unconditional half as well."""
+    if isinstance(value, torch.Tensor):
+        return torch.cat([value, value]) if value.ndim else value
+    if isinstance(value, (list, tuple)):
+        return type(value)(_duplicate(item) for item in value)
+    if hasattr(value, "sample"):
+        value.sample = _duplicate(value.sample)
+    return value
+
+
+@contextmanager
+def cfg_truncation(pipeline: PipelineType, cutoff_step: int | None) -> Iterator[None]:
+    """
+    Run only the conditional branch from denoising step ``cutoff_step`` on.
+
+    ``None`` leaves guidance on for every step. Call it only when the pipeline
+    does classifier-free guidance, so UNet batches hold negatives then positives.
+    """
+    if cutoff_step is None:
+        yield
+        return
+
+    step = 0
+
+    def truncated(forward, counts_steps: bool):
+        def wrapped(sample, *args, **kwargs):
+            nonlocal step
+            try:
+                if step < cutoff_step:
+                    return forward(sample, *args, **kwargs)
+                batch = sample.shape[0]
+                return _duplicate(forward(
+                    _conditional_half(sample, batch),
+                    *_conditional_half(args, batch),
+                    **_conditional_half(kwargs, batch),
+                ))
+            finally:
+                # The ControlNets run before the UNet of the same step.
+                if counts_steps:
+                    step += 1
+        return wrapped
+
+    restore = []
+    layer_forward(pipeline.unet, lambda forward: truncated(forward, counts_steps=True), restore)
+    controlnet = getattr(pipeline, "controlnet", None)
+    if controlnet is not None:
+        layer_forward(controlnet, lambda forward: truncated(forward, counts_steps=False), restore)
+    try:
+        yield
+    finally:
+        for undo in reversed(restore):
+            undo()
+        logger.debug("CFG truncated after step %d of %d", cutoff_step, step)
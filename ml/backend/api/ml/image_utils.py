@@ -1,10 +1,29 @@
 """Image utility functions."""
 
 import logging
-from PIL import Image, ImageEnhance, ImageFilter
+from typing import BinaryIO
+
+from PIL import ExifTags, Image
 
 logger = logging.getLogger(__name__)
 
+# Transpose operations undoing each EXIF orientation, see ImageOps.exif_transpose.
+EXIF_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+# Modes ``Image.reduce`` supports; palette, bilevel and 16-bit images are converted first.
+REDUCE_MODES = ("L", "LA", "RGB", "RGBA", "I", "F")
+
+
+class ImageTooLargeError(ValueError):
+    """Raised when an upload exceeds the configured pixel limit."""
+
 
 def load_style_image(string_path: str) -> Image.Image | None:
     """Load a style image from the given path."""
@@ -17,9 +36,59 @@ def load_style_image(string_path: str) -> Image.Image | None:
         return None
 
 
+def decode_image(
+    source: str | BinaryIO,
+    target_size: tuple[int, int],
+    max_pixels: int | None = None,
+) -> Image.Image:
+    """
+    Decode an image at roughly ``target_size`` instead of its full resolution.
+
+    JPEGs are decoded with DCT scaling (``draft``) and other formats are shrunk
+    with ``reduce`` before any colour conversion, so a 48 MP phone photo never
+    materialises as a full-size RGB copy. The result is upright according to its
+    EXIF orientation and at least ``target_size`` on both axes where the source
+    allows it; the caller does the final resize.
+    """
+    image = Image.open(source)
+
+    width, height = image.size
+    if max_pixels is not None and width * height > max_pixels:
+        raise ImageTooLargeError(
+            f"Image is {width}x{height} ({width * height} pixels), the limit is {max_pixels} pixels."
+        )
+
+    orientation = image.getexif().get(ExifTags.Base.Orientation, 1)
+    target_width, target_height = target_size
+    if orientation in (5, 6, 7, 8):
+        # Stored sideways: compare against the target in storage orientation.
+        target_width, target_height = target_height, target_width
+
+    if image.format == "JPEG":
+        image.draft("RGB", (target_width, target_height))
+
+    factor = min(image.width // target_width, image.height // target_height)
+    if factor >= 2:
+        if image.mode not in REDUCE_MODES:
+            image = image.convert("RGB")
+        image = image.reduce(factor)
+
+    if orientation in EXIF_TRANSPOSE:
+        image = image.transpose(EXIF_TRANSPOSE[orientation])
+
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+
+    return image
+
+
 def fallback_effect(image: Image.Image) -> Image.Image:
-    """Lightweight image filter used when the diffusion model is unavailable."""
-    saturated = ImageEnhance.Color(image).enhance(1.4)
-    blurred_bg = saturated.filter(ImageFilter.GaussianBlur(radius=1.2))
-    overlay = Image.blend(saturated, blurred_bg, alpha=0.25)
-    return overlay
+    """CPU cartoon stylisation used when the diffusion model is unavailable."""
+    return fallback_effects([image])[0]
+
+
+def fallback_effects(images: list[Image.Image]) -> list[Image.Image]:
+    """``fallback_effect`` for a batch; OpenCV is imported on first use."""
+    from .cartoon import cartoonify_batch
+
+    return cartoonify_batch(images)
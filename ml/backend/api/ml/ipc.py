@@ -0,0 +1,153 @@
+"""Local IPC between Django workers and the dedicated model-server process."""
+
+import logging
+import os
+import time
+from dataclasses import dataclass
+from multiprocessing import resource_tracker
+from multiprocessing.connection import Client, Connection
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+from PIL import Image
+
+from .config import load_model_config
+from .status import AdmissionRejected
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SOCKET_PATH = "/tmp/shrekify-model-server.sock"
+
+
+@dataclass
+class SharedImage:
+    """Reference to an RGB (or, with one channel, grayscale) image stored in a named shared-memory block."""
+
+    name: str
+    width: int
+    height: int
+    channels: int = 3
+
+
+def get_model_server_config() -> dict:
+    model_config = load_model_config()
+    server_config = dict(model_config.get("model_server", {}))
+    if os.getenv("SHREKIFY_MODEL_SERVER_SOCKET"):
+        server_config["enabled"] = True
+        server_config["socket_path"] = os.getenv("SHREKIFY_MODEL_SERVER_SOCKET")
+    return server_config
+
+
+def model_server_enabled() -> bool:
+    return bool(get_model_server_config().get("enabled", False))
+
+
+def get_authkey() -> bytes | None:
+    authkey = os.getenv("SHREKIFY_MODEL_SERVER_AUTHKEY")
+    return authkey.encode("utf-8") if authkey else None
+
+
+def put_image(image: Image.Image, track: bool = True) -> tuple[SharedMemory, SharedImage]:
+    """
+    Copy an image into a new shared-memory block.
+
+    With ``track=False`` the creating process gives up ownership, leaving the
+    receiving process responsible for unlinking the block.
+    """
+    pixels = np.asarray(image if image.mode == "L" else image.convert("RGB"))
+    shm = SharedMemory(create=True, size=pixels.nbytes)
+    np.ndarray(pixels.shape, dtype=np.uint8, buffer=shm.buf)[:] = pixels
+
+    if not track:
+        resource_tracker.unregister(shm._name, "shared_memory")
+
+    channels = 1 if pixels.ndim == 2 else 3
+    return shm, SharedImage(name=shm.name, width=image.width, height=image.height, channels=channels)
+
+
+def take_image(ref: SharedImage, unlink: bool = False) -> Image.Image:
+    """Copy an image out of shared memory, optionally freeing the block."""
+    shm = SharedMemory(name=ref.name)
+    try:
+        shape = (ref.height, ref.width) if ref.channels == 1 else (ref.height, ref.width, 3)
+        pixels = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+        image = Image.fromarray(pixels.copy())
+    finally:
+        shm.close()
+        if unlink:
+            shm.unlink()
+    return image
+
+
+def connect(socket_path: str, timeout_s: float) -> Connection:
+    """
+    Connect to the model server, retrying while it is (re)starting.
+
+    Jobs are never lost across a server restart: a client that cannot connect
+    keeps retrying until ``timeout_s`` expires.
+    """
+    deadline = time.monotonic() + timeout_s
+    delay = 0.1
+
+    while True:
+        try:
+            return Client(socket_path, family="AF_UNIX", authkey=get_authkey())
+        except (FileNotFoundError, ConnectionRefusedError) as exc:
+            if time.monotonic() + delay > deadline:
+                raise ConnectionError(f"Model server at {socket_path} is unavailable: {exc}") from exc
+            logger.debug("Model server not reachable, retrying in %.1fs", delay)
+            time.sleep(delay)
+            delay = min(delay * 2, 2.0)
+
+
+def remote_status() -> dict:
+    """Return the model server's pipeline status and queue length."""
+    server_config = get_model_server_config()
+    socket_path = server_config.get("socket_path", DEFAULT_SOCKET_PATH)
+
+    with connect(socket_path, timeout_s=1.0) as conn:
+        conn.send({"op": "status"})
+        response = conn.recv()
+
+    return {**response.get("status", {}), "queued": response.get("queued", 0)}
+
+
+def remote_generate(image: Image.Image, key: str | None = None, priority: str | None = None, **options):
+    """
+    Run a generation on the model server.
+
+    Returns the ``GenerationResult`` and the job's admission timing (``None``
+    when the server does no admission control); raises ``AdmissionRejected``
+    when the server turns the ``priority`` job away. Jobs sent with the same
+    ``key`` while one of them is queued or running share its result,
+    whichever worker sent them.
+    """
+    from .results import GenerationResult
+
+    server_config = get_model_server_config()
+    socket_path = server_config.get("socket_path", DEFAULT_SOCKET_PATH)
+    timeout_s = server_config.get("connect_timeout_s", 60)
+
+    shm, ref = put_image(image)
+    try:
+        with connect(socket_path, timeout_s) as conn:
+            conn.send({"op": "generate", "image": ref, "options": options, "key": key, "priority": priority})
+            response = conn.recv()
+    finally:
+        shm.close()
+        shm.unlink()
+
+    if response.get("rejected"):
+        raise AdmissionRejected(response["error"])
+    if not response.get("ok"):
+        raise RuntimeError(f"Model server error: {response.get('error')}")
+
+    result = GenerationResult(
+        image=take_image(response["image"], unlink=True),
+        used_fallback=response["used_fallback"],
+        control_images=[
+            (take_image(ref, unlink=True), description)
+            for ref, description in response["control_images"]
+        ],
+    )
+    return result, response.get("timing")
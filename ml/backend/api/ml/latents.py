@@ -0,0 +1,67 @@
+"""VAE encoding of input photos for img2img, with an LRU of recent latents."""
+
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+import torch
+from PIL import Image
+
+from .config import load_generation_config
+from .pipeline import PipelineType
+
+logger = logging.getLogger(__name__)
+
+# Scaled VAE latents on the CPU, keyed by image content and VAE dtype.
+_LATENTS: OrderedDict[str, torch.Tensor] = OrderedDict()
+_LATENTS_LOCK = threading.Lock()
+
+
+def _latent_key(image: Image.Image, dtype: torch.dtype) -> str:
+    digest = hashlib.sha256(image.tobytes())
+    digest.update(f"{image.mode}:{image.size}:{dtype}".encode())
+    return digest.hexdigest()
+
+
+@torch.no_grad()
+def encode_init_latents(pipeline: PipelineType, images: list[Image.Image]) -> torch.Tensor:
+    """
+    Return scaled VAE latents ``(batch, 4, h/8, w/8)`` for img2img.
+
+    The img2img pipelines take 4-channel tensors as already encoded latents, so
+    the photo is encoded once and repeated requests for the same input (retries,
+    other strengths, other ControlNets) skip the VAE encoder. The latent
+    distribution's mode is used rather than a sample, so a cached latent is
+    exactly what a fresh encode would give.
+    """
+    vae = pipeline.vae
+    device = pipeline._execution_device
+    cache_size = load_generation_config().get("img2img", {}).get("latent_cache_size", 32)
+
+    keys = [_latent_key(image, vae.dtype) for image in images]
+    with _LATENTS_LOCK:
+        cached = {key: _LATENTS[key] for key in keys if key in _LATENTS}
+        for key in cached:
+            _LATENTS.move_to_end(key)
+
+    missing = [(key, image) for key, image in zip(keys, images) if key not in cached]
+    if missing:
+        pixels = pipeline.image_processor.preprocess([image for _, image in missing])
+        encoded = vae.encode(pixels.to(device=device, dtype=vae.dtype)).latent_dist.mode()
+        encoded = (encoded * vae.config.scaling_factor).cpu()
+
+        with _LATENTS_LOCK:
+            for (key, _), latent in zip(missing, encoded):
+                cached[key] = latent
+                _LATENTS[key] = latent
+            while len(_LATENTS) > cache_size:
+                _LATENTS.popitem(last=False)
+
+    logger.debug("Init latents: %d cached, %d encoded", len(images) - len(missing), len(missing))
+    return torch.stack([cached[key] for key in keys]).to(device=device, dtype=vae.dtype)
+
+
+def clear_latent_cache() -> None:
+    with _LATENTS_LOCK:
+        _LATENTS.clear()
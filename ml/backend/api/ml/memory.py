@@ -0,0 +1,151 @@
+"""Sharing read-only model weights between forked worker processes."""
+
+import gc
+import logging
+import os
+from pathlib import Path
+
+from .config import load_model_config
+
+logger = logging.getLogger(__name__)
+
+SMAPS_FIELDS = ("Rss", "Pss", "Shared_Clean", "Shared_Dirty", "Private_Clean", "Private_Dirty")
+
+
+def iter_torch_modules(obj: object, depth: int = 2):
+    """Yield the torch modules held by a pipeline, detector or plain object."""
+    import torch
+
+    if isinstance(obj, torch.nn.Module):
+        yield obj
+        return
+
+    if depth <= 0:
+        return
+
+    if isinstance(obj, (list, tuple)):
+        children = obj
+    elif hasattr(obj, "components"):
+        children = obj.components.values()
+    elif hasattr(obj, "__dict__"):
+        children = vars(obj).values()
+    else:
+        return
+
+    for child in children:
+        yield from iter_torch_modules(child, depth - 1)
+
+
+def share_weights(obj: object) -> int:
+    """
+    Move the CPU tensors of every module under ``obj`` into shared memory.
+
+    Forked children then map the same physical pages instead of copying them on
+    first touch. Returns the number of bytes now backed by shared memory.
+    """
+    shared_bytes = 0
+
+    for module in iter_torch_modules(obj):
+        for tensor in [*module.parameters(), *module.buffers()]:
+            if tensor.device.type != "cpu":
+                continue
+            if not tensor.is_shared():
+                tensor.share_memory_()
+            shared_bytes += tensor.numel() * tensor.element_size()
+
+    return shared_bytes
+
+
+def module_footprint_mb(obj: object) -> float:
+    """Size of the parameters and buffers of every module under ``obj``, counting shared ones once."""
+    seen = set()
+    total_bytes = 0
+
+    for module in iter_torch_modules(obj):
+        for tensor in [*module.parameters(), *module.buffers()]:
+            if id(tensor) in seen:
+                continue
+            seen.add(id(tensor))
+            total_bytes += tensor.numel() * tensor.element_size()
+
+    return total_bytes / 2**20
+
+
+def prepare_for_fork() -> None:
+    """
+    Load the models once in the parent process before workers are forked.
+
+    Only takes effect for weights that stay on the CPU in the workers (annotators,
+    CPU inference); ``enable_cpu_offload`` re-materialises the pipeline weights on
+    every move and will not keep them shared.
+    """
+    from .controlnets import get_default_controlnet_types, load_preprocessors, try_load_controlnets
+    from .engines import mark_resident
+    from .pipeline import preload_pipeline, select_device
+
+    model_config = load_model_config()
+    memory_config = model_config.get("memory", {})
+
+    if not memory_config.get("preload_before_fork", False):
+        logger.debug("Pre-fork model loading is disabled.")
+        return
+
+    if model_config.get("enable_cpu_offload", False):
+        logger.warning(
+            "enable_cpu_offload copies the pipeline weights to the GPU and back in every worker, "
+            "so only the annotators stay shared; disable it to share the pipeline too."
+        )
+
+    controlnet_types = get_default_controlnet_types()
+    _, dtype = select_device()
+    pipeline = preload_pipeline()
+    if pipeline is not None:
+        # Workers inherit the preloaded sd15, so other engines must make room for it.
+        mark_resident("sd15")
+    loaded = [pipeline, try_load_controlnets(dtype), *load_preprocessors(controlnet_types)]
+    loaded = [obj for obj in loaded if obj is not None]
+
+    if memory_config.get("share_weights", True):
+        shared_bytes = sum(share_weights(obj) for obj in loaded)
+        logger.info("Moved %.1f MB of model weights to shared memory.", shared_bytes / 2**20)
+
+    # Keep the cyclic GC from writing to (and thereby un-sharing) every object
+    # allocated so far.
+    gc.collect()
+    gc.freeze()
+
+
+def process_memory(pid: int | str = "self") -> dict[str, int]:
+    """Return RSS broken down into shared and private pages, in kB."""
+    smaps = Path("/proc") / str(pid) / "smaps_rollup"
+    values = dict.fromkeys(SMAPS_FIELDS, 0)
+
+    with open(smaps, "r", encoding="utf-8") as f:
+        for line in f:
+            key, _, rest = line.partition(":")
+            if key in values:
+                values[key] = int(rest.split()[0])
+
+    return {
+        "rss_kb": values["Rss"],
+        "pss_kb": values["Pss"],
+        "shared_kb": values["Shared_Clean"] + values["Shared_Dirty"],
+        "unique_kb": values["Private_Clean"] + values["Private_Dirty"],
+    }
+
+
+def find_processes(pattern: str) -> list[int]:
+    """Return the pids whose command line contains ``pattern``."""
+    pids = []
+
+    for entry in Path("/proc").iterdir():
+        if not entry.name.isdigit() or int(entry.name) == os.getpid():
+            continue
+        try:
+            cmdline = (entry / "cmdline").read_bytes().replace(b"\0", b" ").decode()
+        except OSError:
+            continue
+        if pattern in cmdline:
+            pids.append(int(entry.name))
+
+    return sorted(pids)
@@ -0,0 +1,305 @@
+"""
+Memory-budgeted configuration of the pipeline's memory features.
+
+With ``memory.auto_plan.enabled``, ``place_pipeline`` no longer follows
+``enable_cpu_offload``. It counts the loaded weights, estimates the peak memory
+of one generation at the configured resolution and batch size, and picks the
+cheapest plan whose estimate fits the budget. Plans are tried from fastest to
+most frugal: each dtype in ``dtypes`` with VAE slicing, then VAE tiling, then
+attention slicing, and finally model and sequential CPU offload.
+
+The estimate is a coarse model of an SD1.5 UNet (weights plus the largest
+activations of the denoising and decoding passes). It is logged with the plan
+so it can be checked against measured peaks with ``manage.py plan_memory``.
+"""
+
+import logging
+import os
+from dataclasses import dataclass, replace
+
+from .config import base_size, load_generation_config, load_model_config
+
+logger = logging.getLogger(__name__)
+
+MB = 2**20
+DTYPE_BYTES = {"float32": 4, "float16": 2, "bfloat16": 2}
+OFFLOAD_LEVELS = ("none", "model", "sequential")
+
+# Constants of the activation estimate, for SD1.5.
+UNET_CHANNELS = 320
+UNET_ATTENTION_HEADS = 8
+# Full-resolution UNet tensors alive at once, skip connections included.
+UNET_LIVE_TENSORS = 12
+VAE_DECODER_CHANNELS = 128
+VAE_LIVE_TENSORS = 3
+# Tile size (pixels) of the SD1.5 VAE's tiled decoding.
+VAE_TILE_SIZE = 512
+# A ControlNet holds about 361M parameters to the UNet's 860M.
+CONTROLNET_UNET_RATIO = 0.42
+# Share of the UNet weights on the device at once under sequential offload.
+SEQUENTIAL_RESIDENT_RATIO = 0.05
+
+_PLAN: "MemoryPlan | None" = None
+
+
+@dataclass(frozen=True)
+class MemoryPlan:
+    dtype: str = "float32"
+    vae_slicing: bool = False
+    vae_tiling: bool = False
+    # None, "auto" (half the heads per slice) or "max" (one head at a time).
+    attention_slicing: str | None = None
+    offload: str = "none"
+    estimated_peak_mb: float = 0.0
+    budget_mb: float | None = None
+
+    @property
+    def fits(self) -> bool:
+        return self.budget_mb is None or self.estimated_peak_mb <= self.budget_mb
+
+    def describe(self) -> str:
+        features = [self.dtype]
+        if self.vae_slicing:
+            features.append("VAE slicing")
+        if self.vae_tiling:
+            features.append("VAE tiling")
+        if self.attention_slicing:
+            features.append(f"attention slicing ({self.attention_slicing})")
+        if self.offload != "none":
+            features.append(f"{self.offload} CPU offload")
+        return ", ".join(features)
+
+
+def get_auto_plan_config() -> dict:
+    return load_model_config().get("memory", {}).get("auto_plan", {})
+
+
+def auto_plan_enabled() -> bool:
+    return bool(get_auto_plan_config().get("enabled", False))
+
+
+def current_memory_plan() -> MemoryPlan | None:
+    """The plan applied to the loaded pipeline, or ``None`` when planning is off."""
+    return _PLAN
+
+
+def reset_memory_plan() -> None:
+    global _PLAN
+    _PLAN = None
+
+
+def get_budget_mb(device: str) -> float | None:
+    """
+    Memory available to one job, in MB; ``None`` means unconstrained.
+
+    ``SHREKIFY_MEMORY_BUDGET_MB`` overrides ``budget_mb``. Without either, CUDA
+    devices use their total memory times ``headroom``. The budget is split
+    between ``jobs_per_device`` concurrent jobs.
+    """
+    plan_config = get_auto_plan_config()
+    budget_mb = os.getenv("SHREKIFY_MEMORY_BUDGET_MB") or plan_config.get("budget_mb")
+    if budget_mb is None and device == "cuda":
+        import torch
+
+        _, total_bytes = torch.cuda.mem_get_info()
+        budget_mb = total_bytes / MB * plan_config.get("headroom", 0.9)
+    if budget_mb is None:
+        return None
+    return float(budget_mb) / plan_config.get("jobs_per_device", 1)
+
+
+def get_plan_dtypes(device: str) -> list[str]:
+    """Dtypes to try, preferred first; half precision is the default only on CUDA."""
+    default = ["float16"] if device == "cuda" else ["float32"]
+    return get_auto_plan_config().get("dtypes") or default
+
+
+def plan_resolution() -> tuple[int, int]:
+    """``(width, height)`` of the diffusion pass."""
+    gen_config = load_generation_config()
+    return base_size(gen_config.get("width", 768), gen_config.get("height", 768))
+
+
+def plan_overhead_mb(device: str) -> float:
+    """Memory outside the model (CUDA context, allocator slack), in MB."""
+    return get_auto_plan_config().get("overhead_mb", 300 if device == "cuda" else 0)
+
+
+def plan_batch_size() -> int:
+    """Images per pipeline call: the model server's batch size when it batches requests."""
+    batch_size = get_auto_plan_config().get("batch_size")
+    if batch_size:
+        return batch_size
+    server_config = load_model_config().get("model_server", {})
+    return server_config.get("max_batch_size", 1) if server_config.get("enabled", False) else 1
+
+
+def estimate_peak_mb(
+    plan: MemoryPlan,
+    component_elements: dict[str, int],
+    width: int,
+    height: int,
+    batch_size: int,
+    efficient_attention: bool,
+    overhead_mb: float = 0.0,
+) -> float:
+    """
+    Estimated peak device memory of one generation under ``plan``, in MB.
+
+    ``component_elements`` maps pipeline components (``unet``, ``vae``,
+    ``controlnet``...) to their number of parameter and buffer elements.
+    """
+    dtype_bytes = DTYPE_BYTES[plan.dtype]
+    weights = {name: elements * dtype_bytes / MB for name, elements in component_elements.items()}
+    # The ControlNets run alongside the UNet at every step.
+    denoiser_mb = weights.get("unet", 0.0) + weights.get("controlnet", 0.0)
+    if plan.offload == "none":
+        weights_mb = sum(weights.values())
+    elif plan.offload == "model":
+        others = [mb for name, mb in weights.items() if name not in ("unet", "controlnet")]
+        weights_mb = max([denoiser_mb, *others])
+    else:
+        weights_mb = weights.get("unet", 0.0) * SEQUENTIAL_RESIDENT_RATIO
+
+    # Classifier-free guidance doubles the UNet batch.
+    unet_batch = 2 * batch_size
+    tokens = (width // 8) * (height // 8)
+    unet_mb = unet_batch * UNET_CHANNELS * tokens * UNET_LIVE_TENSORS * dtype_bytes / MB
+    attention_mb = 0.0
+    if not efficient_attention:
+        # Score matrices of the full-resolution self-attention, per slice.
+        rows = {None: unet_batch * UNET_ATTENTION_HEADS, "auto": UNET_ATTENTION_HEADS // 2, "max": 1}
+        attention_mb = rows[plan.attention_slicing] * tokens**2 * dtype_bytes / MB
+
+    decode_batch = 1 if plan.vae_slicing else batch_size
+    decode_width, decode_height = width, height
+    if plan.vae_tiling:
+        decode_width, decode_height = min(width, VAE_TILE_SIZE), min(height, VAE_TILE_SIZE)
+    vae_mb = decode_batch * VAE_DECODER_CHANNELS * decode_width * decode_height * VAE_LIVE_TENSORS * dtype_bytes / MB
+    if not efficient_attention:
+        # The VAE mid-block attends over the latent pixels with a single head.
+        vae_mb += decode_batch * ((decode_width // 8) * (decode_height // 8)) ** 2 * dtype_bytes / MB
+
+    return overhead_mb + weights_mb + max(unet_mb + attention_mb, vae_mb)
+
+
+def candidate_plans(dtypes: list[str], efficient_attention: bool, allow_offload: bool) -> list[MemoryPlan]:
+    """Plans from fastest to most frugal."""
+    steps = [{}, {"vae_slicing": True}, {"vae_tiling": True}]
+    if not efficient_attention:
+        # Slicing would replace the memory-efficient attention kernels.
+        steps += [{"attention_slicing": "auto"}, {"attention_slicing": "max"}]
+
+    plans = []
+    for dtype in dtypes:
+        plan = MemoryPlan(dtype=dtype)
+        for step in steps:
+            plan = replace(plan, **step)
+            plans.append(plan)
+    if allow_offload:
+        plans += [replace(plans[-1], offload=offload) for offload in OFFLOAD_LEVELS[1:]]
+    return plans
+
+
+def choose_plan(
+    component_elements: dict[str, int],
+    width: int,
+    height: int,
+    batch_size: int,
+    budget_mb: float | None,
+    dtypes: list[str],
+    efficient_attention: bool,
+    allow_offload: bool,
+    overhead_mb: float = 0.0,
+) -> MemoryPlan:
+    """The first candidate plan whose estimated peak fits ``budget_mb``, else the most frugal one."""
+    plan = None
+    for candidate in candidate_plans(dtypes, efficient_attention, allow_offload):
+        peak_mb = estimate_peak_mb(
+            candidate, component_elements, width, height, batch_size, efficient_attention, overhead_mb
+        )
+        plan = replace(candidate, estimated_peak_mb=peak_mb, budget_mb=budget_mb)
+        if plan.fits:
+            return plan
+    logger.warning(
+        "No memory plan fits the %.0f MB budget; using the most frugal one (~%.0f MB).",
+        budget_mb, plan.estimated_peak_mb,
+    )
+    return plan
+
+
+def count_component_elements(pipeline) -> dict[str, int]:
+    """Parameter and buffer elements of each torch component of ``pipeline``."""
+    import torch
+
+    elements = {}
+    for name, component in pipeline.components.items():
+        if isinstance(component, torch.nn.Module):
+            elements[name] = sum(t.numel() for t in [*component.parameters(), *component.buffers()])
+    return elements
+
+
+def with_default_controlnets(component_elements: dict[str, int]) -> dict[str, int]:
+    """Add an estimate for the default ControlNets when the pipeline holds none yet."""
+    from .controlnets import get_default_controlnet_types
+
+    if "controlnet" in component_elements or "unet" not in component_elements:
+        return component_elements
+    controlnet_count = len(get_default_controlnet_types())
+    return {
+        **component_elements,
+        "controlnet": round(component_elements["unet"] * CONTROLNET_UNET_RATIO * controlnet_count),
+    }
+
+
+def plan_memory(pipeline, device: str, efficient_attention: bool) -> MemoryPlan:
+    """Choose and remember the plan for ``pipeline``, logging the estimate."""
+    global _PLAN
+
+    width, height = plan_resolution()
+    batch_size = plan_batch_size()
+    budget_mb = get_budget_mb(device)
+    plan = choose_plan(
+        with_default_controlnets(count_component_elements(pipeline)),
+        width,
+        height,
+        batch_size,
+        budget_mb,
+        get_plan_dtypes(device),
+        efficient_attention,
+        allow_offload=device == "cuda",
+        overhead_mb=plan_overhead_mb(device),
+    )
+    logger.info(
+        "Memory plan for %dx%d, batch %d: %s | estimated peak %.0f MB of %s MB",
+        width, height, batch_size, plan.describe(), plan.estimated_peak_mb,
+        "unlimited" if budget_mb is None else f"{budget_mb:.0f}",
+    )
+    _PLAN = plan
+    return plan
+
+
+def apply_memory_plan(pipeline, plan: MemoryPlan, device: str) -> None:
+    """Convert, configure and place ``pipeline`` as ``plan`` says."""
+    import torch
+    from accelerate.hooks import remove_hook_from_module
+
+    # Variants share their modules, so drop offload hooks installed for another one.
+    for component in pipeline.components.values():
+        if isinstance(component, torch.nn.Module):
+            remove_hook_from_module(component, recurse=True)
+
+    pipeline.to(dtype=getattr(torch, plan.dtype))
+    if plan.vae_slicing:
+        pipeline.vae.enable_slicing()
+    if plan.vae_tiling:
+        pipeline.vae.enable_tiling()
+    if plan.attention_slicing:
+        pipeline.enable_attention_slicing(plan.attention_slicing)
+
+    if plan.offload == "model":
+        pipeline.enable_model_cpu_offload()
+    elif plan.offload == "sequential":
+        pipeline.enable_sequential_cpu_offload()
+    else:
+        pipeline.to(device)
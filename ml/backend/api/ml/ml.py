@@ -1,58 +1,60 @@
-import base64
-import os
+"""
+Stable Diffusion 3.5 medium with an NF4-quantised transformer.
+
+The ``sd35_nf4`` engine (see ``engines.py``): text-to-image from the configured
+prompt, or img2img from the input photo. It has no ControlNets or IP-Adapter;
+its settings live under ``engines.available.sd35_nf4`` in ``model_config.json``.
+"""
+
+import gc
 import logging
-from io import BytesIO
-from typing import Tuple
+import threading
+import time
 
 import torch
 from diffusers import (
     BitsAndBytesConfig,
     SD3Transformer2DModel,
+    StableDiffusion3Img2ImgPipeline,
     StableDiffusion3Pipeline,
 )
-from huggingface_hub import login
-from PIL import Image, ImageEnhance, ImageFilter
+from PIL import Image
+
+from .artifacts import DEFAULT_SD35_MODEL, resolve_pretrained
+from .config import GENERATION_MODES, load_generation_config, load_model_config, load_prompts_config
+from .memory import module_footprint_mb
+from .pipeline import login, select_device, try_add_xformers
+from .profiling import torch_profile
+from .results import GenerationResult
+from .schedulers import with_scheduler
+from .status import PipelineStatus, PipelineUnavailableError
 
 logger = logging.getLogger(__name__)
 
-PipelineType = object
-_PIPELINE: PipelineType | None = None
+PipelineType = StableDiffusion3Pipeline | StableDiffusion3Img2ImgPipeline
+_PIPELINE: StableDiffusion3Pipeline | None = None
+_IMG2IMG: StableDiffusion3Img2ImgPipeline | None = None
+_LOAD_LOCK = threading.Lock()
+# Load state of this engine; failed loads are retried with the sd15 backoff.
+STATUS = PipelineStatus()
 
 
-def load_pipeline() -> PipelineType | None:
-    """
-    Lazy-load the Stable Diffusion 3.5 pipeline.
+def get_sd35_config() -> dict:
+    return load_model_config().get("engines", {}).get("available", {}).get("sd35_nf4", {})
 
-    If the heavy dependencies are not installed or loading fails, we return None
-    and the caller can decide to fall back to a lightweight effect.
-    """
+
+def _load_locked() -> StableDiffusion3Pipeline | None:
     global _PIPELINE
-    if _PIPELINE is not None:
-        return _PIPELINE
 
+    sd35_config = get_sd35_config()
+    model_id = sd35_config.get("model_id", DEFAULT_SD35_MODEL)
+    login()
+    STATUS.state = "loading"
+    started = time.perf_counter()
     try:
-        # NOTE: the correct repo name includes "3.5". The previous "3" caused
-        # 404s on config.json (see logs around lines 933-1010).
-        model_id = "stabilityai/stable-diffusion-3.5-medium"
-        hf_token = os.getenv("HF_TOKEN")
-        logger.info(
-            "Loading SD3.5 pipeline | torch=%s | cuda_available=%s | hf_token=%s",
-            torch.__version__,
-            torch.cuda.is_available(),
-            bool(hf_token),
-        )
-
-        if hf_token:
-            try:
-                login(token=hf_token, add_to_git_credential=False)
-                logger.info("Authenticated with provided HF token.")
-            except Exception as auth_exc:
-                logger.warning("HF login failed: %s", auth_exc)
-
-        # Pick device/dtype; still enable CPU offload if CUDA missing.
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        dtype = torch.float16 if device == "cuda" else torch.float32
-        logger.info("Selected device=%s dtype=%s", device, dtype)
+        device, dtype = select_device()
+        logger.info("Loading SD3.5 pipeline %s | device=%s dtype=%s", model_id, device, dtype)
+        model_path = resolve_pretrained(model_id)
 
         # Load the transformer in 4-bit NF4 to reduce VRAM usage.
         nf4_config = BitsAndBytesConfig(
@@ -60,92 +62,160 @@ def load_pipeline() -> PipelineType | None:
             bnb_4bit_quant_type="nf4",
             bnb_4bit_compute_dtype=dtype,
         )
-
-        model_nf4 = SD3Transformer2DModel.from_pretrained(
-            model_id,
+        transformer = SD3Transformer2DModel.from_pretrained(
+            model_path,
             subfolder="transformer",
             quantization_config=nf4_config,
             torch_dtype=dtype,
         )
-
         pipeline = StableDiffusion3Pipeline.from_pretrained(
-            model_id,
-            transformer=model_nf4,
+            model_path,
+            transformer=transformer,
             torch_dtype=dtype,
         )
 
-        # Enable xFormers speedup if installed.
-        if hasattr(pipeline, "enable_xformers_memory_efficient_attention"):
-            try:
-                pipeline.enable_xformers_memory_efficient_attention()
-                logger.info("Enabled xFormers memory efficient attention.")
-            except Exception as xformers_exc:
-                logger.warning("xFormers enable failed: %s", xformers_exc)
-
-        # On constrained VRAM, consider CPU offload; comment this out if you want
-        # pure CUDA execution and have enough headroom.
-        pipeline.enable_model_cpu_offload()
-
-        pipeline.to(device)
-
-        _PIPELINE = pipeline
-        logger.info("Stable Diffusion pipeline loaded successfully.")
+        if sd35_config.get("enable_xformers", True):
+            try_add_xformers(pipeline)
+        if sd35_config.get("enable_cpu_offload", True):
+            pipeline.enable_model_cpu_offload()
+        else:
+            pipeline.to(device)
     except Exception as exc:
-        logger.exception("Pipeline load failed; falling back. Reason: %s", exc)
-        _PIPELINE = None
-
+        logger.exception("SD3.5 pipeline load failed. Reason: %s", exc)
+        delay = STATUS.record_failure(exc)
+        logger.warning("SD3.5 pipeline load failed %d time(s); next attempt in %ss.", STATUS.failures, delay)
+        return None
+
+    _PIPELINE = pipeline
+    STATUS.record_ready(time.perf_counter() - started)
+    logger.info("SD3.5 pipeline loaded.")
     return _PIPELINE
 
 
-def _fallback_effect(image: Image.Image) -> Image.Image:
+def load_pipeline() -> StableDiffusion3Pipeline | None:
     """
-    Lightweight image filter used when the diffusion model is unavailable.
+    Return the SD3.5 pipeline, loading it on first use.
+
+    ``None`` if loading fails. After a failure, requests get ``None`` at once
+    until the backoff in ``pipeline_loading`` expires; the next one retries.
     """
-    saturated = ImageEnhance.Color(image).enhance(1.4)
-    blurred_bg = saturated.filter(ImageFilter.GaussianBlur(radius=1.2))
-    overlay = Image.blend(saturated, blurred_bg, alpha=0.25)
-    return overlay
+    if _PIPELINE is not None:
+        return _PIPELINE
+    if not STATUS.retry_due():
+        return None
 
+    # Only a first load is worth queueing behind; a retry may fail again.
+    if not _LOAD_LOCK.acquire(blocking=not STATUS.failures):
+        return None
+    try:
+        if _PIPELINE is not None:
+            return _PIPELINE
+        if not STATUS.retry_due():
+            return None
+        return _load_locked()
+    finally:
+        _LOAD_LOCK.release()
 
-def generate_shrek_image(
-    input_image: Image.Image,
-    prompt: str | None = None,
-    negative_prompt: str | None = None,
-) -> Tuple[Image.Image, bool]:
-    """
-    Run the diffusion model (if available) to generate a Shrekified image.
 
-    Returns:
-        (output_image, used_fallback)
-    """
+def get_pipeline(mode: str = "txt2img") -> PipelineType | None:
+    """Return the pipeline for ``mode``; img2img shares the loaded components."""
+    global _IMG2IMG
+
     pipeline = load_pipeline()
-    if pipeline is None:
-        logger.info("Using fallback image effect because pipeline is unavailable.")
-        return _fallback_effect(input_image), True
+    if pipeline is None or mode == "txt2img":
+        return pipeline
+    with _LOAD_LOCK:
+        if _IMG2IMG is None:
+            _IMG2IMG = StableDiffusion3Img2ImgPipeline.from_pipe(pipeline)
+        return _IMG2IMG
 
-    prompt_text = (
-        prompt
-        or "A friendly ogre-inspired portrait, cinematic lighting, photorealistic."
-    )
-    negative = (
-        negative_prompt
-        or "low quality, blurry, distorted, text, watermark, signature"
+
+def unload_pipeline() -> None:
+    global _PIPELINE, _IMG2IMG
+
+    with _LOAD_LOCK:
+        _PIPELINE = None
+        _IMG2IMG = None
+        STATUS.reset()
+
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def footprint_mb() -> float:
+    return module_footprint_mb(_PIPELINE) if _PIPELINE is not None else 0.0
+
+
+@torch.inference_mode()
+def warm_up() -> None:
+    """Run one short generation so the first request does not pay for kernel setup."""
+    pipeline = load_pipeline()
+    if pipeline is None:
+        return
+    gen_config = load_generation_config()
+    pipeline(
+        prompt="",
+        num_inference_steps=1,
+        height=gen_config.get("height", 768),
+        width=gen_config.get("width", 768),
+        output_type="latent",
     )
 
-    result = pipeline(
-        prompt=prompt_text,
-        negative_prompt=negative,
-        num_inference_steps=30,
-        guidance_scale=4.5,
-        max_sequence_length=512,
-    ).images[0]
-    logger.info("Generation complete with diffusion model.")
-    return result, False
 
+def generate_shrek_images(
+    input_images: list[Image.Image],
+    controlnet_types: list[str] | None = None,
+    mode: str | None = None,
+    strength: float | None = None,
+    profile: str | None = None,
+    scheduler: str | None = None,
+) -> list[GenerationResult]:
+    """
+    Generate Shrekified images with SD3.5, one pipeline call per batch.
 
-def image_to_base64(image: Image.Image) -> str:
-    buffer = BytesIO()
-    image.save(buffer, format="PNG")
-    return base64.b64encode(buffer.getvalue()).decode("utf-8")
+    Takes the same options as ``ml_sd15.generate_shrek_images``; ControlNets,
+    generation profiles and scheduler presets do not apply to this engine and
+    are ignored.
+    """
+    if controlnet_types:
+        logger.debug("SD3.5 engine ignores ControlNets: %s", controlnet_types)
+    if scheduler:
+        logger.debug("SD3.5 engine keeps its flow-matching scheduler, ignoring %s", scheduler)
 
+    gen_config = load_generation_config()
+    sd35_config = get_sd35_config()
+    prompts_config = load_prompts_config()
 
+    mode = mode or gen_config.get("mode", "txt2img")
+    if mode not in GENERATION_MODES:
+        raise ValueError(f"Unknown generation mode: {mode}")
+
+    pipeline = get_pipeline(mode)
+    if pipeline is None:
+        raise PipelineUnavailableError("SD3.5 pipeline is unavailable.")
+
+    width, height = gen_config.get("width", 768), gen_config.get("height", 768)
+    batch_size = len(input_images)
+    gen_kwargs = {
+        "prompt": [prompts_config.get("default_prompt", "")] * batch_size,
+        "negative_prompt": [prompts_config.get("default_negative_prompt", "")] * batch_size,
+        "num_inference_steps": sd35_config.get("num_inference_steps", 30),
+        "guidance_scale": sd35_config.get("guidance_scale", 4.5),
+        "max_sequence_length": sd35_config.get("max_sequence_length", 512),
+    }
+    if mode == "img2img":
+        if strength is None:
+            strength = gen_config.get("img2img", {}).get("strength", 0.6)
+        gen_kwargs["image"] = [image.resize((width, height), Image.LANCZOS) for image in input_images]
+        gen_kwargs["strength"] = strength
+    else:
+        gen_kwargs["height"] = height
+        gen_kwargs["width"] = width
+
+    # Each call steps its own scheduler; concurrent calls share only the models.
+    pipeline = with_scheduler(pipeline, None)
+    with torch_profile("sd35"):
+        results = pipeline(**gen_kwargs).images
+    logger.info("Generation complete with SD3.5 (%d image(s)).", batch_size)
+    return [GenerationResult(image=result, used_fallback=False, control_images=[]) for result in results]
@@ -1,30 +1,140 @@
 """Stable Diffusion v1.5 image generation for Shrekify."""
 
 import logging
-from dataclasses import dataclass
+import math
+from typing import TYPE_CHECKING
 
+import torch
+from diffusers.models.embeddings import ImageProjection
 from PIL import Image
 
-from .config import load_generation_config, load_model_config, load_prompts_config
-from .controlnets import get_controlnets, process_control_images
-from .image_utils import fallback_effect, load_style_image
-from .pipeline import load_pipeline
+from .config import GENERATION_MODES, load_generation_config, load_prompts_config, resolve_generation_config
+from .controlnets import (
+    get_controlnet_scale,
+    get_controlnet_window,
+    get_default_controlnet_types,
+    process_control_images_batch,
+)
+from .guidance import cfg_truncation, skip_inactive_controlnets
+from .image_utils import load_style_image
+from .latents import encode_init_latents
+from .pipeline import PipelineType, get_pipeline_variant, load_pipeline, variant_lock
+from .profiling import torch_profile
+from .results import GenerationResult, fallback_result
+from .schedulers import scheduler_settings, with_scheduler
+from .status import PipelineUnavailableError, pipeline_down
+from .step_cache import step_cache
+from .upscale import base_size, upscale_enabled, upscale_images
+
+if TYPE_CHECKING:
+    from .video import ClipContext
 
 logger = logging.getLogger(__name__)
 
 
-@dataclass
-class GenerationResult:
-    image: Image.Image
-    used_fallback: bool
-    control_images: list[tuple[Image.Image, str]]
+def encode_ip_adapter_images(
+    pipeline: PipelineType,
+    face_images: list[Image.Image],
+    style_image: Image.Image,
+    do_classifier_free_guidance: bool,
+) -> list[torch.Tensor]:
+    """
+    Encode one face image per sample plus the shared style image for IP-Adapter.
 
+    Returns ``ip_adapter_image_embeds`` for a batch of ``len(face_images)``
+    samples, in the order of the adapters listed in ``model_config.json`` (face,
+    then style). The style image is encoded once and repeated.
+    """
+    device = pipeline._execution_device
+    projection_layers = pipeline.unet.encoder_hid_proj.image_projection_layers
+    batch_size = len(face_images)
 
-def generate_shrek_image(input_image: Image.Image) -> GenerationResult:
+    embeds = []
+    for images, projection_layer in zip([face_images, [style_image]], projection_layers):
+        output_hidden_states = not isinstance(projection_layer, ImageProjection)
+        image_embeds, negative_embeds = pipeline.encode_image(images, device, 1, output_hidden_states)
 
-    prompts_config = load_prompts_config()
+        # One image per sample: (batch, 1, ...) as in prepare_ip_adapter_image_embeds.
+        image_embeds = image_embeds[:, None].expand(batch_size, *image_embeds.shape[1:])
+        negative_embeds = negative_embeds[:, None].expand(batch_size, *negative_embeds.shape[1:])
+
+        if do_classifier_free_guidance:
+            embeds.append(torch.cat([negative_embeds, image_embeds]))
+        else:
+            embeds.append(image_embeds)
+
+    return embeds
+
+
+@torch.inference_mode()
+def warm_up() -> None:
+    """Run one short generation at the configured size so the first request does not pay for kernel setup."""
+    pipeline = load_pipeline()
+    if pipeline is None:
+        return
     gen_config = load_generation_config()
-    model_config = load_model_config()
+    width, height = base_size(gen_config.get("width", 768), gen_config.get("height", 768))
+    guidance_scale = gen_config.get("guidance_scale", 7.5)
+    gen_kwargs = {
+        "prompt": "",
+        "num_inference_steps": 1,
+        "guidance_scale": guidance_scale,
+        "height": height,
+        "width": width,
+        "output_type": "latent",
+    }
+    if getattr(pipeline, "ip_adapter_enabled", False):
+        # The IP-Adapter UNet requires image embeddings on every call.
+        blank = Image.new("RGB", (width, height))
+        gen_kwargs["ip_adapter_image_embeds"] = encode_ip_adapter_images(
+            pipeline,
+            [blank],
+            blank,
+            do_classifier_free_guidance=guidance_scale > 1 and pipeline.unet.config.time_cond_proj_dim is None,
+        )
+    pipeline(**gen_kwargs)
+
+
+def generate_shrek_images(
+    input_images: list[Image.Image],
+    controlnet_types: list[str] | None = None,
+    mode: str | None = None,
+    strength: float | None = None,
+    profile: str | None = None,
+    scheduler: str | None = None,
+    clip: "ClipContext | None" = None,
+) -> list[GenerationResult]:
+    """
+    Generate Shrekified images for a batch of inputs in one pipeline call.
+
+    ``controlnet_types`` selects the ControlNets for this request; ``None`` uses
+    the types enabled in ``model_config.json`` and an empty list disables them.
+    ``mode`` is ``txt2img`` (start from noise) or ``img2img`` (start from the
+    encoded photo, running ``strength`` of the steps); ``profile`` names an
+    entry of ``generation.profiles`` and ``scheduler`` a preset of
+    ``schedulers.SCHEDULERS``. ``None`` uses the configured defaults.
+
+    ``clip`` is set when the images are consecutive frames of a video: control
+    maps and IP-Adapter embeddings then come from the clip's cache, and every
+    frame uses the clip's seed.
+    """
+    # Under CPU offload, another request's variant switch would re-hook this one's modules,
+    # and another's IP-Adapter scales would replace this one's on the shared UNet.
+    with variant_lock():
+        return _generate_shrek_images(input_images, controlnet_types, mode, strength, profile, scheduler, clip)
+
+
+def _generate_shrek_images(
+    input_images: list[Image.Image],
+    controlnet_types: list[str] | None,
+    mode: str | None,
+    strength: float | None,
+    profile: str | None,
+    scheduler: str | None,
+    clip: "ClipContext | None",
+) -> list[GenerationResult]:
+    prompts_config = load_prompts_config()
+    gen_config = resolve_generation_config(profile)
 
     style_image_path = prompts_config.get("style_image_path", "")
     prompt_text = prompts_config.get("default_prompt", "")
@@ -33,83 +143,174 @@ def generate_shrek_image(input_image: Image.Image) -> GenerationResult:
     logger.debug("Generating Shrek image with prompt: %s", prompt_text)
     logger.debug("Using negative prompt: %s", negative)
 
-    pipeline = load_pipeline()
+    # After a failed load, fall back at once while the reload runs in the background.
+    pipeline = load_pipeline(wait=not pipeline_down())
 
     if pipeline is None:
-        raise Exception("Pipeline is unavailable.")
+        raise PipelineUnavailableError("Pipeline is unavailable.")
 
-    height = gen_config.get("height", 768)
-    width = gen_config.get("width", 768)
+    # With the upscale stage, diffuse at its smaller base size and enlarge afterwards.
+    width, height = base_size(gen_config.get("width", 768), gen_config.get("height", 768))
     num_inference_steps = gen_config.get("num_inference_steps", 50)
     guidance_scale = gen_config.get("guidance_scale", 7.5)
+    scheduler = scheduler or gen_config.get("scheduler")
+    if scheduler is not None:
+        num_inference_steps, scheduler_guidance = scheduler_settings(scheduler, gen_config)
+        if scheduler_guidance is not None:
+            guidance_scale = scheduler_guidance
+    batch_size = len(input_images)
 
-    logger.debug("Starting Stable Diffusion v1.5 image generation...")
+    mode = mode or gen_config.get("mode", "txt2img")
+    if mode not in GENERATION_MODES:
+        raise ValueError(f"Unknown generation mode: {mode}")
+    if strength is None:
+        strength = gen_config.get("img2img", {}).get("strength", 0.6)
 
-    style_image = load_style_image(style_image_path)
+    logger.debug("Starting Stable Diffusion v1.5 image generation for %d image(s)...", batch_size)
 
-    adapter_scales = gen_config.get("ip_adapter_scales", {})
-    face_scale = adapter_scales.get("face_scale", 0.6)
-    style_scale = adapter_scales.get("style_scale", 0.4)
+    # Variants built by from_pipe do not carry this flag, so read it from the base.
+    ip_adapter_enabled = getattr(pipeline, "ip_adapter_enabled", False)
+    if ip_adapter_enabled:
+        adapter_scales = gen_config.get("ip_adapter_scales", {})
+        face_scale = adapter_scales.get("face_scale", 0.6)
+        style_scale = adapter_scales.get("style_scale", 0.4)
 
-    pipeline.set_ip_adapter_scale([face_scale, style_scale])
-    logger.debug("Set IP-Adapter scales: face=%s, style=%s", face_scale, style_scale)
+        pipeline.set_ip_adapter_scale([face_scale, style_scale])
+        logger.debug("Set IP-Adapter scales: face=%s, style=%s", face_scale, style_scale)
 
-    face_image = input_image.resize((width, height), Image.LANCZOS)
+    face_images = [
+        image if image.size == (width, height)
+        else image.resize((width, height), Image.LANCZOS, reducing_gap=3.0)
+        for image in input_images
+    ]
 
     gen_kwargs = {
-        "ip_adapter_image": [face_image, style_image],
-        "prompt": prompt_text,
-        "negative_prompt": negative,
-        "height": height,
-        "width": width,
+        "prompt": [prompt_text] * batch_size,
+        "negative_prompt": [negative] * batch_size,
         "num_inference_steps": num_inference_steps,
         "guidance_scale": guidance_scale,
     }
+    if mode == "txt2img":
+        # img2img takes its size from the init latents.
+        gen_kwargs["height"] = height
+        gen_kwargs["width"] = width
 
-    # Handle multi-ControlNet
-    controlnets = get_controlnets()
-    controlnet_config = model_config.get("controlnet", {})
-    control_images_with_desc: list[tuple[Image.Image, str]] = []
-
-    if controlnets and controlnet_config.get("enabled", False):
-        controlnet_types_config = controlnet_config.get("types", {})
-        controlnet_types = list(controlnet_types_config.keys())
-        
-        control_images_with_desc = process_control_images(face_image, controlnet_types)
-        
-        if control_images_with_desc:
-            control_images = [img for img, _ in control_images_with_desc]
-            controlnet_scales = [
-                controlnet_types_config.get(cn_type, {}).get("scale", 0.5)
-                for cn_type in controlnet_types
+    if controlnet_types is None:
+        controlnet_types = get_default_controlnet_types()
+
+    pipeline, loaded_types = get_pipeline_variant(controlnet_types, mode)
+    if pipeline is None:
+        raise PipelineUnavailableError("Pipeline is unavailable.")
+
+    # control_images[i][j] is the map of the j-th ControlNet type for sample i; a
+    # failed preprocessor drops its ControlNet from this request.
+    if clip is None:
+        control_images, processed_types = process_control_images_batch(face_images, loaded_types)
+    else:
+        control_images, processed_types = clip.control_maps(face_images, loaded_types)
+
+    if processed_types != loaded_types:
+        pipeline, loaded_types = get_pipeline_variant(processed_types, mode)
+
+    if loaded_types:
+        controlnet_scales = [get_controlnet_scale(cn_type) for cn_type in loaded_types]
+
+        # Pre-scaled tensors skip the pipeline's PIL-to-float conversion.
+        if mode == "img2img":
+            # The ControlNet img2img pipeline takes the init image as ``image``, and
+            # only one batched map per ControlNet rather than maps per sample.
+            gen_kwargs["control_image"] = [
+                torch.stack([sample_controls[j][0].to_tensor() for sample_controls in control_images])
+                for j in range(len(loaded_types))
             ]
-            
-            gen_kwargs["image"] = control_images
-            gen_kwargs["controlnet_conditioning_scale"] = controlnet_scales
-            
-            logger.debug(
-                "ControlNet enabled: types=%s, conditioning_scales=%s",
-                controlnet_types, controlnet_scales
-            )
-
-    result = pipeline(**gen_kwargs).images[0]
-
-    logger.info("Generation complete with Stable Diffusion v1.5.")
-    return GenerationResult(
-        image=result,
-        used_fallback=False,
-        control_images=control_images_with_desc,
-    )
-
-
-def try_generate_shrek_image(input_image: Image.Image) -> GenerationResult:
+        else:
+            gen_kwargs["image"] = [
+                [control_map.to_tensor() for control_map, _ in sample_controls] for sample_controls in control_images
+            ]
+        gen_kwargs["controlnet_conditioning_scale"] = controlnet_scales
+        windows = [get_controlnet_window(cn_type) for cn_type in loaded_types]
+        gen_kwargs["control_guidance_start"] = [start for start, _ in windows]
+        gen_kwargs["control_guidance_end"] = [end for _, end in windows]
+
+        logger.debug(
+            "ControlNet enabled: types=%s, conditioning_scales=%s, windows=%s",
+            loaded_types, controlnet_scales, windows
+        )
+
+    do_classifier_free_guidance = guidance_scale > 1 and pipeline.unet.config.time_cond_proj_dim is None
+
+    ip_adapter_image_embeds = None
+    if ip_adapter_enabled:
+        encode = encode_ip_adapter_images if clip is None else clip.ip_adapter_image_embeds
+        ip_adapter_image_embeds = encode(
+            pipeline,
+            face_images,
+            load_style_image(style_image_path),
+            do_classifier_free_guidance=do_classifier_free_guidance,
+        )
+        gen_kwargs["ip_adapter_image_embeds"] = ip_adapter_image_embeds
+
+    if clip is not None:
+        gen_kwargs["generator"] = clip.generators(batch_size)
+
+    if mode == "img2img":
+        gen_kwargs["image"] = encode_init_latents(pipeline, face_images)
+        gen_kwargs["strength"] = strength
+        logger.debug("img2img: strength=%s, %d denoising step(s)", strength, int(num_inference_steps * strength))
+
+    # From this step on only the conditional branch runs; None keeps guidance throughout.
+    cfg_cutoff = gen_config.get("cfg_cutoff", 1.0)
+    cutoff_step = None
+    if do_classifier_free_guidance and cfg_cutoff < 1:
+        denoising_steps = num_inference_steps if mode == "txt2img" else int(num_inference_steps * strength)
+        cutoff_step = math.ceil(cfg_cutoff * denoising_steps)
+
+    pipeline = with_scheduler(pipeline, scheduler)
+    # CFG truncation goes outermost so the step cache sees the batch it actually runs.
+    with skip_inactive_controlnets(pipeline), \
+            step_cache(pipeline, gen_config.get("step_cache", {}).get("interval", 1)), \
+            cfg_truncation(pipeline, cutoff_step), \
+            torch_profile("sd15"):
+        results = pipeline(**gen_kwargs).images
+
+    if upscale_enabled():
+        results = upscale_images(results, prompt_text, negative, guidance_scale, ip_adapter_image_embeds)
+
+    logger.info("Generation complete with Stable Diffusion v1.5 (%d image(s)).", batch_size)
+    return [
+        GenerationResult(
+            image=result,
+            used_fallback=False,
+            control_images=[(control_map.to_pil(), description) for control_map, description in sample_controls],
+        )
+        for result, sample_controls in zip(results, control_images)
+    ]
+
+
+def generate_shrek_image(
+    input_image: Image.Image,
+    controlnet_types: list[str] | None = None,
+    mode: str | None = None,
+    strength: float | None = None,
+    profile: str | None = None,
+    scheduler: str | None = None,
+) -> GenerationResult:
+    return generate_shrek_images([input_image], controlnet_types, mode, strength, profile, scheduler)[0]
+
+
+def try_generate_shrek_image(
+    input_image: Image.Image,
+    controlnet_types: list[str] | None = None,
+    mode: str | None = None,
+    strength: float | None = None,
+    profile: str | None = None,
+    scheduler: str | None = None,
+) -> GenerationResult:
     try:
-        return generate_shrek_image(input_image)
+        return generate_shrek_image(input_image, controlnet_types, mode, strength, profile, scheduler)
+    except PipelineUnavailableError as unavailable_exc:
+        logger.warning("%s Using fallback effect.", unavailable_exc)
+        return fallback_result(input_image)
     except Exception as gen_exc:
         logger.exception("Image generation failed; using fallback effect. Reason: %s", gen_exc)
-        fallback_result = fallback_effect(input_image)
-        return GenerationResult(
-            image=fallback_result,
-            used_fallback=True,
-            control_images=[],
-        )
+        return fallback_result(input_image)
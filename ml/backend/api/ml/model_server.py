@@ -0,0 +1,299 @@
+"""Long-lived inference process owning the pipeline and preprocessors."""
+
+import itertools
+import logging
+import math
+import os
+import queue
+import signal
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from multiprocessing.connection import Client, Connection, Listener
+from multiprocessing.shared_memory import SharedMemory
+from typing import TYPE_CHECKING, Callable
+
+from PIL import Image
+
+from .config import reload_configs
+from .ipc import SharedImage, get_authkey, put_image, take_image
+from .status import AdmissionRejected
+
+if TYPE_CHECKING:
+    from api.admission import QueueAdmission, Ticket
+    from api.singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Job:
+    image: Image.Image
+    options: dict
+    ticket: "Ticket | None" = None
+    future: Future = field(default_factory=Future)
+    started: threading.Event = field(default_factory=threading.Event)
+
+
+class ModelServer:
+    """
+    Accepts generation jobs over a Unix socket and runs them on one inference thread.
+
+    Connections are handled on their own threads and only enqueue jobs; a single
+    inference thread owns the models. With ``generate_batch``, consecutive queued
+    jobs with the same options, up to ``max_batch_size`` and waiting at most
+    ``batch_window_s`` for more, run as one batch. With ``flights``, jobs sent with
+    the same key while one of them is queued or running share its result, so
+    duplicates from different Django workers run once. With ``admission``
+    (``api.admission.QueueAdmission``), the jobs of every worker are taken
+    from the queue in weighted fair order rather than as they came, and turned
+    away when their class is full or they waited past its timeout; their
+    compute time starts when they run. ``restart`` rereads the configuration
+    and reloads the models between two
+    jobs and ``shutdown`` stops accepting connections but drains the queue first,
+    so neither drops a job that was already accepted.
+    """
+
+    def __init__(
+        self,
+        socket_path: str,
+        generate: Callable,
+        load: Callable[[], None] | None = None,
+        unload: Callable[[], None] | None = None,
+        status: Callable[[], dict] | None = None,
+        generate_batch: Callable | None = None,
+        max_batch_size: int = 1,
+        batch_window_s: float = 0.0,
+        flights: "SingleFlight | None" = None,
+        admission: "QueueAdmission | None" = None,
+    ):
+        self.socket_path = socket_path
+        self.generate = generate
+        self.load = load
+        self.unload = unload
+        self.status = status
+        self.generate_batch = generate_batch
+        self.max_batch_size = max_batch_size if generate_batch is not None else 1
+        self.batch_window_s = batch_window_s
+        self.flights = flights
+        self.admission = admission
+        # Entries are (order, sequence, job): fair order with admission, else arrival.
+        self.jobs: queue.PriorityQueue[tuple[float, int, Job | None]] = queue.PriorityQueue()
+        self._sequence = itertools.count()
+        # Jobs taken off the queue while collecting a batch they did not fit.
+        self._held: deque[Job | None] = deque()
+        self._restart_requested = threading.Event()
+        self._stopping = threading.Event()
+
+    def serve_forever(self) -> None:
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+        if self.load is not None:
+            self.load()
+
+        worker = threading.Thread(target=self._run_jobs, name="model-server-inference")
+        worker.start()
+
+        with Listener(self.socket_path, family="AF_UNIX", authkey=get_authkey()) as listener:
+            os.chmod(self.socket_path, 0o660)
+            logger.info("Model server listening on %s", self.socket_path)
+
+            while not self._stopping.is_set():
+                try:
+                    conn = listener.accept()
+                except OSError as exc:
+                    logger.warning("Rejected model server connection: %s", exc)
+                    continue
+                if self._stopping.is_set():
+                    conn.close()
+                    break
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+        logger.info("Draining %d queued job(s) before exit...", self.jobs.qsize())
+        self.jobs.put((math.inf, next(self._sequence), None))
+        worker.join()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        logger.info("Model server stopped.")
+
+    def restart(self) -> None:
+        logger.info("Model reload requested; it will run after the current job.")
+        self._restart_requested.set()
+
+    def shutdown(self) -> None:
+        logger.info("Model server shutdown requested.")
+        self._stopping.set()
+        # Wake the blocking accept() with a throwaway connection.
+        try:
+            Client(self.socket_path, family="AF_UNIX", authkey=get_authkey()).close()
+        except OSError:
+            pass
+
+    def install_signal_handlers(self) -> None:
+        signal.signal(signal.SIGHUP, lambda *_: self.restart())
+        signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=self.shutdown).start())
+        signal.signal(signal.SIGINT, lambda *_: threading.Thread(target=self.shutdown).start())
+
+    def _handle(self, conn: Connection) -> None:
+        with conn:
+            try:
+                request = conn.recv()
+            except EOFError:
+                return
+
+            if request.get("op") == "ping":
+                conn.send({"ok": True, "queued": self.jobs.qsize()})
+                return
+
+            if request.get("op") == "status":
+                status = self.status() if self.status is not None else {}
+                conn.send({"ok": True, "queued": self.jobs.qsize(), "status": status})
+                return
+
+            try:
+                image = take_image(request["image"])
+            except Exception as exc:
+                conn.send({"ok": False, "error": f"Invalid image: {exc}"})
+                return
+
+            options = request.get("options", {})
+            key = request.get("key")
+            priority = request.get("priority")
+            try:
+                if self.flights is None or key is None:
+                    result, timing = self._submit(image, options, priority)
+                else:
+                    (result, timing), shared = self.flights.do(key, lambda: self._submit(image, options, priority))
+                    if shared:
+                        logger.info("Served a duplicate job from in-flight job %s", key[:12])
+                response = {**self._encode_result(result), "timing": timing}
+            except AdmissionRejected as exc:
+                response = {"ok": False, "rejected": True, "error": str(exc)}
+            except Exception as exc:
+                logger.exception("Model server job failed")
+                response = {"ok": False, "error": str(exc)}
+
+            try:
+                conn.send(response)
+            except OSError:
+                logger.warning("Client disconnected before receiving its result.")
+                self._discard_result(response)
+
+    def _submit(self, image: Image.Image, options: dict, priority: str | None) -> tuple[object, dict | None]:
+        """Queue a job for the inference thread and wait for its result and admission timing."""
+        if self.admission is None:
+            job = Job(image=image, options=options)
+            self.jobs.put((0.0, next(self._sequence), job))
+            return job.future.result(), None
+
+        ticket = self.admission.enqueue(options, priority)
+        job = Job(image=image, options=options, ticket=ticket)
+        self.jobs.put((ticket.finish_tag, next(self._sequence), job))
+        # A job the inference thread has not started yet can still be withdrawn.
+        if not job.started.wait(self.admission.timeout) and job.future.cancel():
+            self.admission.controller.withdraw(ticket)
+        return job.future.result(), ticket.timing()
+
+    def _encode_result(self, result) -> dict:
+        def share(image: Image.Image) -> SharedImage:
+            shm, ref = put_image(image, track=False)
+            shm.close()
+            return ref
+
+        return {
+            "ok": True,
+            "image": share(result.image),
+            "used_fallback": result.used_fallback,
+            "control_images": [
+                (share(control_image), description)
+                for control_image, description in result.control_images
+            ],
+        }
+
+    @staticmethod
+    def _discard_result(response: dict) -> None:
+        if not response.get("ok"):
+            return
+        refs = [response["image"], *(ref for ref, _ in response["control_images"])]
+        for ref in refs:
+            shm = SharedMemory(name=ref.name)
+            shm.close()
+            shm.unlink()
+
+    def _run_jobs(self) -> None:
+        while True:
+            if self._restart_requested.is_set():
+                self._reload()
+
+            try:
+                job = self._held.popleft() if self._held else self._next_job(timeout=0.5)
+            except queue.Empty:
+                continue
+            if job is None:
+                return
+
+            batch = [job for job in self._collect_batch(job) if job.future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            for job in batch:
+                if job.ticket is not None:
+                    self.admission.controller.start(job.ticket)
+                job.started.set()
+
+            try:
+                if len(batch) == 1:
+                    results = [self.generate(batch[0].image, **batch[0].options)]
+                else:
+                    results = self.generate_batch([job.image for job in batch], **batch[0].options)
+            except Exception as exc:
+                self._release(batch)
+                for job in batch:
+                    job.future.set_exception(exc)
+                continue
+            self._release(batch)
+            for job, result in zip(batch, results):
+                job.future.set_result(result)
+
+    def _next_job(self, timeout: float) -> Job | None:
+        """Take the next job off the queue; raises ``queue.Empty`` when none comes within ``timeout`` seconds."""
+        _, _, job = self.jobs.get(timeout=timeout) if timeout > 0 else self.jobs.get_nowait()
+        return job
+
+    def _release(self, batch: list[Job]) -> None:
+        """Release the tickets of a finished batch, so their timing ends before results are returned."""
+        for job in batch:
+            if job.ticket is not None:
+                self.admission.controller.release(job.ticket)
+
+    def _collect_batch(self, first: Job) -> list[Job]:
+        """Add the jobs next in the queue after ``first`` with the same options, up to the batch size."""
+        batch = [first]
+        deadline = time.monotonic() + self.batch_window_s
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                job = self._held.popleft() if self._held else self._next_job(timeout=remaining)
+            except queue.Empty:
+                break
+            if job is None or job.options != first.options:
+                # Keep the queue order: this job runs next, after the batch.
+                self._held.appendleft(job)
+                break
+            batch.append(job)
+
+        if len(batch) > 1:
+            logger.info("Running %d queued job(s) as one batch.", len(batch))
+        return batch
+
+    def _reload(self) -> None:
+        self._restart_requested.clear()
+        logger.info("Reloading models (%d job(s) waiting)...", self.jobs.qsize())
+        if self.unload is not None:
+            self.unload()
+        reload_configs()
+        if self.load is not None:
+            self.load()
+        logger.info("Models reloaded.")
@@ -1,25 +1,67 @@
 """Stable Diffusion pipeline loading and configuration."""
 
+import gc
 import logging
 import os
+import threading
+import time
+from contextlib import AbstractContextManager, nullcontext
 from typing import TypeAlias, Union
 
 import torch
-from diffusers import ControlNetModel, StableDiffusionControlNetPipeline, StableDiffusionPipeline, LCMScheduler
+from accelerate.hooks import remove_hook_from_module
+from diffusers import (
+    LCMScheduler,
+    MultiControlNetModel,
+    StableDiffusionControlNetImg2ImgPipeline,
+    StableDiffusionControlNetPipeline,
+    StableDiffusionImg2ImgPipeline,
+    StableDiffusionPipeline,
+)
 from huggingface_hub import login as hf_login
 
+from .artifacts import offline_mode, resolve_pretrained
 from .config import load_model_config
-from .controlnets import get_controlnets, try_load_controlnets
+from .controlnets import get_controlnets, load_controlnets, unload_controlnets
+from .memory_plan import apply_memory_plan, auto_plan_enabled, current_memory_plan, plan_memory, reset_memory_plan
+from .snapshot import find_snapshot, read_snapshot_marker
+from .status import STATUS, pipeline_down
 
 logger = logging.getLogger(__name__)
 
-PipelineType: TypeAlias = Union[StableDiffusionPipeline, StableDiffusionControlNetPipeline]
+PipelineType: TypeAlias = Union[
+    StableDiffusionPipeline,
+    StableDiffusionControlNetPipeline,
+    StableDiffusionImg2ImgPipeline,
+    StableDiffusionControlNetImg2ImgPipeline,
+]
+# (generation mode, ControlNet types) identifying a pipeline variant.
+VariantKey: TypeAlias = tuple[str, tuple[str, ...]]
+BASE_VARIANT: VariantKey = ("txt2img", ())
+
+# Pipeline class for each generation mode, without and with ControlNets.
+VARIANT_CLASSES: dict[str, tuple[type, type]] = {
+    "txt2img": (StableDiffusionPipeline, StableDiffusionControlNetPipeline),
+    "img2img": (StableDiffusionImg2ImgPipeline, StableDiffusionControlNetImg2ImgPipeline),
+}
+
 _PIPELINE: PipelineType | None = None
+_PIPELINE_PLACED = False
+# Pipelines sharing the base components.
+_VARIANTS: dict[VariantKey, PipelineType] = {}
+_ACTIVE_VARIANT: VariantKey | None = None
+# Guards building and placing variants. Under CPU offload, placing one re-hooks
+# the modules every variant shares, so it is also held while a variant runs.
+_VARIANT_LOCK = threading.RLock()
+# Serialises loads, so concurrent requests never start several multi-minute loads.
+_LOAD_LOCK = threading.Lock()
+_RELOADER: threading.Thread | None = None
+_RELOADER_LOCK = threading.Lock()
 
 
 def login() -> None:
     hf_token = os.getenv("HF_TOKEN")
-    if hf_token:
+    if hf_token and not offline_mode():
         try:
             hf_login(token=hf_token, add_to_git_credential=False)
             logger.info("Authenticated with provided HF token.")
@@ -27,17 +69,19 @@ def login() -> None:
             logger.warning("HF login failed: %s", auth_exc)
 
 
-def try_add_xformers(pipeline: PipelineType) -> None:
-
+def try_add_xformers(pipeline: PipelineType) -> bool:
+    """Enable xFormers attention; returns whether it is on."""
     if hasattr(pipeline, "enable_xformers_memory_efficient_attention"):
         try:
             logger.debug("Attempting to enable xFormers memory efficient attention...")
             pipeline.enable_xformers_memory_efficient_attention()
             logger.info("Enabled xFormers memory efficient attention.")
+            return True
         except Exception as xformers_exc:
             logger.warning("xFormers enable failed: %s", xformers_exc)
     else:
         logger.debug("Pipeline does not have xFormers attention method.")
+    return False
 
 
 def try_add_ip_adapter(pipeline: PipelineType, model_config: dict) -> None:
@@ -54,7 +98,7 @@ def try_add_ip_adapter(pipeline: PipelineType, model_config: dict) -> None:
     try:
         logger.debug("Attempting to load IP-Adapter...")
         pipeline.load_ip_adapter(
-            [ip_config.get("repo", "h94/IP-Adapter")],
+            [resolve_pretrained(ip_config.get("repo", "h94/IP-Adapter"))],
             subfolder=ip_config.get("subfolder", "models"),
             weight_name=ip_config.get("weight_names", [])
         )
@@ -86,7 +130,7 @@ def try_add_lcm_lora(pipeline: PipelineType, lcm_config: dict) -> None:
         lora_id = lcm_config.get("lora_id", "latent-consistency/lcm-lora-sdv1-5")
         logger.debug("Loading LCM-LoRA from %s...", lora_id)
         
-        pipeline.load_lora_weights(lora_id)
+        pipeline.load_lora_weights(resolve_pretrained(lora_id))
         pipeline.fuse_lora()
         
         pipeline.scheduler = LCMScheduler.from_config(pipeline.scheduler.config)
@@ -98,65 +142,324 @@ def try_add_lcm_lora(pipeline: PipelineType, lcm_config: dict) -> None:
         pipeline.lcm_enabled = False
 
 
-def load_pipeline() -> PipelineType | None:
+def select_device() -> tuple[str, torch.dtype]:
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    dtype = torch.float16 if device == "cuda" else torch.float32
+    return device, dtype
+
+
+def build_base_pipeline(model_config: dict, dtype: torch.dtype) -> PipelineType:
+    """Load the base model and merge textual inversions and LCM-LoRA into it."""
+    model_id = model_config.get("model_id", "runwayml/stable-diffusion-v1-5")
+
+    logger.info(
+        "Loading %s | torch=%s | cuda_available=%s",
+        model_id,
+        torch.__version__,
+        torch.cuda.is_available()
+    )
+
+    pipeline = StableDiffusionPipeline.from_pretrained(
+        resolve_pretrained(model_id),
+        torch_dtype=dtype,
+    )
+
+    try_add_textual_inversion(
+        pipeline,
+        model_config.get("textual_inversion_paths", []),
+    )
+    try_add_lcm_lora(pipeline, model_config.get("lcm_lora", {}))
+    return pipeline
+
+
+def assemble_pipeline(model_config: dict, dtype: torch.dtype) -> PipelineType:
+    """
+    Build the base pipeline with all adapters attached, leaving weights on the CPU.
+
+    Loads the fused snapshot from ``build_pipeline_snapshot`` when one matches
+    the config, which skips the textual inversion and LoRA merge work.
+    ControlNets are not part of the base pipeline; ``get_pipeline_variant`` wraps
+    its components together with the ControlNets a request selects.
+    """
+    started = time.perf_counter()
+
+    snapshot_path = None
+    if model_config.get("snapshot", {}).get("enabled", True):
+        snapshot_path = find_snapshot(model_config, dtype)
+
+    if snapshot_path is not None:
+        logger.info("Loading fused pipeline snapshot %s", snapshot_path)
+        # safetensors weights are memory-mapped rather than read up front.
+        pipeline = StableDiffusionPipeline.from_pretrained(
+            snapshot_path,
+            torch_dtype=dtype,
+            use_safetensors=True,
+        )
+        pipeline.lcm_enabled = read_snapshot_marker(snapshot_path).get("lcm_enabled", False)
+    else:
+        pipeline = build_base_pipeline(model_config, dtype)
 
-    global _PIPELINE
-    if _PIPELINE is not None:
-        return _PIPELINE
+    try_add_ip_adapter(pipeline, model_config)
 
-    login()
-    try:
-        model_config = load_model_config()
-        model_id = model_config.get("model_id", "runwayml/stable-diffusion-v1-5")
+    logger.info(
+        "Pipeline assembled in %.1fs (%s).",
+        time.perf_counter() - started,
+        "from snapshot" if snapshot_path is not None else "from scratch",
+    )
+    return pipeline
 
-        logger.info(
-            "Loading %s | torch=%s | cuda_available=%s",
-            model_id,
-            torch.__version__,
-            torch.cuda.is_available()
-        )
 
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        dtype = torch.float16 if device == "cuda" else torch.float32
+def place_pipeline(pipeline: PipelineType, model_config: dict, device: str) -> None:
+    # xFormers runs a probe kernel on the GPU, so it belongs with device placement.
+    xformers_enabled = model_config.get("enable_xformers", True) and try_add_xformers(pipeline)
 
-        controlnets = try_load_controlnets(dtype)
-        
-        if controlnets:
-            logger.info("Using StableDiffusionControlNetPipeline with %d ControlNet(s).", len(controlnets))
-            pipeline = StableDiffusionControlNetPipeline.from_pretrained(
-                model_id,
-                controlnet=controlnets,
-                torch_dtype=dtype,
-            )
-        else:
-            pipeline = StableDiffusionPipeline.from_pretrained(
-                model_id,
-                torch_dtype=dtype,
+    if auto_plan_enabled():
+        # The base pipeline is planned on load; variants reuse its plan.
+        plan = current_memory_plan()
+        if plan is None:
+            efficient_attention = xformers_enabled or (
+                device == "cuda" and hasattr(torch.nn.functional, "scaled_dot_product_attention")
             )
+            plan = plan_memory(pipeline, device, efficient_attention)
+        apply_memory_plan(pipeline, plan, device)
+        return
 
-        if model_config.get("enable_xformers", True):
-            try_add_xformers(pipeline)
+    if model_config.get("enable_cpu_offload", False):
+        logger.info("Enabling model CPU offload for memory efficiency...")
+        # Variants share their modules, so drop hooks installed for another one.
+        for component in pipeline.components.values():
+            if isinstance(component, torch.nn.Module):
+                remove_hook_from_module(component, recurse=True)
+        pipeline.enable_model_cpu_offload()
+    else:
+        pipeline.to(device)
 
-        try_add_ip_adapter(pipeline, model_config)
-        try_add_textual_inversion(
-            pipeline,
-            model_config.get("textual_inversion_paths", []),
-        )
-        try_add_lcm_lora(pipeline, model_config.get("lcm_lora", {}))
 
-        if model_config.get("enable_cpu_offload", False):
-            logger.info("Enabling model CPU offload for memory efficiency...")
-            pipeline.enable_model_cpu_offload()
-        else:
-            pipeline.to(device)
+def preload_pipeline() -> PipelineType | None:
+    """
+    Assemble the pipeline on the CPU without moving it to its device.
+
+    Used by the pre-fork hook: the weights are loaded once in the parent process and
+    placed on the target device lazily by ``load_pipeline`` inside each worker, so
+    CUDA is never initialised before the fork.
+    """
+    global _PIPELINE, _PIPELINE_PLACED
+
+    with _LOAD_LOCK:
+        if _PIPELINE is not None:
+            return _PIPELINE
+
+        login()
+        STATUS.state = "loading"
+        try:
+            _, dtype = select_device()
+            _PIPELINE = assemble_pipeline(load_model_config(), dtype)
+            _PIPELINE_PLACED = False
+            STATUS.state = "idle"
+        except Exception as exc:
+            logger.exception("Pipeline preload failed. Reason: %s", exc)
+            _PIPELINE = None
+            _record_failure(exc)
+
+    return _PIPELINE
+
+
+def _record_failure(exc: Exception) -> None:
+    """Remember a failed load and when it may be retried (exponential backoff)."""
+    delay = STATUS.record_failure(exc)
+    logger.warning("Pipeline load failed %d time(s); next attempt in %ss.", STATUS.failures, delay)
+
+
+def _load_locked() -> PipelineType | None:
+    """Load and place the pipeline. The caller holds ``_LOAD_LOCK``."""
+    global _PIPELINE, _PIPELINE_PLACED, _ACTIVE_VARIANT
+
+    login()
+    STATUS.state = "loading"
+    started = time.perf_counter()
+    try:
+        model_config = load_model_config()
+        device, dtype = select_device()
+
+        pipeline = _PIPELINE
+        if pipeline is None:
+            pipeline = assemble_pipeline(model_config, dtype)
+
+        reset_memory_plan()
+        place_pipeline(pipeline, model_config, device)
 
         _PIPELINE = pipeline
+        _PIPELINE_PLACED = True
+        _VARIANTS.clear()
+        _VARIANTS[BASE_VARIANT] = pipeline
+        _ACTIVE_VARIANT = BASE_VARIANT
     except Exception as exc:
         logger.exception("Pipeline load failed; falling back. Reason: %s", exc)
         _PIPELINE = None
+        _record_failure(exc)
+        return None
 
+    STATUS.record_ready(time.perf_counter() - started)
     return _PIPELINE
 
 
+def _reload_until_ready() -> None:
+    """Background task retrying the load, honouring the backoff, until it succeeds."""
+    while True:
+        delay = (STATUS.next_retry_at or 0) - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+        with _LOAD_LOCK:
+            if _PIPELINE is not None and _PIPELINE_PLACED:
+                return
+            if not STATUS.retry_due():
+                # Another load failed meanwhile and pushed the retry back.
+                continue
+            if _load_locked() is not None:
+                logger.info("Pipeline loaded in the background.")
+                return
+
+
+def _ensure_reloader() -> None:
+    global _RELOADER
+
+    with _RELOADER_LOCK:
+        if _RELOADER is None or not _RELOADER.is_alive():
+            _RELOADER = threading.Thread(target=_reload_until_ready, name="pipeline-reload", daemon=True)
+            _RELOADER.start()
+
+
+def load_pipeline(wait: bool = True) -> PipelineType | None:
+    """
+    Return the placed pipeline, loading it if necessary.
+
+    With ``wait`` the load runs in the calling thread, and concurrent callers
+    queue behind that single load. Without it, a background task loads the
+    pipeline, retrying with exponential backoff, and ``None`` is returned right
+    away so the caller can fall back. After a failure, callers never wait for
+    or repeat a load: that is left to the background task.
+    """
+    if _PIPELINE is not None and _PIPELINE_PLACED:
+        return _PIPELINE
+
+    if not wait:
+        _ensure_reloader()
+        return None
+
+    # While a failed load is retried in the background, do not queue behind it.
+    if not _LOAD_LOCK.acquire(blocking=not pipeline_down()):
+        return None
+    try:
+        if _PIPELINE is not None and _PIPELINE_PLACED:
+            return _PIPELINE
+        # A load may have failed while this caller waited; the retry honours its backoff.
+        pipeline = None if pipeline_down() else _load_locked()
+    finally:
+        _LOAD_LOCK.release()
+
+    if pipeline is None:
+        _ensure_reloader()
+    return pipeline
+
+
 def get_pipeline() -> PipelineType | None:
     return _PIPELINE
+
+
+def _uses_cpu_offload(model_config: dict) -> bool:
+    plan = current_memory_plan()
+    if plan is not None:
+        return plan.offload != "none"
+    return model_config.get("enable_cpu_offload", False)
+
+
+def variant_lock() -> AbstractContextManager:
+    """
+    Hold while running a variant: the variant lock under CPU offload or with an IP-Adapter, a no-op otherwise.
+
+    Offload hooks follow the active variant, and IP-Adapter scales are set on
+    the attention processors of the UNet every variant shares.
+    """
+    model_config = load_model_config()
+    if _uses_cpu_offload(model_config) or model_config.get("ip_adapter"):
+        return _VARIANT_LOCK
+    return nullcontext()
+
+
+def get_pipeline_variant(
+    controlnet_types: list[str],
+    mode: str = "txt2img",
+) -> tuple[PipelineType | None, list[str]]:
+    """
+    Return a pipeline for ``mode`` running the given ControlNets on the shared base.
+
+    The variant reuses the already loaded UNet, VAE, text encoder, IP-Adapter and
+    scheduler of the base pipeline, so switching mode or ControlNet subsets only
+    loads ControlNets that are not resident yet. Returns the pipeline together
+    with the ControlNet types it actually runs, in order.
+    """
+    global _ACTIVE_VARIANT
+
+    base = load_pipeline()
+    if base is None:
+        return None, []
+
+    model_config = load_model_config()
+    device, _ = select_device()
+    with _VARIANT_LOCK:
+        # The memory plan may have changed the base pipeline's dtype.
+        controlnets = load_controlnets(controlnet_types, base.dtype)
+        key: VariantKey = (mode, tuple(controlnets))
+
+        # Forget variants holding a ControlNet the LRU has since evicted.
+        resident = get_controlnets()
+        for stale_key in [k for k in _VARIANTS if any(cn_type not in resident for cn_type in k[1])]:
+            del _VARIANTS[stale_key]
+
+        variant = _VARIANTS.get(key)
+        if variant is None:
+            logger.info("Building %s pipeline variant with ControlNets: %s", mode, list(controlnets))
+            plain_class, controlnet_class = VARIANT_CLASSES[mode]
+            if controlnets:
+                variant = controlnet_class.from_pipe(
+                    base,
+                    controlnet=MultiControlNetModel(list(controlnets.values())),
+                )
+            else:
+                variant = plain_class.from_pipe(base)
+            _VARIANTS[key] = variant
+            place_pipeline(variant, model_config, device)
+            _ACTIVE_VARIANT = key
+        elif key != _ACTIVE_VARIANT and _uses_cpu_offload(model_config):
+            place_pipeline(variant, model_config, device)
+            _ACTIVE_VARIANT = key
+
+    return variant, list(controlnets)
+
+
+def pipeline_footprint_mb() -> float:
+    """Memory held by the base pipeline and the resident ControlNets."""
+    from .memory import module_footprint_mb
+
+    if _PIPELINE is None:
+        return 0.0
+    return module_footprint_mb([_PIPELINE, *get_controlnets().values()])
+
+
+def unload_pipeline() -> None:
+    """Drop the loaded pipeline so the next ``load_pipeline`` call reloads it."""
+    global _PIPELINE, _PIPELINE_PLACED, _ACTIVE_VARIANT
+
+    with _LOAD_LOCK:
+        _PIPELINE = None
+        _PIPELINE_PLACED = False
+        _VARIANTS.clear()
+        _ACTIVE_VARIANT = None
+        STATUS.reset()
+        reset_memory_plan()
+    unload_controlnets()
+
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
@@ -0,0 +1,166 @@
+"""
+On-demand profiling of single requests.
+
+Inside ``capture_profile`` the calling thread runs under cProfile, and the
+pipeline calls wrapped in ``torch_profile`` run under ``torch.profiler``. The
+capture is written to ``profiling.directory/<id>/``:
+
+- ``python.prof`` (open with ``pstats`` or snakeviz) and ``python.txt``, the
+  top functions by cumulative time;
+- ``torch_<name>_<n>.json``, a Chrome trace of each pipeline call (open in
+  Perfetto or chrome://tracing), and ``torch_<name>_<n>.txt``, its top
+  operators;
+- ``meta.json``, what was captured and how long it took.
+
+One capture runs at a time per process: cProfile allows a single active
+profiler (from Python 3.12 it raises otherwise), so a request asking for a
+capture while another runs is served unprofiled.
+
+The active capture lives in a context variable. Outside a capture
+``torch_profile`` only reads that variable, and neither profiler is imported.
+With the model server, pipeline calls run in its process and are not traced.
+"""
+
+import json
+import logging
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Iterator
+
+from .config import load_model_config
+
+logger = logging.getLogger(__name__)
+
+# Relative profiling directories are resolved against the backend directory.
+BACKEND_DIR = Path(__file__).resolve().parents[2]
+
+_CAPTURE: ContextVar["ProfileCapture | None"] = ContextVar("profile_capture", default=None)
+# cProfile allows one active profiler per process.
+_PYTHON_PROFILER_LOCK = threading.Lock()
+# torch.profiler is process-wide, so pipeline calls are traced one at a time.
+_TORCH_PROFILER_LOCK = threading.Lock()
+
+
+@dataclass
+class ProfileCapture:
+    id: str
+    label: str
+    directory: Path
+    torch_traces: list[str] = field(default_factory=list)
+    # Pipeline calls left untraced because another capture held the profiler.
+    torch_skipped: int = 0
+
+
+def get_profiling_config() -> dict:
+    return load_model_config().get("profiling", {})
+
+
+def profiling_enabled() -> bool:
+    return bool(get_profiling_config().get("enabled", False))
+
+
+def get_profiles_dir() -> Path:
+    return BACKEND_DIR / get_profiling_config().get("directory", "profiles")
+
+
+def prune_profiles(directory: Path, keep: int) -> None:
+    """Delete all but the ``keep`` newest captures; their ids start with a timestamp."""
+    captures = sorted(path for path in directory.iterdir() if path.is_dir())
+    for path in captures[:-keep] if keep else captures:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+@contextmanager
+def capture_profile(label: str) -> Iterator[ProfileCapture | None]:
+    """
+    Profile the block (and the pipeline calls in it) into a new capture directory.
+
+    Yields the capture, or ``None`` when another capture is running and the
+    block runs unprofiled.
+    """
+    import cProfile
+    import pstats
+
+    if not _PYTHON_PROFILER_LOCK.acquire(blocking=False):
+        logger.warning("Another capture is running; %s is not profiled.", label)
+        yield None
+        return
+
+    try:
+        profiling_config = get_profiling_config()
+        profiles_dir = get_profiles_dir()
+        capture_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        capture = ProfileCapture(capture_id, label, profiles_dir / capture_id)
+
+        profiler = cProfile.Profile()
+        started = time.perf_counter()
+        profiler.enable()
+        token = _CAPTURE.set(capture)
+        try:
+            capture.directory.mkdir(parents=True)
+            yield capture
+        finally:
+            profiler.disable()
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            _CAPTURE.reset(token)
+
+            profiler.dump_stats(capture.directory / "python.prof")
+            with open(capture.directory / "python.txt", "w", encoding="utf-8") as f:
+                stats = pstats.Stats(profiler, stream=f)
+                stats.sort_stats("cumulative").print_stats(profiling_config.get("top", 50))
+            with open(capture.directory / "meta.json", "w", encoding="utf-8") as f:
+                json.dump(
+                    {
+                        "id": capture.id,
+                        "label": label,
+                        "wall_ms": round(elapsed_ms, 1),
+                        "torch_traces": capture.torch_traces,
+                        "torch_skipped": capture.torch_skipped,
+                    },
+                    f,
+                    indent=4,
+                )
+            prune_profiles(profiles_dir, profiling_config.get("max_captures", 20))
+            logger.info("Profiled %s in %.0f ms: %s", label, elapsed_ms, capture.directory)
+    finally:
+        _PYTHON_PROFILER_LOCK.release()
+
+
+@contextmanager
+def torch_profile(name: str) -> Iterator[None]:
+    """Trace the block with ``torch.profiler`` while a capture is active; otherwise do nothing."""
+    capture = _CAPTURE.get()
+    if capture is None:
+        yield
+        return
+    if not _TORCH_PROFILER_LOCK.acquire(blocking=False):
+        capture.torch_skipped += 1
+        yield
+        return
+
+    try:
+        import torch
+        from torch.profiler import ProfilerActivity, profile
+
+        activities = [ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(ProfilerActivity.CUDA)
+        with profile(activities=activities, record_shapes=True, profile_memory=True) as prof:
+            yield
+
+        stem = f"torch_{name}_{len(capture.torch_traces)}"
+        prof.export_chrome_trace(str(capture.directory / f"{stem}.json"))
+        sort_by = "self_cuda_time_total" if torch.cuda.is_available() else "self_cpu_time_total"
+        (capture.directory / f"{stem}.txt").write_text(
+            prof.key_averages().table(sort_by=sort_by, row_limit=get_profiling_config().get("top", 50)),
+            encoding="utf-8",
+        )
+        capture.torch_traces.append(f"{stem}.json")
+    finally:
+        _TORCH_PROFILER_LOCK.release()
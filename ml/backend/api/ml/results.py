@@ -0,0 +1,29 @@
+"""Generation results, importable without loading the diffusion stack."""
+
+from dataclasses import dataclass
+
+from PIL import Image
+
+from .image_utils import fallback_effect, fallback_effects
+
+
+@dataclass
+class GenerationResult:
+    image: Image.Image
+    used_fallback: bool
+    control_images: list[tuple[Image.Image, str]]
+
+
+def fallback_result(input_image: Image.Image) -> GenerationResult:
+    return GenerationResult(
+        image=fallback_effect(input_image),
+        used_fallback=True,
+        control_images=[],
+    )
+
+
+def fallback_results(input_images: list[Image.Image]) -> list[GenerationResult]:
+    return [
+        GenerationResult(image=image, used_fallback=True, control_images=[])
+        for image in fallback_effects(input_images)
+    ]
@@ -0,0 +1,134 @@
+"""
+Registry of denoising schedulers and their recommended step counts.
+
+A request (or ``generation.scheduler``, or a profile) names a preset. Every
+call runs on a shallow copy of the shared pipeline holding a scheduler of its
+own, built from the loaded scheduler's config, so no weights are reloaded and
+concurrent calls never share a stateful scheduler. Without a preset the
+model's own scheduler runs ``generation.num_inference_steps`` steps. Presets use their
+default step count unless ``generation.schedulers.<name>`` overrides it.
+
+Diffusers is imported only when a scheduler is built, so request validation
+can read this registry without torch.
+"""
+
+import copy
+import logging
+from dataclasses import dataclass, field
+from importlib import import_module
+
+from .config import load_model_config
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class SchedulerPreset:
+    name: str
+    description: str
+    # Scheduler class in ``diffusers``.
+    class_name: str
+    default_steps: int
+    # Step counts worth trying, fewest first; the benchmark times each.
+    recommended_steps: tuple[int, ...]
+    # Keyword arguments of ``from_config``.
+    options: dict = field(default_factory=dict)
+    # Guidance scale the preset needs, overriding the configured one.
+    guidance_scale: float | None = None
+    # Only usable with the LCM-LoRA fused into the UNet.
+    requires_lcm_lora: bool = False
+
+
+SCHEDULERS: dict[str, SchedulerPreset] = {}
+
+
+def register_scheduler(preset: SchedulerPreset) -> None:
+    SCHEDULERS[preset.name] = preset
+
+
+register_scheduler(SchedulerPreset(
+    name="dpmpp_2m",
+    description="DPM-Solver++ (2M) multistep with Karras sigmas",
+    class_name="DPMSolverMultistepScheduler",
+    default_steps=25,
+    recommended_steps=(15, 20, 25, 30),
+    options={"algorithm_type": "dpmsolver++", "solver_order": 2, "use_karras_sigmas": True},
+))
+register_scheduler(SchedulerPreset(
+    name="unipc",
+    description="UniPC multistep",
+    class_name="UniPCMultistepScheduler",
+    default_steps=20,
+    recommended_steps=(10, 15, 20, 25),
+))
+register_scheduler(SchedulerPreset(
+    name="euler_a",
+    description="Euler ancestral",
+    class_name="EulerAncestralDiscreteScheduler",
+    default_steps=30,
+    recommended_steps=(20, 30, 40),
+))
+register_scheduler(SchedulerPreset(
+    name="ddim",
+    description="DDIM",
+    class_name="DDIMScheduler",
+    default_steps=50,
+    recommended_steps=(25, 50),
+))
+register_scheduler(SchedulerPreset(
+    name="lcm",
+    description="Latent consistency (with LCM-LoRA)",
+    class_name="LCMScheduler",
+    default_steps=6,
+    recommended_steps=(4, 6, 8),
+    guidance_scale=1.5,
+    requires_lcm_lora=True,
+))
+
+
+def get_scheduler_names() -> list[str]:
+    """Presets usable with the configured model; ``lcm`` needs ``lcm_lora.enabled``."""
+    lcm_enabled = load_model_config().get("lcm_lora", {}).get("enabled", False)
+    return [name for name, preset in SCHEDULERS.items() if lcm_enabled or not preset.requires_lcm_lora]
+
+
+def get_scheduler_preset(name: str) -> SchedulerPreset:
+    if name not in get_scheduler_names():
+        raise ValueError(f"Unknown or unavailable scheduler: {name}")
+    return SCHEDULERS[name]
+
+
+def scheduler_settings(name: str, gen_config: dict) -> tuple[int, float | None]:
+    """``(num_inference_steps, guidance_scale)`` of a preset; ``None`` keeps the configured guidance."""
+    preset = get_scheduler_preset(name)
+    overrides = gen_config.get("schedulers", {}).get(name, {})
+    return (
+        overrides.get("num_inference_steps", preset.default_steps),
+        overrides.get("guidance_scale", preset.guidance_scale),
+    )
+
+
+def build_scheduler(name: str, base_config):
+    """A new scheduler of preset ``name``, configured from the loaded one's ``base_config``."""
+    preset = get_scheduler_preset(name)
+    scheduler_class = getattr(import_module("diffusers"), preset.class_name)
+    return scheduler_class.from_config(base_config, **preset.options)
+
+
+def with_scheduler(pipeline, name: str | None):
+    """
+    A copy of ``pipeline`` for one call, sharing its models but not its scheduler.
+
+    The copy runs a fresh scheduler of preset ``name``, or of the loaded
+    scheduler's own class for ``None``; ``pipeline`` itself is left untouched.
+    """
+    base = pipeline.scheduler
+    if name is None:
+        scheduler = type(base).from_config(base.config)
+    else:
+        scheduler = build_scheduler(name, base.config)
+        logger.debug("Using scheduler %s (%s)", name, type(scheduler).__name__)
+
+    call_pipeline = copy.copy(pipeline)
+    call_pipeline.scheduler = scheduler
+    return call_pipeline
@@ -0,0 +1,117 @@
+"""
+Fused pipeline snapshots for fast cold starts.
+
+``manage.py build_pipeline_snapshot`` assembles the base pipeline once:
+textual inversions are loaded, LCM-LoRA is fused and the scheduler is swapped.
+The result is saved as safetensors under a directory named after a hash of
+everything that went into it. ``assemble_pipeline`` then loads that directory
+directly, memory-mapped, and only re-attaches the IP-Adapter.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+from pathlib import Path
+
+import torch
+
+from .artifacts import read_lock
+from .config import CONFIG_DIR
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SNAPSHOT_DIR = CONFIG_DIR.parent / "snapshots"
+MARKER_FILE = "shrekify_snapshot.json"
+
+
+def get_snapshot_root(model_config: dict) -> Path:
+    snapshot_dir = model_config.get("snapshot", {}).get("dir")
+    return Path(snapshot_dir) if snapshot_dir else DEFAULT_SNAPSHOT_DIR
+
+
+def snapshot_key(model_config: dict, dtype: torch.dtype) -> str:
+    """
+    Hash the inputs of the fused base pipeline.
+
+    Covers the base model and LCM-LoRA (with their pinned revisions), the
+    textual inversion files, the dtype and the diffusers version, so changing
+    any of them selects a different snapshot.
+    """
+    import diffusers
+
+    lock = read_lock()
+    model_id = model_config.get("model_id", "runwayml/stable-diffusion-v1-5")
+    lcm_config = model_config.get("lcm_lora", {})
+    lora_id = lcm_config.get("lora_id", "latent-consistency/lcm-lora-sdv1-5")
+
+    textual_inversions = []
+    for ti_path in model_config.get("textual_inversion_paths", []):
+        path = Path(ti_path)
+        stat = path.stat() if path.exists() else None
+        textual_inversions.append([ti_path, stat.st_size if stat else None, stat.st_mtime_ns if stat else None])
+
+    inputs = {
+        "model_id": model_id,
+        "model_revision": lock.get(model_id, {}).get("revision"),
+        "lcm_lora": lcm_config.get("enabled", False) and [lora_id, lock.get(lora_id, {}).get("revision")],
+        "textual_inversions": textual_inversions,
+        "dtype": str(dtype),
+        "diffusers": diffusers.__version__,
+    }
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def find_snapshot(model_config: dict, dtype: torch.dtype) -> Path | None:
+    """Return the snapshot matching the current config, if one was built."""
+    path = get_snapshot_root(model_config) / snapshot_key(model_config, dtype)
+    return path if (path / MARKER_FILE).exists() else None
+
+
+def save_snapshot(pipeline, model_config: dict, dtype: torch.dtype) -> Path:
+    """
+    Save a fused base pipeline (without IP-Adapter) under its config hash.
+
+    Written to a temporary directory and renamed into place, so a crashed
+    build never leaves a snapshot that looks complete.
+    """
+    root = get_snapshot_root(model_config)
+    key = snapshot_key(model_config, dtype)
+    target = root / key
+    staging = root / f".{key}.tmp-{os.getpid()}"
+
+    shutil.rmtree(staging, ignore_errors=True)
+    pipeline.save_pretrained(staging, safe_serialization=True)
+
+    with open(staging / MARKER_FILE, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "key": key,
+                "model_id": model_config.get("model_id"),
+                "lcm_enabled": getattr(pipeline, "lcm_enabled", False),
+                "built_at": time.time(),
+            },
+            f,
+            indent=4,
+        )
+
+    shutil.rmtree(target, ignore_errors=True)
+    staging.rename(target)
+    return target
+
+
+def read_snapshot_marker(path: Path) -> dict:
+    with open(path / MARKER_FILE, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def prune_snapshots(model_config: dict, keep: Path) -> list[Path]:
+    """Delete snapshots other than ``keep``; return the removed directories."""
+    removed = []
+    for path in get_snapshot_root(model_config).iterdir():
+        if path.is_dir() and path != keep:
+            shutil.rmtree(path)
+            removed.append(path)
+    return removed
@@ -0,0 +1,67 @@
+"""Pipeline load state, kept free of heavy imports so views can report it cheaply."""
+
+import time
+from dataclasses import asdict, dataclass, fields
+
+from .config import load_model_config
+
+
+class PipelineUnavailableError(RuntimeError):
+    """The pipeline is not loaded: still loading, or failed and waiting to retry."""
+
+
+class AdmissionRejected(Exception):
+    """A job was refused: its class queue is full, or it waited past the timeout."""
+
+
+@dataclass
+class PipelineStatus:
+    state: str = "idle"  # idle, loading, ready or failed
+    last_error: str | None = None
+    failures: int = 0
+    next_retry_at: float | None = None
+    loaded_at: float | None = None
+    load_seconds: float | None = None
+
+    def reset(self) -> None:
+        for status_field in fields(self):
+            setattr(self, status_field.name, status_field.default)
+
+    def record_failure(self, exc: Exception) -> float:
+        """Remember a failed load and when it may be retried (exponential backoff); returns the delay."""
+        loading_config = load_model_config().get("pipeline_loading", {})
+        base_s = loading_config.get("retry_base_s", 30)
+        max_s = loading_config.get("retry_max_s", 900)
+
+        self.state = "failed"
+        self.last_error = f"{type(exc).__name__}: {exc}"
+        self.failures += 1
+        delay = min(base_s * 2 ** (self.failures - 1), max_s)
+        self.next_retry_at = time.time() + delay
+        return delay
+
+    def record_ready(self, load_seconds: float) -> None:
+        self.state = "ready"
+        self.last_error = None
+        self.failures = 0
+        self.next_retry_at = None
+        self.loaded_at = time.time()
+        self.load_seconds = round(load_seconds, 2)
+
+    def retry_due(self) -> bool:
+        return (self.next_retry_at or 0) <= time.time()
+
+
+STATUS = PipelineStatus()
+
+
+def pipeline_down() -> bool:
+    """Whether a load failed and the pipeline is not back yet, including while a retry runs."""
+    return STATUS.failures > 0
+
+
+def get_pipeline_status() -> dict:
+    status = asdict(STATUS)
+    if STATUS.next_retry_at is not None:
+        status["retry_in_s"] = max(round(STATUS.next_retry_at - time.time(), 1), 0.0)
+    return status
@@ -0,0 +1,191 @@
+"""
+Reuse of deep UNet features across denoising steps (DeepCache).
+
+Adjacent steps produce nearly the same high-level UNet features, so with an
+``interval`` of N only every N-th step runs the full UNet. On the other steps
+only ``conv_in``, the first down block and the last up block run: the last up
+block takes the features it received on the previous full step together with
+fresh skip connections from the shallow blocks. The ControlNets' residuals are
+reused on those steps as well, so they skip the ControlNet branches entirely.
+
+Every variant and every concurrent request shares the UNet and ControlNets, so
+their ``forward`` is never swapped per call. Each module instead gets a
+dispatcher once, which applies the wrappers layered on it in the current
+context (``layer_forward``); other requests run the plain forward.
+"""
+
+import logging
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Callable, Iterator
+
+import torch
+
+from .pipeline import PipelineType
+
+logger = logging.getLogger(__name__)
+
+# Forward wrappers of the pipeline calls in this context, per module, innermost first.
+_LAYERS: ContextVar[dict[torch.nn.Module, tuple[Callable[[Callable], Callable], ...]]] = ContextVar(
+    "forward_layers", default={}
+)
+_DISPATCH_LOCK = threading.Lock()
+
+
+@dataclass
+class StepCacheState:
+    interval: int
+    step: int = 0
+    full_steps: int = 0
+    # Input of the last up block and the ControlNet outputs of the last full step.
+    features: torch.Tensor | None = None
+    control_outputs: tuple | None = None
+    control_batch: int | None = None
+    # Set by the UNet wrapper while it runs a cached step.
+    skipping: bool = False
+    restore: list[Callable[[], None]] = field(default_factory=list)
+
+    def is_full_step(self, cached_batch: int | None, batch: int) -> bool:
+        # A changed batch size (e.g. guidance switched off) invalidates the cache.
+        return self.step % self.interval == 0 or cached_batch != batch
+
+
+def _dispatches(forward: Callable) -> bool:
+    """Whether ``forward`` is, or wraps (accelerate offload hooks), a layer dispatcher."""
+    while forward is not None:
+        if getattr(forward, "dispatches_layers", False):
+            return True
+        forward = getattr(forward, "__wrapped__", None)
+    return False
+
+
+def _install_dispatch(module: torch.nn.Module) -> None:
+    """Route ``module.forward`` through the wrappers of the current context, once per module."""
+    with _DISPATCH_LOCK:
+        forward = module.forward
+        # Removing offload hooks puts back the forward from before the dispatcher.
+        if _dispatches(forward):
+            return
+
+        def dispatch(*args, **kwargs):
+            call = forward
+            for make_forward in _LAYERS.get().get(module, ()):
+                call = make_forward(call)
+            return call(*args, **kwargs)
+
+        dispatch.dispatches_layers = True
+        dispatch.__wrapped__ = forward
+        module.forward = dispatch
+
+
+def layer_forward(
+    module: torch.nn.Module,
+    make_forward: Callable[[Callable], Callable],
+    restore: list[Callable[[], None]],
+) -> None:
+    """
+    Wrap ``module.forward`` with ``make_forward`` for the calls made in this context.
+
+    Layers added later run outside earlier ones. Appends the step removing the
+    layer to ``restore``; steps must run in reverse order.
+    """
+    _install_dispatch(module)
+    layers = _LAYERS.get()
+    token = _LAYERS.set({**layers, module: (*layers.get(module, ()), make_forward)})
+    restore.append(lambda: _LAYERS.reset(token))
+
+
+def _hidden_states(args: tuple, kwargs: dict) -> torch.Tensor:
+    return kwargs["hidden_states"] if "hidden_states" in kwargs else args[0]
+
+
+def _install(pipeline: PipelineType, state: StepCacheState) -> None:
+    unet = pipeline.unet
+    # Placeholder for skipped blocks; it broadcasts when ControlNet residuals are added to it.
+    zero = torch.zeros((), device=unet.device, dtype=unet.dtype)
+
+    def unet_forward(forward):
+        def wrapped(sample, *args, **kwargs):
+            cached_batch = None if state.features is None else state.features.shape[0]
+            state.skipping = not state.is_full_step(cached_batch, sample.shape[0])
+            try:
+                return forward(sample, *args, **kwargs)
+            finally:
+                state.full_steps += not state.skipping
+                state.skipping = False
+                state.step += 1
+        return wrapped
+
+    def skipped_down_block(block):
+        outputs = len(block.resnets) + len(block.downsamplers or [])
+
+        def make(forward):
+            def wrapped(*args, **kwargs):
+                if state.skipping:
+                    return zero, (zero,) * outputs
+                return forward(*args, **kwargs)
+            return wrapped
+        return make
+
+    def skipped_block(forward):
+        def wrapped(*args, **kwargs):
+            if state.skipping:
+                return zero
+            return forward(*args, **kwargs)
+        return wrapped
+
+    def last_up_block(forward):
+        def wrapped(*args, **kwargs):
+            if state.skipping:
+                if "hidden_states" in kwargs:
+                    kwargs["hidden_states"] = state.features
+                else:
+                    args = (state.features, *args[1:])
+            else:
+                state.features = _hidden_states(args, kwargs)
+            return forward(*args, **kwargs)
+        return wrapped
+
+    layer_forward(unet, unet_forward, state.restore)
+    for block in unet.down_blocks[1:]:
+        layer_forward(block, skipped_down_block(block), state.restore)
+    layer_forward(unet.mid_block, skipped_block, state.restore)
+    for block in unet.up_blocks[:-1]:
+        layer_forward(block, skipped_block, state.restore)
+    layer_forward(unet.up_blocks[-1], last_up_block, state.restore)
+
+    controlnet = getattr(pipeline, "controlnet", None)
+    if controlnet is not None:
+        def controlnet_forward(forward):
+            def wrapped(sample, *args, **kwargs):
+                # Runs before the UNet of the same step, so ``state.step`` is this step.
+                if state.control_outputs is None or state.is_full_step(state.control_batch, sample.shape[0]):
+                    state.control_outputs = forward(sample, *args, **kwargs)
+                    state.control_batch = sample.shape[0]
+                return state.control_outputs
+            return wrapped
+
+        layer_forward(controlnet, controlnet_forward, state.restore)
+
+
+@contextmanager
+def step_cache(pipeline: PipelineType, interval: int) -> Iterator[StepCacheState | None]:
+    """
+    Cache deep UNet features for ``interval`` steps during the pipeline calls in this block.
+
+    An ``interval`` of 1 (or less) leaves the pipeline untouched and yields ``None``.
+    """
+    if interval <= 1:
+        yield None
+        return
+
+    state = StepCacheState(interval=interval)
+    _install(pipeline, state)
+    try:
+        yield state
+    finally:
+        for restore in reversed(state.restore):
+            restore()
+        logger.debug("Step cache: %d of %d UNet step(s) ran in full", state.full_steps, state.step)
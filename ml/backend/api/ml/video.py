@@ -0,0 +1,247 @@
+"""
+Shrekify short clips, reusing work between near-identical frames.
+
+Frames are streamed from the input file and diffused in batches with the sd15
+engine. Within a clip:
+
+- the IP-Adapter face and style embeddings are encoded once, from the first
+  frame, and reused by every batch;
+- control maps are computed only for key frames. A frame becomes a key frame
+  when it differs from the previous key frame by more than
+  ``video.change_threshold`` (mean absolute difference of small grayscale
+  thumbnails, in ``[0, 1]``); other frames reuse the key frame's maps;
+- every frame starts from the same seed, which keeps consecutive outputs
+  close and limits flicker.
+
+Output frames are appended to the output video as each batch completes, so a
+clip is never held in memory as a whole.
+"""
+
+import logging
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Iterator
+
+import cv2
+import numpy as np
+import torch
+from PIL import Image, ImageSequence
+
+from .config import get_video_config, load_generation_config
+from .controlnets import ControlMap, process_control_images_batch
+from .engines import use_engine
+from .ml_sd15 import encode_ip_adapter_images, generate_shrek_images
+from .upscale import repeat_embeds
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_WIDTH = 64
+GIF_SUFFIXES = {".gif"}
+
+
+@dataclass
+class VideoResult:
+    frames: int
+    fps: float
+    control_maps_computed: int
+    control_maps_reused: int
+    seconds: float
+
+
+def _thumbnail(frame: Image.Image) -> np.ndarray:
+    height = max(1, round(frame.height * THUMBNAIL_WIDTH / frame.width))
+    return np.asarray(frame.convert("L").resize((THUMBNAIL_WIDTH, height), Image.BILINEAR), dtype=np.float32) / 255
+
+
+def frame_change(a: np.ndarray, b: np.ndarray) -> float:
+    """Mean absolute difference of two thumbnails, in ``[0, 1]``."""
+    return float(np.mean(np.abs(a - b)))
+
+
+class ClipContext:
+    """Conditioning shared by the batches of one clip, passed to ``generate_shrek_images``."""
+
+    def __init__(self, seed: int, change_threshold: float):
+        self.seed = seed
+        self.change_threshold = change_threshold
+        self.control_maps_computed = 0
+        self.control_maps_reused = 0
+        self._key_thumbnail: np.ndarray | None = None
+        self._key_maps: dict[str, tuple[ControlMap, str]] = {}
+        self._ip_adapter_embeds: list[torch.Tensor] | None = None
+        self._ip_adapter_cfg: bool | None = None
+
+    def control_maps(
+        self,
+        frames: list[Image.Image],
+        controlnet_types: list[str],
+    ) -> tuple[list[list[tuple[ControlMap, str]]], list[str]]:
+        """Like ``process_control_images_batch``, running the preprocessors on key frames only."""
+        if not controlnet_types:
+            return [[] for _ in frames], []
+
+        # Pick key frames from the thumbnails, then preprocess them in one batch.
+        key_of_frame: list[int | None] = []
+        key_frames: list[Image.Image] = []
+        key_thumbnail = self._key_thumbnail
+        for frame in frames:
+            thumbnail = _thumbnail(frame)
+            if key_thumbnail is None or frame_change(thumbnail, key_thumbnail) > self.change_threshold:
+                key_thumbnail = thumbnail
+                key_frames.append(frame)
+            key_of_frame.append(len(key_frames) - 1 if key_frames else None)
+        self._key_thumbnail = key_thumbnail
+
+        key_maps = []
+        if key_frames:
+            maps, processed_types = process_control_images_batch(key_frames, controlnet_types)
+            key_maps = [dict(zip(processed_types, sample)) for sample in maps]
+            self.control_maps_computed += len(key_frames)
+        self.control_maps_reused += len(frames) - len(key_frames)
+
+        # Frames before the batch's first key frame reuse the previous batch's maps.
+        previous_maps = self._key_maps
+        frame_maps = [previous_maps if key is None else key_maps[key] for key in key_of_frame]
+        if key_maps:
+            self._key_maps = key_maps[-1]
+
+        # A preprocessor that failed on the key frames drops its type for the batch.
+        types = [t for t in controlnet_types if all(t in maps for maps in frame_maps)]
+        return [[maps[t] for t in types] for maps in frame_maps], types
+
+    def ip_adapter_image_embeds(
+        self,
+        pipeline,
+        frames: list[Image.Image],
+        style_image: Image.Image,
+        do_classifier_free_guidance: bool,
+    ) -> list[torch.Tensor]:
+        """The clip's IP-Adapter embeddings, encoded from its first frame, for a batch of ``frames``."""
+        if self._ip_adapter_embeds is None or self._ip_adapter_cfg != do_classifier_free_guidance:
+            self._ip_adapter_embeds = encode_ip_adapter_images(
+                pipeline, frames[:1], style_image, do_classifier_free_guidance
+            )
+            self._ip_adapter_cfg = do_classifier_free_guidance
+        return repeat_embeds(self._ip_adapter_embeds, 0, len(frames), do_classifier_free_guidance)
+
+    def generators(self, count: int) -> list[torch.Generator]:
+        return [torch.Generator().manual_seed(self.seed) for _ in range(count)]
+
+
+def get_frame_rate(path: Path) -> float:
+    if path.suffix.lower() in GIF_SUFFIXES:
+        with Image.open(path) as gif:
+            duration_ms = gif.info.get("duration") or 100
+        return 1000 / duration_ms
+
+    capture = cv2.VideoCapture(str(path))
+    try:
+        return capture.get(cv2.CAP_PROP_FPS) or 25.0
+    finally:
+        capture.release()
+
+
+def iter_frames(path: Path, size: tuple[int, int], max_frames: int | None = None) -> Iterator[Image.Image]:
+    """Yield the frames of a video or GIF as RGB images scaled to ``size``, one at a time."""
+    def scaled(frame: Image.Image) -> Image.Image:
+        return frame if frame.size == size else frame.resize(size, Image.LANCZOS, reducing_gap=3.0)
+
+    count = 0
+    if path.suffix.lower() in GIF_SUFFIXES:
+        with Image.open(path) as gif:
+            for frame in ImageSequence.Iterator(gif):
+                if max_frames is not None and count >= max_frames:
+                    return
+                yield scaled(frame.convert("RGB"))
+                count += 1
+        return
+
+    capture = cv2.VideoCapture(str(path))
+    if not capture.isOpened():
+        raise ValueError(f"Cannot read video: {path.name}")
+    try:
+        while max_frames is None or count < max_frames:
+            ok, frame = capture.read()
+            if not ok:
+                return
+            yield scaled(Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)))
+            count += 1
+    finally:
+        capture.release()
+
+
+def _batched(frames: Iterator[Image.Image], size: int) -> Iterator[list[Image.Image]]:
+    batch = []
+    for frame in frames:
+        batch.append(frame)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def shrekify_video(
+    input_path: Path,
+    output_path: Path,
+    controlnet_types: list[str] | None = None,
+    mode: str | None = None,
+    strength: float | None = None,
+    profile: str | None = None,
+    scheduler: str | None = None,
+    on_progress: Callable[[int], None] | None = None,
+) -> VideoResult:
+    """
+    Shrekify the clip at ``input_path`` into an MP4 at ``output_path``.
+
+    Takes the options of ``ml_sd15.generate_shrek_images``; at most
+    ``video.max_frames`` frames are read. ``on_progress`` receives the number
+    of frames written after every batch.
+    """
+    video_config = get_video_config()
+    gen_config = load_generation_config()
+    size = (gen_config.get("width", 768), gen_config.get("height", 768))
+    fps = get_frame_rate(input_path)
+    clip = ClipContext(
+        seed=video_config.get("seed", 0),
+        change_threshold=video_config.get("change_threshold", 0.02),
+    )
+
+    started = time.perf_counter()
+    written = 0
+    writer = None
+    try:
+        with use_engine("sd15"):
+            frames = iter_frames(input_path, size, video_config.get("max_frames", 300))
+            for batch in _batched(frames, video_config.get("batch_size", 4)):
+                results = generate_shrek_images(
+                    batch, controlnet_types, mode, strength, profile, scheduler, clip=clip
+                )
+                for result in results:
+                    if writer is None:
+                        fourcc = cv2.VideoWriter_fourcc(*video_config.get("codec", "mp4v"))
+                        writer = cv2.VideoWriter(str(output_path), fourcc, fps, result.image.size)
+                    writer.write(cv2.cvtColor(np.asarray(result.image.convert("RGB")), cv2.COLOR_RGB2BGR))
+                written += len(results)
+                if on_progress is not None:
+                    on_progress(written)
+    finally:
+        if writer is not None:
+            writer.release()
+
+    if not written:
+        raise ValueError(f"No frames could be read from {input_path.name}.")
+
+    result = VideoResult(
+        frames=written,
+        fps=fps,
+        control_maps_computed=clip.control_maps_computed,
+        control_maps_reused=clip.control_maps_reused,
+        seconds=time.perf_counter() - started,
+    )
+    logger.info(
+        "Shrekified %d frame(s) in %.1fs; control maps computed for %d, reused for %d.",
+        result.frames, result.seconds, result.control_maps_computed, result.control_maps_reused,
+    )
+    return result
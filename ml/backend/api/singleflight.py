@@ -0,0 +1,66 @@
+"""Coalescing of identical in-flight calls within one process."""
+
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Callable, Generic, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class SingleFlight(Generic[T]):
+    """
+    Run at most one call per key at a time; concurrent callers share its outcome.
+
+    The first caller for a key (the leader) runs the function. Callers arriving
+    while it runs wait for the same result, or see the same exception. Nothing is
+    cached: the key is released as soon as the leader finishes, so later calls
+    run again.
+
+    A waiting caller that gives up (``timeout``) only stops waiting; the leader
+    keeps running and its result is still delivered to everyone else.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: dict[str, Future] = {}
+
+    def do(self, key: str, fn: Callable[[], T], timeout: float | None = None) -> tuple[T, bool]:
+        """
+        Return ``fn()``'s result for ``key`` and whether it came from another caller.
+
+        Raises ``TimeoutError`` if this caller waited more than ``timeout``
+        seconds for another caller's run.
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                future.set_running_or_notify_cancel()
+                self._calls[key] = future
+
+        if not leader:
+            logger.debug("Joining in-flight call %s", key)
+            return future.result(timeout=timeout), True
+
+        try:
+            result = fn()
+        except BaseException as exc:
+            self._release(key)
+            future.set_exception(exc)
+            raise
+
+        self._release(key)
+        future.set_result(result)
+        return result, False
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._calls)
+
+    def _release(self, key: str) -> None:
+        with self._lock:
+            del self._calls[key]
@@ -1,9 +1,11 @@
 from django.urls import path
 
-from api.views import ShrekifyView
+from api.views import PipelineStatusView, ShrekifyVideoView, ShrekifyView
 
 urlpatterns = [
     path("shrekify/", ShrekifyView.as_view(), name="shrekify"),
+    path("shrekify/video/", ShrekifyVideoView.as_view(), name="shrekify-video"),
+    path("pipeline/status/", PipelineStatusView.as_view(), name="pipeline-status"),
 ]
 
 
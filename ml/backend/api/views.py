@@ -1,28 +1,174 @@
 import base64
+import hashlib
+import json
 from io import BytesIO
 import logging
 import os
+import tempfile
+from dataclasses import replace
+from functools import wraps
+from pathlib import Path
 
 from PIL import Image
 from django.conf import settings
 from django.core.files.base import ContentFile
+from django.http import FileResponse
 from rest_framework import status
 from rest_framework.parsers import FormParser, MultiPartParser, JSONParser
 from rest_framework.response import Response
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.views import APIView
 
-from api.ml.ml_sd15 import try_generate_shrek_image
+from api.admission import (
+    AdmissionRejected,
+    admission_status,
+    admit,
+    get_admission_config,
+    get_default_priority,
+    get_priority_classes,
+    server_timing,
+)
+from api.encoding import encode_image, encode_images
+from api.ml.config import (
+    GENERATION_MODES,
+    get_generation_profiles,
+    get_video_config,
+    load_generation_config,
+    load_model_config,
+    load_prompts_config,
+)
+from api.ml.controlnets import get_controlnet_models, get_default_controlnet_types
+from api.ml.engines import get_engine, get_engine_names, resolve_engine, try_generate_image
+from api.ml.image_utils import decode_image
+from api.ml.ipc import model_server_enabled, remote_generate, remote_status
+from api.ml.profiling import capture_profile, profiling_enabled
+from api.ml.results import GenerationResult, fallback_result
+from api.ml.schedulers import get_scheduler_names
+from api.ml.status import PipelineUnavailableError, get_pipeline_status
+from api.singleflight import SingleFlight
 
 logger = logging.getLogger(__name__)
 
+# Identical requests in flight at the same time in this process share one
+# generation; with the model server, duplicates from other workers meet there.
+_GENERATIONS: SingleFlight[tuple[GenerationResult, dict | None]] = SingleFlight()
+
+
+def generate(
+    image: Image.Image,
+    key: str | None = None,
+    priority: str | None = None,
+    **options,
+) -> tuple[GenerationResult, dict | None]:
+    """
+    Run generation in-process, or on the model server when one is configured.
+
+    ``options`` are the keyword arguments of ``try_generate_image``; the engine
+    modules, and with them torch and diffusers, load on the first generation.
+    CPU-only engines always run in-process. ``key`` (see ``generation_key``)
+    lets the model server coalesce duplicates sent by other workers.
+
+    The job is admitted as ``priority`` where it runs: by the model server,
+    whose queue every worker shares, or by this process. Returns the result
+    and the job's admission timing, ``None`` when admission control is
+    disabled; raises ``AdmissionRejected`` when the job is turned away.
+    """
+    engine = get_engine(resolve_engine(options.get("engine"), options.get("profile")))
+    if not model_server_enabled() or engine.cpu_only:
+        with admit(options, priority) as ticket:
+            result = try_generate_image(image, **options)
+        return result, None if ticket is None else ticket.timing()
+
+    try:
+        return remote_generate(image, key=key, priority=priority, **options)
+    except ConnectionError as exc:
+        logger.error("Model server unavailable; using fallback effect. Reason: %s", exc)
+        return fallback_result(image), None
+
+
+def generate_admitted(
+    image: Image.Image,
+    options: dict,
+    priority: str,
+    key: str | None = None,
+) -> tuple[GenerationResult, dict | None]:
+    """
+    Run ``generate``, falling back to ``admission.overload_profile`` when the job is rejected.
+
+    The fallback, if set, is marked as such in the result.
+    """
+    try:
+        return generate(image, key=key, priority=priority, **options)
+    except AdmissionRejected as exc:
+        overload_profile = get_admission_config().get("overload_profile")
+        if not overload_profile or options.get("profile") == overload_profile:
+            raise
+        logger.warning("%s Serving the %s profile instead.", exc, overload_profile)
+        result, timing = generate_admitted(image, {**options, "profile": overload_profile}, priority)
+        return replace(result, used_fallback=True), timing
+
+
+def generation_key(upload, options: dict) -> str:
+    """
+    Key a request by its uploaded bytes and the parameters generation will use.
+
+    The configured defaults are resolved first, so a request that omits a
+    parameter matches one that passes the default explicitly.
+    """
+    digest = hashlib.sha256()
+    for chunk in upload.chunks():
+        digest.update(chunk)
+    upload.seek(0)
+
+    gen_config = load_generation_config()
+    controlnet_types = options.get("controlnet_types")
+    if controlnet_types is None:
+        controlnet_types = get_default_controlnet_types()
+    mode = options.get("mode") or gen_config.get("mode", "txt2img")
+    strength = options.get("strength")
+    if strength is None:
+        strength = gen_config.get("img2img", {}).get("strength", 0.6)
+
+    params = {
+        "engine": resolve_engine(options.get("engine"), options.get("profile")),
+        "controlnets": sorted(set(controlnet_types)),
+        "mode": mode,
+        "strength": strength if mode == "img2img" else None,
+        "profile": options.get("profile") or gen_config.get("profile", "quality"),
+        "scheduler": options.get("scheduler") or gen_config.get("scheduler"),
+        "generation": gen_config,
+        "prompts": load_prompts_config(),
+    }
+    digest.update(json.dumps(params, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def generate_coalesced(
+    upload,
+    image: Image.Image,
+    options: dict,
+    priority: str,
+) -> tuple[GenerationResult, dict | None]:
+    """Run ``generate_admitted``, joining an identical request that is already queued or running."""
+    coalescing_config = load_model_config().get("coalescing", {})
+    if not coalescing_config.get("enabled", True):
+        return generate_admitted(image, options, priority)
+
+    key = generation_key(upload, options)
+    (result, timing), shared = _GENERATIONS.do(
+        key,
+        lambda: generate_admitted(image, options, priority, key),
+        timeout=coalescing_config.get("wait_timeout_s", 300),
+    )
+    if shared:
+        logger.info("Served a duplicate request from in-flight generation %s", key[:12])
+    return result, timing
+
 
 def image_to_base64(image: Image.Image, quality: int = 85) -> str:
     """Convert PIL Image to base64 string."""
-    buffer = BytesIO()
-    rgb_image = image.convert("RGB")
-    rgb_image.save(buffer, format="JPEG", quality=quality, optimize=True)
-    return base64.b64encode(buffer.getvalue()).decode("utf-8")
+    image_base64, _ = encode_image(image, {"format": "JPEG", "quality": quality, "optimize": True})
+    return image_base64
 
 
 def pil_to_content_file(image: Image.Image, filename: str, quality: int = 85) -> ContentFile:
@@ -33,6 +179,141 @@ def pil_to_content_file(image: Image.Image, filename: str, quality: int = 85) ->
     return ContentFile(buffer.getvalue(), name=filename)
 
 
+def parse_controlnet_types(data) -> list[str] | None:
+    """
+    Read the ControlNets selected by a request.
+
+    Accepts repeated ``controlnets`` fields or a comma-separated list. Returns
+    ``None`` when the field is absent so the configured defaults apply.
+    """
+    if "controlnets" not in data:
+        return None
+
+    controlnet_types = [
+        cn_type.strip()
+        for value in data.getlist("controlnets")
+        for cn_type in value.split(",")
+        if cn_type.strip()
+    ]
+
+    known_types = get_controlnet_models()
+    unknown = [cn_type for cn_type in controlnet_types if cn_type not in known_types]
+    if unknown:
+        raise ValueError(
+            f"Unknown ControlNet type(s): {', '.join(unknown)}. "
+            f"Available: {', '.join(known_types)}."
+        )
+
+    return controlnet_types
+
+
+def parse_generation_options(data) -> dict:
+    """
+    Read the generation options of a request as ``try_generate_image`` kwargs.
+
+    Absent fields are left out so the configured defaults apply. Raises
+    ``ValueError`` for invalid values.
+    """
+    options = {}
+
+    engine = data.get("engine")
+    if engine:
+        engines = get_engine_names()
+        if engine not in engines:
+            raise ValueError(f"Unknown engine: {engine}. Available: {', '.join(engines)}.")
+        options["engine"] = engine
+
+    controlnet_types = parse_controlnet_types(data)
+    if controlnet_types is not None:
+        options["controlnet_types"] = controlnet_types
+
+    mode = data.get("mode")
+    if mode:
+        if mode not in GENERATION_MODES:
+            raise ValueError(f"Unknown mode: {mode}. Available: {', '.join(GENERATION_MODES)}.")
+        options["mode"] = mode
+
+    strength = data.get("strength")
+    if strength not in (None, ""):
+        try:
+            options["strength"] = float(strength)
+        except ValueError:
+            raise ValueError(f"Invalid strength: {strength}.") from None
+        if not 0 < options["strength"] <= 1:
+            raise ValueError("strength must be in (0, 1].")
+
+    profile = data.get("profile")
+    if profile:
+        profiles = get_generation_profiles()
+        if profile not in profiles:
+            raise ValueError(f"Unknown profile: {profile}. Available: {', '.join(profiles)}.")
+        options["profile"] = profile
+
+    engine = resolve_engine(options.get("engine"), options.get("profile"))
+    if engine not in get_engine_names():
+        raise ValueError(f"Engine {engine} is disabled.")
+
+    scheduler = data.get("scheduler")
+    if scheduler:
+        schedulers = get_scheduler_names()
+        if scheduler not in schedulers:
+            raise ValueError(f"Unknown scheduler: {scheduler}. Available: {', '.join(schedulers)}.")
+        options["scheduler"] = scheduler
+
+    return options
+
+
+def parse_priority(data, default: str | None = None) -> str:
+    """Read the priority class of a request; ``default`` (or ``admission.default_class``) when absent."""
+    priority = data.get("priority")
+    if not priority:
+        return default or get_default_priority()
+
+    classes = get_priority_classes()
+    if priority not in classes:
+        raise ValueError(f"Unknown priority: {priority}. Available: {', '.join(classes)}.")
+    return priority
+
+
+def decode_upload(upload) -> Image.Image:
+    """Decode an upload at roughly the generation resolution."""
+    gen_config = load_generation_config()
+    upload_config = load_model_config().get("upload", {})
+    target_size = (gen_config.get("width", 768), gen_config.get("height", 768))
+    return decode_image(upload, target_size, max_pixels=upload_config.get("max_pixels"))
+
+
+def profiling_requested(request) -> bool:
+    """Whether an admin asked to profile this request with ``X-Profile: 1`` or ``?profiling=1``."""
+    flag = request.headers.get("X-Profile") or request.query_params.get("profiling")
+    if flag not in ("1", "true"):
+        return False
+    if not request.user.is_staff:
+        logger.warning("Ignoring a profiling request from a non-admin user.")
+        return False
+    return profiling_enabled()
+
+
+def profiled(handler):
+    """
+    Profile a view method when ``profiling_requested``, returning the capture id in ``X-Profile-Id``.
+
+    Other requests only pay for the header lookup.
+    """
+    @wraps(handler)
+    def wrapper(self, request, *args, **kwargs):
+        if not profiling_requested(request):
+            return handler(self, request, *args, **kwargs)
+
+        with capture_profile(f"{type(self).__name__}.{handler.__name__}") as capture:
+            response = handler(self, request, *args, **kwargs)
+        if capture is not None:
+            response["X-Profile-Id"] = capture.id
+        return response
+
+    return wrapper
+
+
 def get_image_url(image_field) -> str:
     """Get the URL for an image field."""
     if image_field and image_field.name:
@@ -43,6 +324,7 @@ def get_image_url(image_field) -> str:
 class ShrekifyView(APIView):
     parser_classes = (MultiPartParser, FormParser)
 
+    @profiled
     def post(self, request, *args, **kwargs):
 
         upload = request.FILES.get("image")
@@ -54,32 +336,164 @@ class ShrekifyView(APIView):
             )
 
         try:
-            pil_image = Image.open(upload).convert("RGB")
-            result = try_generate_shrek_image(pil_image)
-            
+            options = parse_generation_options(request.data)
+            priority = parse_priority(request.data)
+        except ValueError as exc:
+            return Response({"detail": str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            pil_image = decode_upload(upload)
+        except (ValueError, Image.DecompressionBombError, OSError) as exc:
+            return Response(
+                {"detail": f"Invalid image: {exc}"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        try:
+            result, timing = generate_coalesced(upload, pil_image, options, priority)
+        except TimeoutError:
+            return Response(
+                {"detail": "Timed out waiting for an identical request in progress."},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE,
+            )
+        except AdmissionRejected as exc:
+            return Response({"detail": str(exc)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        except Exception as exc:
+            logger.exception("Failed to process image")
+            return Response(
+                {"detail": f"Processing failed: {exc}"},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            )
+
+        try:
+            descriptions = ["Generated Shrek Image"]
+            to_encode = [(result.image, "result")]
+            for control_image, description in result.control_images:
+                descriptions.append(description)
+                to_encode.append((control_image, "control"))
+
+            encoded = encode_images(to_encode)
             images = [
                 {
-                    "image_base64": image_to_base64(result.image),
-                    "description": "Generated Shrek Image",
+                    "image_base64": image_base64,
+                    "mime_type": mime_type,
+                    "description": description,
                 }
+                for (image_base64, mime_type), description in zip(encoded, descriptions)
             ]
-            
-            for control_image, description in result.control_images:
-                images.append({
-                    "image_base64": image_to_base64(control_image),
-                    "description": description,
-                })
-            
-            return Response(
-                {
-                    "images": images,
-                    "used_fallback": result.used_fallback,
-                },
-                status=status.HTTP_200_OK,
-            )
+
+            body = {
+                "images": images,
+                "used_fallback": result.used_fallback,
+            }
+            if timing is None:
+                return Response(body, status=status.HTTP_200_OK)
+
+            body["timing"] = timing
+            return Response(body, status=status.HTTP_200_OK, headers={"Server-Timing": server_timing(timing)})
         except Exception as exc:
             logger.exception("Failed to process image")
             return Response(
                 {"detail": f"Processing failed: {exc}"},
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR,
             )
+
+
+def shrekify_video_admitted(input_path: Path, output_path: Path, options: dict, priority: str):
+    """
+    Run ``shrekify_video`` once admitted; returns its result and the job's ticket.
+
+    A clip holds the cost of one batch of ``video.batch_size`` frames for as
+    long as it runs.
+    """
+    from api.ml.video import shrekify_video
+
+    batch_size = get_video_config().get("batch_size", 4)
+    with admit({**options, "engine": "sd15"}, priority, images=batch_size) as ticket:
+        result = shrekify_video(input_path, output_path, **options)
+    return result, ticket
+
+
+class ShrekifyVideoView(APIView):
+    """Shrekify a short video or GIF, responding with the MP4 as it is read from disk."""
+
+    parser_classes = (MultiPartParser, FormParser)
+
+    def post(self, request, *args, **kwargs):
+        upload = request.FILES.get("video")
+        if upload is None:
+            return Response(
+                {"detail": "No video file provided (use 'video' in form-data)."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        try:
+            options = parse_generation_options(request.data)
+            priority = parse_priority(request.data, get_admission_config().get("video_class", "batch"))
+        except ValueError as exc:
+            return Response({"detail": str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+        if resolve_engine(options.pop("engine", "sd15"), options.get("profile")) != "sd15":
+            return Response({"detail": "Videos are generated with the sd15 engine."}, status=status.HTTP_400_BAD_REQUEST)
+
+        max_mb = get_video_config().get("max_upload_mb", 50)
+        if upload.size > max_mb * 2**20:
+            return Response(
+                {"detail": f"Video larger than {max_mb} MB."},
+                status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            )
+
+        if model_server_enabled():
+            # Clips run in-process; the model server only takes single images.
+            return Response(
+                {"detail": "Video generation is unavailable with the model server."},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE,
+            )
+
+        with tempfile.TemporaryDirectory(prefix="shrekify-video-") as workdir:
+            input_path = Path(workdir) / f"input{Path(upload.name).suffix.lower() or '.mp4'}"
+            output_path = Path(workdir) / "output.mp4"
+            with open(input_path, "wb") as f:
+                for chunk in upload.chunks():
+                    f.write(chunk)
+
+            try:
+                result, ticket = shrekify_video_admitted(input_path, output_path, options, priority)
+            except AdmissionRejected as exc:
+                return Response({"detail": str(exc)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+            except ValueError as exc:
+                return Response({"detail": str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+            except PipelineUnavailableError as exc:
+                return Response({"detail": str(exc)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+            except Exception as exc:
+                logger.exception("Failed to process video")
+                return Response(
+                    {"detail": f"Processing failed: {exc}"},
+                    status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                )
+
+            # The open handle keeps the file readable after the directory is removed.
+            output = open(output_path, "rb")
+
+        response = FileResponse(output, content_type="video/mp4", filename="shrekified.mp4")
+        response["X-Frames"] = str(result.frames)
+        response["X-Control-Maps-Reused"] = str(result.control_maps_reused)
+        if ticket is not None:
+            response["Server-Timing"] = ticket.server_timing()
+        return response
+
+
+class PipelineStatusView(APIView):
+    """Report whether the diffusion pipeline is loading, ready or failed, and the admission queues."""
+
+    def get(self, request, *args, **kwargs):
+        if not model_server_enabled():
+            pipeline_status = get_pipeline_status()
+            admission = admission_status()
+            if admission is not None:
+                pipeline_status = {**pipeline_status, "admission": admission}
+        else:
+            try:
+                pipeline_status = remote_status()
+            except ConnectionError as exc:
+                pipeline_status = {"state": "unavailable", "last_error": str(exc)}
+        return Response(pipeline_status, status=status.HTTP_200_OK)
@@ -0,0 +1,33 @@
+"""
+Gunicorn configuration for the ML backend.
+
+Usage:
+    uv run gunicorn -c gunicorn.conf.py
+
+The app is preloaded so the models are loaded once in the arbiter (see
+``api.ml.memory.prepare_for_fork``) and shared copy-on-write by every worker.
+
+Workers are threaded, so the requests of one worker share its admission queues,
+coalesced generations and models. Those are per process: run the model server
+to share them across workers.
+"""
+import os
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "backend.settings")
+# Check for CUDA through NVML so the arbiter never initialises a CUDA context,
+# which would break the forked workers.
+os.environ.setdefault("PYTORCH_NVML_BASED_CUDA_CHECK", "1")
+
+wsgi_app = "backend.wsgi:application"
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:8000")
+workers = int(os.getenv("GUNICORN_WORKERS", "2"))
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "600"))
+preload_app = True
+
+
+def when_ready(server):
+    from api.ml.memory import prepare_for_fork
+
+    prepare_for_fork()
@@ -2,6 +2,7 @@ import { useState } from "react";
 import { useForm, FormProvider } from "react-hook-form";
 import { zodResolver } from "@hookform/resolvers/zod";
 import { useShrekify } from "@/hooks/useShrekify";
+import { base64ToDataUrl } from "@/apiClient";
 import { shrekifyFormSchema, type ShrekifyFormData } from "@/lib/schema";
 import { PageLayout } from "@/components/Layout";
 import { ImageInputCard } from "@/components/ImageInputCard";
@@ -58,7 +59,7 @@ function App() {
     const mainImage = shrekifyMutation.data?.images?.[0];
     if (mainImage) {
       const link = document.createElement("a");
-      link.href = `data:image/jpeg;base64,${mainImage.image_base64}`;
+      link.href = base64ToDataUrl(mainImage.image_base64, mainImage.mime_type);
       link.download = "glowup-transformation.jpg";
       link.click();
     }
@@ -3,6 +3,7 @@
 // ML backend returns images as base64 strings with optional description
 export interface MLImage {
     image_base64: string;
+    mime_type?: string;
     description?: string;
 }
 
@@ -84,7 +84,7 @@ export default function EnhancePage() {
     const mainImage = shrekifyMutation.data?.images?.[0];
     if (mainImage) {
       // Create a data URL from base64
-      const dataUrl = `data:image/jpeg;base64,${mainImage.image_base64}`;
+      const dataUrl = base64ToDataUrl(mainImage.image_base64, mainImage.mime_type);
       const link = document.createElement("a");
       link.href = dataUrl;
       link.download = "glowup-transformation.jpg";
@@ -116,12 +116,12 @@ export default function EnhancePage() {
       {
         input_image_base64: preview || "",
         generated_image_base64: result.images[0].image_base64
-          ? `data:image/jpeg;base64,${result.images[0].image_base64}`
+          ? base64ToDataUrl(result.images[0].image_base64, result.images[0].mime_type)
           : "",
         control_images_base64: result.images
           .slice(1)
           .map((img) =>
-            img.image_base64 ? `data:image/jpeg;base64,${img.image_base64}` : ""
+            img.image_base64 ? base64ToDataUrl(img.image_base64, img.mime_type) : ""
           ),
       },
       {
@@ -154,7 +154,7 @@ export default function EnhancePage() {
     ? shrekifyMutation.data.images.map((img) => ({
         ...img,
         src: img.image_base64
-          ? `data:image/jpeg;base64,${img.image_base64}`
+          ? base64ToDataUrl(img.image_base64, img.mime_type)
           : undefined,
       }))
     : null;